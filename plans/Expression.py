@@ -0,0 +1,558 @@
+from abc import ABCMeta, abstractmethod
+import ast
+import operator
+import re
+
+
+# the functions that may be called from within a predicate or projection
+FUNCTIONS = {
+    "abs": abs,
+    "round": round,
+    "min": min,
+    "max": max,
+    "len": len,
+    "str": str,
+    "int": int,
+    "float": float
+}
+
+# keywords which can never be attribute names
+KEYWORD_LITERALS = {"None": None, "True": True, "False": False}
+KEYWORD_OPERATORS = ["and", "or", "not"]
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+    | (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)
+    | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)
+    | (?P<parameter>:[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<operator><--|==|!=|<>|<=|>=|<|>|\+|-|\*|/|%|\(|\)|\[|\]|,)
+    """, re.VERBOSE)
+
+
+class ParseError(Exception):
+    """
+    This exception reports a syntax error in a query or expression, along with where in the text it was found.
+    """
+    def __init__(self, description, position, text):
+        """
+        :param description: string, what is wrong
+        :param position: int, the offset of the error within the text
+        :param text: string, the query or expression text
+        """
+        Exception.__init__(self, "%s at position %d in: %s" % (description, position, text))
+        self.description = description
+        self.position = position
+        self.text = text
+
+
+class Token:
+    """
+    This class defines a single lexical token of an expression.
+    """
+    def __init__(self, kind, value, position):
+        """
+        Token object constructor
+        :param kind: string, one of 'number', 'string', 'name', 'parameter', 'operator' or 'end'
+        :param value: string, the text of the token
+        :param position: int, the offset of the token within the expression text
+        """
+        self.kind = kind
+        self.value = value
+        self.position = position
+
+
+def tokenize(input_string):
+    """
+    Splits an expression or query string into a list of tokens in a single pass, ending with an 'end' token.
+    :param input_string: The expression or query text
+    :return: A list of Token objects
+    """
+    tokens = []
+    index = 0
+    while index < len(input_string):
+        match = TOKEN_PATTERN.match(input_string, index)
+        if not match:
+            raise ParseError("unexpected character %s" % input_string[index], index, input_string)
+        if match.lastgroup != "space":
+            tokens.append(Token(match.lastgroup, match.group(), index))
+        index = match.end()
+
+    tokens.append(Token("end", "", index))
+    return tokens
+
+
+class Expression:
+    """
+    Abstract class for the nodes of a parsed predicate or projection expression.
+    Expressions are compiled into python functions by generating their source with every attribute reference
+    replaced by a positional lookup into the row.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def to_source(self, column_source):
+        """
+        Generates python source for the expression
+        :param column_source: function mapping an attribute name to the source that reads it
+        :return: string, the python source
+        """
+        pass
+
+    @abstractmethod
+    def columns(self):
+        """
+        :return: A list of the attribute names referenced by the expression, in order of first appearance
+        """
+        pass
+
+    @abstractmethod
+    def map_columns(self, function):
+        """
+        Copies the expression, renaming every attribute reference
+        :param function: function mapping an attribute name to its new name
+        :return: The renamed Expression
+        """
+        pass
+
+    @abstractmethod
+    def parameters(self):
+        """
+        :return: A list of the Parameter placeholders in the expression
+        """
+        pass
+
+    def __str__(self):
+        return self.to_source(lambda name: name)
+
+
+class Literal(Expression):
+    def __init__(self, value):
+        self.value = value
+
+    def to_source(self, column_source):
+        return repr(self.value)
+
+    def columns(self):
+        return []
+
+    def map_columns(self, function):
+        return self
+
+    def parameters(self):
+        return []
+
+
+class Column(Expression):
+    def __init__(self, name):
+        self.name = name
+
+    def to_source(self, column_source):
+        return column_source(self.name)
+
+    def columns(self):
+        return [self.name]
+
+    def map_columns(self, function):
+        return Column(function(self.name))
+
+    def parameters(self):
+        return []
+
+
+class ParameterValues(dict):
+    """
+    This class holds the values of the parameters of a prepared query. Every expression parsed for the query shares
+    it, and the compiled expressions read their parameter values from it each time they run.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        # the names of every parameter referenced in the query
+        self.names = set()
+
+
+class Parameter(Expression):
+    def __init__(self, name, values):
+        """
+        :param name: string, the parameter name, without its leading colon
+        :param values: ParameterValues: where the value of the parameter is read from when the expression runs
+        """
+        self.name = name
+        self.values = values
+        values.names.add(name)
+
+    def to_source(self, column_source):
+        return "parameters[%r]" % self.name
+
+    def columns(self):
+        return []
+
+    def map_columns(self, function):
+        return self
+
+    def parameters(self):
+        return [self]
+
+    def __str__(self):
+        return ":" + self.name
+
+
+class UnaryOperation(Expression):
+    def __init__(self, operator, operand):
+        """
+        :param operator: string, one of 'not', '-' or '+'
+        :param operand: Expression: the operand
+        """
+        self.operator = operator
+        self.operand = operand
+
+    def to_source(self, column_source):
+        separator = " " if self.operator == "not" else ""
+        return "(%s%s%s)" % (self.operator, separator, self.operand.to_source(column_source))
+
+    def columns(self):
+        return self.operand.columns()
+
+    def map_columns(self, function):
+        return UnaryOperation(self.operator, self.operand.map_columns(function))
+
+    def parameters(self):
+        return self.operand.parameters()
+
+
+class BinaryOperation(Expression):
+    def __init__(self, operator, operands):
+        """
+        :param operator: string, a boolean, comparison or arithmetic operator
+        :param operands: List of Expressions: two or more operands, joined by the operator
+        """
+        self.operator = operator
+        self.operands = operands
+
+    def to_source(self, column_source):
+        return "(%s)" % (" %s " % self.operator).join(operand.to_source(column_source) for operand in self.operands)
+
+    def columns(self):
+        return _merge_columns(self.operands)
+
+    def map_columns(self, function):
+        return BinaryOperation(self.operator, [operand.map_columns(function) for operand in self.operands])
+
+    def parameters(self):
+        return [parameter for operand in self.operands for parameter in operand.parameters()]
+
+
+class Comparison(Expression):
+    def __init__(self, operators, operands):
+        """
+        Comparisons may be chained as in python, so a < b <= c has operators ['<', '<='] and operands [a, b, c]
+        :param operators: List of strings: the comparison operators
+        :param operands: List of Expressions: one more operand than there are operators
+        """
+        self.operators = operators
+        self.operands = operands
+
+    def to_source(self, column_source):
+        source = self.operands[0].to_source(column_source)
+        for operator, operand in zip(self.operators, self.operands[1:]):
+            source += " %s %s" % (operator, operand.to_source(column_source))
+        return "(%s)" % source
+
+    def columns(self):
+        return _merge_columns(self.operands)
+
+    def map_columns(self, function):
+        return Comparison(self.operators, [operand.map_columns(function) for operand in self.operands])
+
+    def parameters(self):
+        return [parameter for operand in self.operands for parameter in operand.parameters()]
+
+
+class FunctionCall(Expression):
+    def __init__(self, function_name, arguments):
+        """
+        :param function_name: string, a key of FUNCTIONS
+        :param arguments: List of Expressions: the arguments to the function
+        """
+        self.function_name = function_name
+        self.arguments = arguments
+
+    def to_source(self, column_source):
+        return "%s(%s)" % (self.function_name, ", ".join(argument.to_source(column_source) for argument in self.arguments))
+
+    def columns(self):
+        return _merge_columns(self.arguments)
+
+    def map_columns(self, function):
+        return FunctionCall(self.function_name, [argument.map_columns(function) for argument in self.arguments])
+
+    def parameters(self):
+        return [parameter for argument in self.arguments for parameter in argument.parameters()]
+
+
+def split_conjuncts(expression):
+    """
+    Splits a predicate into the list of predicates which are and-ed together at its top level
+    :param expression: Expression: the predicate
+    :return: A list of Expressions
+    """
+    if isinstance(expression, BinaryOperation) and expression.operator == "and":
+        return [conjunct for operand in expression.operands for conjunct in split_conjuncts(operand)]
+    return [expression]
+
+
+def conjunction(expressions):
+    """
+    The inverse of split_conjuncts: ands a non-empty list of predicates together
+    :param expressions: List of Expressions
+    :return: The combined Expression
+    """
+    if len(expressions) == 1:
+        return expressions[0]
+    return BinaryOperation("and", list(expressions))
+
+
+def _merge_columns(expressions):
+    columns = []
+    for expression in expressions:
+        columns.extend(column for column in expression.columns() if column not in columns)
+    return columns
+
+
+class ExpressionParser:
+    """
+    This object parses an expression string into an Expression tree by recursive descent.
+    Precedence follows python: or, and, not, comparisons, + and -, then * / and %, then unary minus.
+    """
+
+    comparison_operators = ["==", "!=", "<>", "<", "<=", ">", ">="]
+
+    def __init__(self, input_string, parameters=None, tokens=None, index=0):
+        """
+        :param input_string: The expression text, or the query text when parsing an expression embedded in a query
+        :param parameters: ParameterValues: shared by the parameters of the expression; None creates a new one
+        :param tokens: List of Tokens: the tokens of the query when parsing an embedded expression, which ends at a
+            closing square bracket rather than the end of the text. None tokenizes the expression text.
+        :param index: int, the index of the first token of an embedded expression
+        """
+        self.input_string = input_string
+        self.parameters = parameters if parameters is not None else ParameterValues()
+        self.embedded = tokens is not None
+        self.tokens = tokens if tokens is not None else tokenize(input_string)
+        self.index = index
+
+    def _peek(self):
+        return self.tokens[self.index]
+
+    def _next(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def _error(self, message):
+        raise ParseError(message, self._peek().position, self.input_string)
+
+    def _accept(self, value):
+        token = self._peek()
+        if token.kind in ("operator", "name") and token.value == value:
+            self.index += 1
+            return True
+        return False
+
+    def _expect(self, value):
+        if not self._accept(value):
+            self._error("expecting %s" % value)
+
+    def parse(self):
+        expression = self._parse_or()
+        self._expect_end()
+        return expression
+
+    def parse_projection_list(self):
+        """
+        Parses a comma separated list of projections, each optionally renamed with the AS keyword
+        :return: A list of (Expression, output attribute name) pairs
+        """
+        projections = [self._parse_projection()]
+        while self._accept(","):
+            projections.append(self._parse_projection())
+        self._expect_end()
+        return projections
+
+    def _parse_projection(self):
+        start = self._peek().position
+        expression = self._parse_or()
+        name = self.input_string[start:self._peek().position].strip()
+
+        if self._accept("AS"):
+            token = self._next()
+            if token.kind != "name":
+                self.index -= 1
+                self._error("expecting attribute name after AS")
+            name = token.value
+        return expression, name
+
+    def _expect_end(self):
+        # an embedded expression ends at the square bracket closing it, which is left for the query parser
+        token = self._peek()
+        if self.embedded and token.kind == "operator" and token.value == "]":
+            return
+        if token.kind != "end":
+            self._error("unexpected token %s" % token.value)
+
+    def _parse_or(self):
+        operands = [self._parse_and()]
+        while self._accept("or"):
+            operands.append(self._parse_and())
+        return operands[0] if len(operands) == 1 else BinaryOperation("or", operands)
+
+    def _parse_and(self):
+        operands = [self._parse_not()]
+        while self._accept("and"):
+            operands.append(self._parse_not())
+        return operands[0] if len(operands) == 1 else BinaryOperation("and", operands)
+
+    def _parse_not(self):
+        if self._accept("not"):
+            return UnaryOperation("not", self._parse_not())
+        return self._parse_comparison()
+
+    def _parse_comparison(self):
+        operands = [self._parse_additive()]
+        operators = []
+        while self._peek().kind == "operator" and self._peek().value in self.comparison_operators:
+            operator = self._next().value
+            operators.append("!=" if operator == "<>" else operator)
+            operands.append(self._parse_additive())
+        return operands[0] if not operators else Comparison(operators, operands)
+
+    def _parse_additive(self):
+        return self._parse_arithmetic(["+", "-"], self._parse_multiplicative)
+
+    def _parse_multiplicative(self):
+        return self._parse_arithmetic(["*", "/", "%"], self._parse_unary)
+
+    def _parse_arithmetic(self, operators, parse_operand):
+        expression = parse_operand()
+        while self._peek().kind == "operator" and self._peek().value in operators:
+            operator = self._next().value
+            expression = BinaryOperation(operator, [expression, parse_operand()])
+        return expression
+
+    def _parse_unary(self):
+        if self._peek().kind == "operator" and self._peek().value in ("-", "+"):
+            operator = self._next().value
+            return UnaryOperation(operator, self._parse_unary())
+        return self._parse_primary()
+
+    def _parse_primary(self):
+        token = self._next()
+
+        if token.kind == "number":
+            return Literal(ast.literal_eval(token.value))
+
+        if token.kind == "string":
+            return Literal(ast.literal_eval(token.value))
+
+        if token.kind == "parameter":
+            return Parameter(token.value[1:], self.parameters)
+
+        if token.kind == "name":
+            if token.value in KEYWORD_LITERALS:
+                return Literal(KEYWORD_LITERALS[token.value])
+            if token.value in KEYWORD_OPERATORS:
+                self.index -= 1
+                self._error("unexpected keyword %s" % token.value)
+
+            # a name followed by an open paren is a function call
+            if self._accept("("):
+                if token.value not in FUNCTIONS:
+                    self.index -= 2
+                    self._error("unknown function %s" % token.value)
+                arguments = []
+                if not self._accept(")"):
+                    arguments.append(self._parse_or())
+                    while self._accept(","):
+                        arguments.append(self._parse_or())
+                    self._expect(")")
+                return FunctionCall(token.value, arguments)
+
+            return Column(token.value)
+
+        if token.kind == "operator" and token.value == "(":
+            expression = self._parse_or()
+            self._expect(")")
+            return expression
+
+        self.index -= 1
+        self._error("unexpected token %s" % (token.value or "end of input"))
+
+
+def parse_expression(input_string, parameters=None):
+    """
+    Parses an expression string into an Expression tree.
+    :param input_string: The expression text, e.g. "company_name == 'First Bank Corporation' and salary > :salary"
+    :param parameters: ParameterValues: where the values of :name parameters are read from; None creates a new one
+    :return: The root Expression
+    """
+    return ExpressionParser(input_string, parameters).parse()
+
+
+def parse_projection_list(input_string, parameters=None):
+    """
+    Parses a projection list string into expressions and output attribute names.
+    :param input_string: The projection list text, e.g. "person_name, salary * 1.1 AS salary"
+    :param parameters: ParameterValues: where the values of :name parameters are read from; None creates a new one
+    :return: A list of (Expression, output attribute name) pairs
+    """
+    return ExpressionParser(input_string, parameters).parse_projection_list()
+
+
+def compile_expression(expression, schema):
+    """
+    Compiles an expression into a python function of a single row, with every attribute reference
+    resolved to its position in the schema ahead of time.
+    :param expression: Expression: the parsed expression
+    :param schema: Schema: the schema of the rows the function will be applied to
+    :return: A function taking a row and returning the value of the expression
+    """
+    return _compile_lambda(expression.to_source(_column_source(schema)), parameter_values([expression]))
+
+
+def compile_row_builder(expressions, schema):
+    """
+    Compiles a list of expressions into a single python function building an output row from an input row.
+    Plain attribute references become direct positional picks from the input row.
+    :param expressions: List of Expressions: one per output attribute
+    :param schema: Schema: the schema of the input rows
+    :return: A function taking an input row and returning the output row as a tuple
+    """
+    # a projection made up only of attribute references is a single native itemgetter call
+    if len(expressions) > 1 and all(isinstance(expression, Column) for expression in expressions):
+        return operator.itemgetter(*[schema.position(expression.name) for expression in expressions])
+
+    column_source = _column_source(schema)
+    return _compile_lambda("(%s,)" % ", ".join(expression.to_source(column_source) for expression in expressions)
+                           if expressions else "()", parameter_values(expressions))
+
+
+def parameter_values(expressions):
+    """
+    :param expressions: List of Expressions
+    :return: ParameterValues: where the parameters of the expressions read their values from, or None if they
+        have no parameters
+    """
+    for expression in expressions:
+        for parameter in expression.parameters():
+            return parameter.values
+    return None
+
+
+def _column_source(schema):
+    return lambda name: "row[%d]" % schema.position(name)
+
+
+def _compile_lambda(body, parameters=None):
+    namespace = {"__builtins__": {}, "parameters": parameters}
+    namespace.update(FUNCTIONS)
+    return eval(compile("lambda row: %s" % body, "<expression>", "eval"), namespace)
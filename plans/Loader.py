@@ -0,0 +1,256 @@
+import array
+import csv
+import itertools
+import marshal
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import PlanNode as pn
+
+
+# the delimiter of a file, by its extension; files with any other extension are read as comma separated
+DELIMITERS = {".csv": ",", ".tsv": "\t", ".tab": "\t"}
+
+# the field values read as NULL (None)
+NULL_VALUES = frozenset(["", "NULL", "null", "\\N"])
+
+# the number of rows parsed at a time when a file is read by a single process
+BATCH_ROWS = 10000
+
+# the number of bytes of the file parsed by each task when a file is read by several processes
+DEFAULT_CHUNK_SIZE = 4 * 2 ** 20
+
+# the kinds of value a column can hold, each able to represent every value of the kinds before it
+INT, FLOAT, STRING = range(3)
+
+# the field values read as floats: python's float() also accepts words such as "nan" and "inf", which in a file are
+# far more likely to be text
+FLOAT_PATTERN = re.compile(r"\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$")
+
+# the range of ints a typed integer column can hold
+LONG_BITS = 8 * array.array('l').itemsize
+LONG_MIN, LONG_MAX = -2 ** (LONG_BITS - 1), 2 ** (LONG_BITS - 1) - 1
+
+
+class FormatError(Exception):
+    """
+    Raised while a file is being parsed, possibly in a worker process, when a row doesn't match the header
+    """
+    pass
+
+
+class LoadReport:
+    """
+    This object describes how long a file took to load, for working out the throughput of a loader.
+    """
+    def __init__(self, name, path, rows, size, seconds):
+        """
+        :param name: string, the name of the loaded relation
+        :param path: string, the path of the file
+        :param rows: int, the number of rows loaded
+        :param size: int, the size of the file in bytes
+        :param seconds: float, the time taken to read and convert the whole file
+        """
+        self.name = name
+        self.path = path
+        self.rows = rows
+        self.size = size
+        self.seconds = seconds
+
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else float("inf")
+
+    def megabytes_per_second(self):
+        return self.size / 2.0 ** 20 / self.seconds if self.seconds else float("inf")
+
+    def __str__(self):
+        return "loaded %d rows (%.1f MB) into %s in %.2fs: %d rows/s, %.1f MB/s" % \
+            (self.rows, self.size / 2.0 ** 20, self.name, self.seconds, self.rows_per_second(),
+             self.megabytes_per_second())
+
+
+def _records(reader, width, path):
+    """
+    Skips the blank lines of a file, checking every other row has a field per attribute
+    """
+    for row in reader:
+        if not row:
+            continue
+        if len(row) != width:
+            raise FormatError("%s: a row has %d fields but the header has %d: %s" % (path, len(row), width, row))
+        yield row
+
+
+def _infer(rows, stats, null_values):
+    """
+    Widens the kind of each column to hold a batch of rows
+    :param rows: array of rows of field strings
+    :param stats: array holding, for each column, a list of its kind, whether it has NULLs, and whether it has ints
+        too large for a typed column. The lists are updated in place.
+    """
+    for values, column in itertools.izip(itertools.izip(*rows), stats):
+        for value in values:
+            if value in null_values:
+                column[1] = True
+                continue
+            if column[0] == INT:
+                try:
+                    number = int(value)
+                    if not LONG_MIN <= number <= LONG_MAX:
+                        column[2] = True
+                    continue
+                except ValueError:
+                    column[0] = FLOAT
+            if column[0] == FLOAT:
+                if FLOAT_PATTERN.match(value):
+                    continue
+                column[0] = STRING
+            # the column is known to be a string column, so only a NULL could tell us anything more
+            if column[1]:
+                break
+
+
+def _convert(rows, stats, null_values):
+    """
+    Converts a batch of rows to columns of typed values
+    :return: array of the values of each column
+    """
+    columns = []
+    for values, (kind, nullable, _) in itertools.izip(itertools.izip(*rows), stats):
+        convert = (int, float, str)[kind]
+        if nullable:
+            columns.append([None if value in null_values else convert(value) for value in values])
+        else:
+            columns.append(map(convert, values))
+    return columns
+
+
+def _read_range(path, start, end, delimiter):
+    with open(path, "rb") as input_file:
+        input_file.seek(start)
+        return list(csv.reader(input_file.read(end - start).splitlines(True), delimiter=delimiter))
+
+
+def _infer_range(task):
+    path, start, end, delimiter, width, null_values = task
+    stats = [[INT, False, False] for _ in range(width)]
+    rows = list(_records(_read_range(path, start, end, delimiter), width, path))
+    _infer(rows, stats, null_values)
+    return len(rows), stats
+
+
+def _convert_range(task):
+    path, start, end, delimiter, width, null_values, stats = task
+    rows = list(_records(_read_range(path, start, end, delimiter), width, path))
+    return marshal.dumps(_convert(rows, stats, null_values))
+
+
+def _ranges(path, start, chunk_size):
+    """
+    Splits a file into ranges of about chunk_size bytes, each ending at the end of a line
+    :return: array of (start, end) pairs
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as input_file:
+        while start < size:
+            input_file.seek(min(start + chunk_size, size))
+            input_file.readline()
+            end = min(input_file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _batches(path, start, delimiter, width):
+    """
+    Reads the rows of a file after its header, a batch at a time
+    """
+    with open(path, "rb") as input_file:
+        input_file.seek(start)
+        records = _records(csv.reader(input_file, delimiter=delimiter), width, path)
+        while True:
+            rows = list(itertools.islice(records, BATCH_ROWS))
+            if not rows:
+                return
+            yield rows
+
+
+def _column(kind, nullable, wide):
+    """
+    :return: an empty column able to hold values of the given kind: a typed array where possible, else a list
+    """
+    if nullable:
+        return []
+    if kind == INT and not wide:
+        return array.array('l')
+    if kind == FLOAT:
+        return array.array('d')
+    return []
+
+
+def load_delimited(path, name, delimiter=None, null_values=NULL_VALUES, processes=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Loads a CSV or TSV file with a header line of attribute names into a columnar relation.
+    The file is read twice, a batch of rows at a time, so only the relation being built is held in memory: the first
+    pass infers the kind of each column, the narrowest of int, float and string which holds every value but the NULLs,
+    and the second converts the values to it. Columns of ints or floats without NULLs are stored in typed arrays.
+    :param path: string, the path of the file
+    :param name: string, the name of the relation
+    :param delimiter: string, the field delimiter. By default it's worked out from the file extension.
+    :param null_values: the field values read as NULL
+    :param processes: int, the number of processes parsing the file. Beyond one, the file is split into ranges of lines
+        parsed in parallel, so quoted fields mustn't span several lines.
+    :param chunk_size: int, the size in bytes of the ranges parsed by each process
+    :return: The ColumnarRelation, and a LoadReport for it
+    """
+    started = time.time()
+    if delimiter is None:
+        delimiter = DELIMITERS.get(os.path.splitext(path)[1].lower(), ",")
+
+    with open(path, "rb") as input_file:
+        header = input_file.readline()
+        start = input_file.tell()
+    if not header.strip():
+        sys.exit("%s has no header line" % path)
+    schema = next(csv.reader([header], delimiter=delimiter))
+    width = len(schema)
+
+    stats = [[INT, False, False] for _ in range(width)]
+    rows = 0
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        if pool is None:
+            for batch in _batches(path, start, delimiter, width):
+                _infer(batch, stats, null_values)
+                rows += len(batch)
+        else:
+            ranges = _ranges(path, start, chunk_size)
+            tasks = [(path, range_start, range_end, delimiter, width, null_values)
+                     for range_start, range_end in ranges]
+            for range_rows, range_stats in pool.imap_unordered(_infer_range, tasks):
+                rows += range_rows
+                for column, range_column in zip(stats, range_stats):
+                    column[:] = [max(column[0], range_column[0]), column[1] or range_column[1],
+                                 column[2] or range_column[2]]
+
+        columns = [_column(*column) for column in stats]
+        if pool is None:
+            converted = (_convert(batch, stats, null_values) for batch in _batches(path, start, delimiter, width))
+        else:
+            converted = itertools.imap(marshal.loads, pool.imap(_convert_range, [task + (stats,) for task in tasks]))
+        for batch_columns in converted:
+            for column, values in zip(columns, batch_columns):
+                column.extend(values)
+    except FormatError as error:
+        # the error is raised in whichever process parsed the row, and reported here
+        sys.exit(str(error))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    relation = pn.ColumnarRelation(schema, columns, name)
+    return relation, LoadReport(name, path, rows, os.path.getsize(path), time.time() - started)
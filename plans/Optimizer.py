@@ -0,0 +1,700 @@
+from collections import Counter
+
+import Expression as ex
+import PlanNode as pn
+
+
+# joins of up to this many inputs are ordered by exhaustive dynamic programming, larger joins greedily
+MAX_EXHAUSTIVE_JOIN_INPUTS = 10
+
+# the fraction of tuples assumed to pass a selection conjunct the estimates know nothing about
+DEFAULT_SELECTIVITY = 1 / 3.0
+
+# comparison operators with the operands swapped, so a condition can be written with its attribute on the left
+SWAPPED_OPERATORS = {"==": "==", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+class Optimizer:
+    """
+    This object rewrites bound execution plans into cheaper plans producing the same output.
+    First, subplans which appear more than once are evaluated once and shared through spool nodes, turning the plan
+    into a DAG. Later rules never push anything into a spool, since it has to produce the same output for every
+    consumer.
+    Selections are split into their conjuncts, and each conjunct is pushed as far down the plan as it can go. The
+    conjuncts of a selection over a cartesian product which compare both inputs are made into a theta join.
+    Chains of inner natural joins are then reordered by their estimated cost, using the cardinality and distinct value
+    counts of the relations in the catalog.
+    Selections on indexed relations are turned into index scans, and joins with an indexed relation on their join
+    attribute look their matches up in the index.
+    Then projections are inserted below joins, cartesian products and aggregations, so attributes that nothing
+    above needs are dropped as early as possible. The output schema of the plan is never changed.
+    Finally the sort orders of the nodes are used to drop sorts of already ordered inputs, to merge joins of inputs
+    sorted on their join attributes and to aggregate sorted inputs one group at a time.
+    """
+
+    def __init__(self, relations, indexes=None):
+        """
+        Class constructor.
+        :param relations: A dictionary of relation names to relation objects, the catalog of the plans being optimized
+        :param indexes: A dictionary of relation names to lists of the indexes built on them (defined in PlanNode.py)
+        """
+        self.relations = relations
+        self.indexes = indexes if indexes is not None else {}
+
+    def optimize(self, plan):
+        """
+        Applies every rewrite rule to a plan
+        :param plan: Plan Node or Relation: the root of the plan
+        :return: The root of the bound, rewritten plan
+        """
+        if not isinstance(plan, pn.PlanNode):
+            return plan
+
+        plan.bind()
+        plan = self.share_common_subplans(plan)
+        plan.bind()
+        plan = self.push_down_selections(plan)
+        plan.bind()
+        plan = self.reorder_joins(plan)
+        plan.bind()
+        plan = self.use_indexes(plan)
+        plan.bind()
+        plan = self.prune_columns(plan, None)
+        plan.bind()
+        plan = self.use_sort_orders(plan)
+        plan.bind()
+        return plan
+
+    @staticmethod
+    def _children(node):
+        return [attribute for attribute in ("left_child", "right_child") if hasattr(node, attribute)]
+
+    @staticmethod
+    def _resolve(schema, expression):
+        """
+        Renames every attribute reference of an expression to the exact name it resolves to in a schema
+        """
+        return expression.map_columns(lambda name: schema[schema.position(name)])
+
+    @staticmethod
+    def _select(conjuncts, child):
+        """
+        Builds a bound select node over a child for a list of conjuncts, or returns the child if there are none
+        """
+        if not conjuncts:
+            return child
+        predicate = ex.conjunction(conjuncts)
+        node = pn.SelectNode(predicate, predicate.columns(), child)
+        node.bind()
+        return node
+
+    @staticmethod
+    def _product(node):
+        """
+        Builds a bound cartesian product of the inputs of a theta join
+        """
+        product = pn.CartesianProductNode(node.left_child, node.right_child)
+        product.bind()
+        return product
+
+    def share_common_subplans(self, plan):
+        """
+        Replaces every occurrence of a subplan which appears more than once in a plan with a single spool node, so the
+        subplan is evaluated once per execution. Relations are already materialized, so they are never spooled.
+        :param plan: the root of the bound plan
+        :return: the root of the rewritten plan
+        """
+        occurrences = Counter()
+        self._count_subplans(plan, occurrences)
+        return self._share_subplans(plan, occurrences, {})
+
+    def _count_subplans(self, node, occurrences):
+        """
+        Counts the occurrences of each subplan fingerprint. A repeated subplan will be evaluated once, so the subplans
+        within it are only counted the first time it is seen.
+        """
+        fingerprint = node.fingerprint()
+        occurrences[fingerprint] += 1
+        if occurrences[fingerprint] == 1:
+            for attribute in self._children(node):
+                self._count_subplans(getattr(node, attribute), occurrences)
+
+    def _share_subplans(self, node, occurrences, spools):
+        """
+        Rewrites a subplan, replacing repeated subplans with the spool node built at their first occurrence
+        :param spools: dictionary of fingerprints to the spool nodes built so far
+        """
+        if isinstance(node, pn.Relation):
+            return node
+        fingerprint = node.fingerprint()
+        if fingerprint in spools:
+            return spools[fingerprint]
+
+        for attribute in self._children(node):
+            setattr(node, attribute, self._share_subplans(getattr(node, attribute), occurrences, spools))
+
+        if occurrences[fingerprint] > 1:
+            node = pn.SpoolNode(node, occurrences[fingerprint])
+            node.bind()
+            spools[fingerprint] = node
+        return node
+
+    def push_down_selections(self, node):
+        """
+        Pushes every selection in a bound plan as far towards the leaves as it can go
+        :param node: the root of the plan
+        :return: the root of the rewritten plan
+        """
+        for attribute in self._children(node):
+            setattr(node, attribute, self.push_down_selections(getattr(node, attribute)))
+
+        if isinstance(node, pn.SelectNode):
+            return self._push_selection(ex.split_conjuncts(node.predicate), node.left_child)
+        if isinstance(node, pn.ThetaJoinNode):
+            return self._push_selection(ex.split_conjuncts(node.predicate), self._product(node))
+        return node
+
+    def _push_selection(self, conjuncts, node):
+        """
+        Applies a list of conjuncts to the output of a node, pushing each one below the node where possible
+        :param conjuncts: List of Expressions: predicates over the output schema of the node
+        :param node: the bound node the predicates apply to
+        :return: the rewritten node
+        """
+        if not conjuncts:
+            return node
+        schema = node.schema
+        conjuncts = [self._resolve(schema, conjunct) for conjunct in conjuncts]
+
+        # adjacent selections are merged and pushed down together
+        if isinstance(node, pn.SelectNode):
+            return self._push_selection(conjuncts + ex.split_conjuncts(node.predicate), node.left_child)
+
+        # a theta join is a selection over the product of its inputs, so its conjuncts are pushed down the same way
+        if isinstance(node, pn.ThetaJoinNode):
+            return self._push_selection(conjuncts + ex.split_conjuncts(node.predicate), self._product(node))
+
+        remaining = []
+
+        if isinstance(node, pn.NaturalJoinNode):
+            # a conjunct can go to any side whose attributes it references, unless that side supplies the nulls of an
+            # outer join. Conjuncts on the common attributes go to both sides of an inner join.
+            left, right = [], []
+            for conjunct in conjuncts:
+                columns = conjunct.columns()
+                pushed = False
+                if columns and not node.is_right_outer and all(c in node.left_child.schema for c in columns):
+                    left.append(conjunct)
+                    pushed = True
+                if columns and not node.is_left_outer and all(c in node.right_child.schema for c in columns):
+                    right.append(conjunct)
+                    pushed = True
+                if not pushed:
+                    remaining.append(conjunct)
+            node.left_child = self._push_selection(left, node.left_child)
+            node.right_child = self._push_selection(right, node.right_child)
+
+        elif isinstance(node, pn.CartesianProductNode):
+            # the output attributes are the qualified attributes of the left child followed by those of the right
+            left_schema, right_schema = node.left_child.schema, node.right_child.schema
+            split = len(left_schema)
+            left, right = [], []
+            for conjunct in conjuncts:
+                positions = [schema.index(c) for c in conjunct.columns()]
+                if positions and max(positions) < split:
+                    left.append(conjunct.map_columns(lambda c: left_schema[schema.index(c)]))
+                elif positions and min(positions) >= split:
+                    right.append(conjunct.map_columns(lambda c: right_schema[schema.index(c) - split]))
+                else:
+                    remaining.append(conjunct)
+            node.left_child = self._push_selection(left, node.left_child)
+            node.right_child = self._push_selection(right, node.right_child)
+
+            # the conjuncts comparing both inputs join them, so the product is never built
+            if remaining:
+                node = pn.ThetaJoinNode(node.left_child, node.right_child, ex.conjunction(remaining))
+                node.bind()
+                return node
+
+        elif isinstance(node, pn.SetOperationNode):
+            # selection distributes over union, intersection and difference alike
+            node.left_child = self._push_selection(conjuncts, node.left_child)
+            node.right_child = self._push_selection(conjuncts, node.right_child)
+
+        elif isinstance(node, pn.ProjectNode):
+            # conjuncts over output attributes which are plain references to input attributes can be renamed and
+            # pushed below the projection
+            left_schema = node.left_child.schema
+            sources = dict((name, left_schema[left_schema.position(projection.name)])
+                           for name, projection in zip(node.schema, node.projections)
+                           if isinstance(projection, ex.Column))
+            below = []
+            for conjunct in conjuncts:
+                if all(c in sources for c in conjunct.columns()):
+                    below.append(conjunct.map_columns(lambda c: sources[c]))
+                else:
+                    remaining.append(conjunct)
+            node.left_child = self._push_selection(below, node.left_child)
+
+        elif isinstance(node, pn.DivisionNode):
+            # conjuncts over the quotient attributes keep or drop whole quotients, so they can filter the dividend
+            node.left_child = self._push_selection(conjuncts, node.left_child)
+
+        elif isinstance(node, pn.SortNode):
+            # filtering before sorting leaves fewer tuples to sort
+            node.left_child = self._push_selection(conjuncts, node.left_child)
+
+        elif isinstance(node, pn.AggregationNode):
+            # conjuncts over only the grouping attributes filter whole groups, so they can filter the input instead.
+            # Conjuncts over no attributes at all stay above: an aggregation without grouping attributes outputs a
+            # tuple even for empty input.
+            left_schema = node.left_child.schema
+            sources = dict((name, left_schema[i]) for name, i in zip(node.grouping_attributes, node.group_indices))
+            below = []
+            for conjunct in conjuncts:
+                columns = conjunct.columns()
+                if columns and all(c in sources for c in columns):
+                    below.append(conjunct.map_columns(lambda c: sources[c]))
+                else:
+                    remaining.append(conjunct)
+            node.left_child = self._push_selection(below, node.left_child)
+
+        else:
+            remaining = conjuncts
+
+        node.bind()
+        return self._select(remaining, node)
+
+    def reorder_joins(self, node):
+        """
+        Reorders every chain of inner natural joins in a bound plan into the join order with the smallest estimated
+        total size of intermediate results, and picks the build side of each join.
+        If the chosen order changes the order of the output attributes or the name of the output, a projection restores
+        the original ones.
+        :param node: the root of the plan
+        :return: the root of the rewritten plan
+        """
+        if not self._is_inner_join(node):
+            for attribute in self._children(node):
+                setattr(node, attribute, self.reorder_joins(getattr(node, attribute)))
+            return node
+
+        inputs = []
+        written_order = self._flatten_joins(node, inputs)
+        inputs = [self.reorder_joins(child) for child in inputs]
+        estimates = [self._estimate(child) for child in inputs]
+
+        if len(inputs) <= MAX_EXHAUSTIVE_JOIN_INPUTS:
+            cost, order, estimate = self._exhaustive_join_order(estimates)
+        else:
+            cost, order, estimate = self._greedy_join_order(estimates)
+
+        # the order the joins were written in is kept unless another order is estimated to be cheaper
+        if cost >= self._join_order_cost(written_order, estimates)[0]:
+            order = written_order
+
+        joined = self._build_joins(order, inputs, estimates)[0]
+        joined.bind()
+        if joined.schema == node.schema and joined.name == node.name:
+            return joined
+        # the name is restored too, since a parent product qualifies the attributes of its inputs with their names
+        return self._projection(list(node.schema), joined, node.name)
+
+    @staticmethod
+    def _is_inner_join(node):
+        return isinstance(node, pn.NaturalJoinNode) and not node.is_left_outer and not node.is_right_outer
+
+    def _flatten_joins(self, node, inputs):
+        """
+        Collects the inputs of a chain of inner natural joins
+        :param node: the join at the root of the chain
+        :param inputs: list the inputs are appended to
+        :return: the shape of the chain: an input's index in the list, or a pair of shapes for a join
+        """
+        if not self._is_inner_join(node):
+            inputs.append(node)
+            return len(inputs) - 1
+        return self._flatten_joins(node.left_child, inputs), self._flatten_joins(node.right_child, inputs)
+
+    def _estimate(self, node):
+        """
+        Estimates the output of a bound node
+        :return: the estimated cardinality, and a dictionary of the estimated number of distinct values of each output
+            attribute
+        """
+        if isinstance(node, pn.Relation):
+            return node.estimated_cardinality(), dict((a, node.distinct_count(a)) for a in node.schema)
+
+        if isinstance(node, pn.SelectNode):
+            cardinality, distinct = self._estimate(node.left_child)
+            for conjunct in ex.split_conjuncts(node.predicate):
+                attribute = self._equality_attribute(conjunct, node.schema)
+                if attribute is not None:
+                    # an equality with a constant keeps one of the attribute's values
+                    cardinality /= float(max(distinct[attribute], 1))
+                    distinct[attribute] = 1
+                else:
+                    cardinality *= DEFAULT_SELECTIVITY
+            return cardinality, self._cap(distinct, cardinality)
+
+        if isinstance(node, pn.ProjectNode):
+            cardinality, distinct = self._estimate(node.left_child)
+            left_schema = node.left_child.schema
+            return cardinality, dict((name, distinct[left_schema[left_schema.position(projection.name)]]
+                                      if isinstance(projection, ex.Column) else cardinality)
+                                     for name, projection in zip(node.schema, node.projections))
+
+        if self._is_inner_join(node):
+            return self._join_estimate(self._estimate(node.left_child), self._estimate(node.right_child))
+
+        cardinality = node.estimated_cardinality()
+        return cardinality, dict((a, cardinality) for a in node.schema)
+
+    @staticmethod
+    def _equality_attribute(conjunct, schema):
+        """
+        :return: the attribute a conjunct compares for equality with a constant or parameter, or None
+        """
+        if not isinstance(conjunct, ex.Comparison) or conjunct.operators != ["=="]:
+            return None
+        kinds = [type(operand) for operand in conjunct.operands]
+        if (ex.Literal not in kinds and ex.Parameter not in kinds) or ex.Column not in kinds:
+            return None
+        column = conjunct.operands[kinds.index(ex.Column)]
+        return schema[schema.position(column.name)]
+
+    @staticmethod
+    def _cap(distinct, cardinality):
+        return dict((a, min(count, max(cardinality, 1))) for a, count in distinct.items())
+
+    def _join_estimate(self, left, right):
+        """
+        Estimates the output of a natural join from the estimates of its inputs, assuming the values of each common
+        attribute in the input with fewer distinct values all appear in the other input
+        """
+        (left_cardinality, left_distinct), (right_cardinality, right_distinct) = left, right
+        cardinality = float(left_cardinality) * right_cardinality
+        distinct = dict(left_distinct)
+        for attribute, count in right_distinct.items():
+            if attribute in distinct:
+                cardinality /= max(distinct[attribute], count, 1)
+                distinct[attribute] = min(distinct[attribute], count)
+            else:
+                distinct[attribute] = count
+        return cardinality, self._cap(distinct, cardinality)
+
+    def _join_order_cost(self, order, estimates):
+        """
+        :param order: the shape of a join tree, as returned by _flatten_joins
+        :return: the total estimated size of the tree's join results, and the estimate of its output
+        """
+        if not isinstance(order, tuple):
+            return 0, estimates[order]
+        left_cost, left = self._join_order_cost(order[0], estimates)
+        right_cost, right = self._join_order_cost(order[1], estimates)
+        estimate = self._join_estimate(left, right)
+        return left_cost + right_cost + estimate[0], estimate
+
+    def _exhaustive_join_order(self, estimates):
+        """
+        Finds the cheapest join tree over every subset of the inputs, smallest subsets first.
+        Joins without common attributes are cartesian products, so they are only considered for a subset which can't
+        be split into two parts sharing an attribute.
+        :return: the cost, shape and estimate of the cheapest tree joining every input
+        """
+        best = {}
+        for i, estimate in enumerate(estimates):
+            best[1 << i] = (0, i, estimate)
+
+        full = (1 << len(estimates)) - 1
+        for subset in range(1, full + 1):
+            if subset in best:
+                continue
+            candidates = []
+            # each split is enumerated once, with the lowest input always in the left part
+            lowest = subset & -subset
+            part = (subset - 1) & subset
+            while part:
+                if part & lowest:
+                    left, right = best[part], best[subset ^ part]
+                    estimate = self._join_estimate(left[2], right[2])
+                    connected = any(a in right[2][1] for a in left[2][1])
+                    candidates.append((not connected, left[0] + right[0] + estimate[0], (left[1], right[1]), estimate))
+                part = (part - 1) & subset
+            _, cost, order, estimate = min(candidates, key=lambda candidate: candidate[:2])
+            best[subset] = (cost, order, estimate)
+        return best[full]
+
+    def _greedy_join_order(self, estimates):
+        """
+        Repeatedly joins the pair of trees with the smallest estimated result, preferring pairs sharing an attribute
+        :return: the cost, shape and estimate of the tree joining every input
+        """
+        trees = [(0, i, estimate) for i, estimate in enumerate(estimates)]
+        while len(trees) > 1:
+            candidates = []
+            for i in range(len(trees)):
+                for j in range(i + 1, len(trees)):
+                    estimate = self._join_estimate(trees[i][2], trees[j][2])
+                    connected = any(a in trees[j][2][1] for a in trees[i][2][1])
+                    candidates.append((not connected, estimate[0], i, j, estimate))
+            _, cardinality, i, j, estimate = min(candidates, key=lambda candidate: candidate[:2])
+            joined = (trees[i][0] + trees[j][0] + cardinality, (trees[i][1], trees[j][1]), estimate)
+            trees = [tree for k, tree in enumerate(trees) if k not in (i, j)] + [joined]
+        return trees[0]
+
+    def _build_joins(self, order, inputs, estimates):
+        """
+        Builds the join nodes for a join tree shape, building each hash table on the input estimated to be smaller
+        :return: the root node of the tree, and its estimate
+        """
+        if not isinstance(order, tuple):
+            return inputs[order], estimates[order]
+        left, left_estimate = self._build_joins(order[0], inputs, estimates)
+        right, right_estimate = self._build_joins(order[1], inputs, estimates)
+        node = pn.NaturalJoinNode(left, right, False, False)
+        node.build_left = left_estimate[0] <= right_estimate[0]
+        return node, self._join_estimate(left_estimate, right_estimate)
+
+    def use_indexes(self, node):
+        """
+        Rewrites selections and joins over indexed relations to use the indexes.
+        A selection directly over an indexed relation becomes an index scan for one equality or range conjunct, with
+        any other conjuncts applied to the scanned tuples. A natural join with a hash index on the single join attribute
+        of a child relation becomes an index nested loop join; if both children are indexed, the larger one is.
+        :param node: the root of the bound plan
+        :return: the root of the rewritten plan
+        """
+        for attribute in self._children(node):
+            setattr(node, attribute, self.use_indexes(getattr(node, attribute)))
+
+        if isinstance(node, pn.SelectNode) and isinstance(node.left_child, pn.Relation):
+            return self._index_scan(node)
+
+        if isinstance(node, pn.NaturalJoinNode) and len(node.left_key_indices) == 1:
+            candidates = []
+            for child, key_index in ((node.left_child, node.left_key_indices[0]),
+                                     (node.right_child, node.right_key_indices[0])):
+                if isinstance(child, pn.Relation):
+                    candidates.extend((child.estimated_cardinality(), index) for index in self._indexes_on(child)
+                                      if index.kind == "hash" and index.attribute == child.schema[key_index])
+            if candidates:
+                node.build_index = max(candidates, key=lambda candidate: candidate[0])[1]
+        return node
+
+    def _indexes_on(self, relation):
+        return [index for indexes in self.indexes.values() for index in indexes if index.relation is relation]
+
+    def _index_scan(self, node):
+        """
+        Replaces a selection over an indexed relation with an index scan, if one of its conjuncts can use an index.
+        Equality conditions are preferred, on the attribute with the most distinct values; otherwise the range
+        conditions on one attribute with a sorted index are used.
+        """
+        relation = node.left_child
+        indexes = self._indexes_on(relation)
+        if not indexes:
+            return node
+
+        conjuncts = ex.split_conjuncts(node.predicate)
+        conditions = [self._index_conditions(conjunct, relation.schema) for conjunct in conjuncts]
+
+        # a scan for an equality condition
+        best = None
+        for i, condition in enumerate(conditions):
+            for attribute, operator, value in condition:
+                if operator != "==":
+                    continue
+                for index in indexes:
+                    if index.attribute == attribute and (best is None or index.distinct_count > best[1].distinct_count):
+                        best = i, index, value
+        if best is not None:
+            i, index, value = best
+            scan = pn.IndexScanNode(index, equal=value)
+            return self._select([c for j, c in enumerate(conjuncts) if j != i], self._bound(scan))
+
+        # a scan for the range conditions on the attribute with the most of them
+        sorted_indexes = dict((index.attribute, index) for index in indexes if index.kind == "sorted")
+        ranges = {}
+        for i, condition in enumerate(conditions):
+            for attribute, operator, value in condition:
+                if attribute in sorted_indexes:
+                    ranges.setdefault(attribute, []).append((i, operator, value))
+        if not ranges:
+            return node
+
+        attribute = max(ranges, key=lambda name: len(ranges[name]))
+        low = high = None
+        used = Counter()
+        for i, operator, value in ranges[attribute]:
+            if operator in (">", ">=") and low is None:
+                low = value, operator == ">="
+            elif operator in ("<", "<=") and high is None:
+                high = value, operator == "<="
+            else:
+                continue
+            used[i] += 1
+
+        # a conjunct is still checked after the scan unless the scan used all of its conditions
+        scan = pn.IndexScanNode(sorted_indexes[attribute], low=low, high=high)
+        return self._select([c for j, c in enumerate(conjuncts) if used[j] < len(conditions[j])], self._bound(scan))
+
+    @staticmethod
+    def _bound(node):
+        node.bind()
+        return node
+
+    @staticmethod
+    def _index_conditions(conjunct, schema):
+        """
+        Finds the conditions of a conjunct an index can answer: comparisons between an attribute and a constant or
+        parameter, like a > 5, 5 > a, or the chained 1 < a <= 5.
+        :return: a list of (attribute, operator, value Expression) triples, each with the attribute on the left, which
+            the conjunct is equivalent to the conjunction of; or an empty list if the conjunct can't use an index
+        """
+        if not isinstance(conjunct, ex.Comparison) or any(o not in SWAPPED_OPERATORS for o in conjunct.operators):
+            return []
+        operands = conjunct.operands
+        is_constant = [isinstance(operand, (ex.Literal, ex.Parameter)) for operand in operands]
+        is_column = [isinstance(operand, ex.Column) for operand in operands]
+
+        if len(operands) == 2 and is_column[0] and is_constant[1]:
+            return [(schema[schema.position(operands[0].name)], conjunct.operators[0], operands[1])]
+        if len(operands) == 2 and is_constant[0] and is_column[1]:
+            return [(schema[schema.position(operands[1].name)], SWAPPED_OPERATORS[conjunct.operators[0]],
+                     operands[0])]
+        if len(operands) == 3 and is_constant[0] and is_column[1] and is_constant[2] and "==" not in conjunct.operators:
+            attribute = schema[schema.position(operands[1].name)]
+            return [(attribute, SWAPPED_OPERATORS[conjunct.operators[0]], operands[0]),
+                    (attribute, conjunct.operators[1], operands[2])]
+        return []
+
+    def prune_columns(self, node, required):
+        """
+        Drops attributes which aren't needed above a node, inserting projections below joins, cartesian products and
+        aggregations so the attributes are never carried through them
+        :param node: the bound node to prune
+        :param required: set of strings: the output attributes needed above the node, or None if all of them are
+        :return: the rewritten node, bound, with at least the required attributes in its output
+        """
+        if isinstance(node, pn.ProjectNode):
+            if required is not None and len(required) < len(node.schema):
+                keep = [i for i, name in enumerate(node.schema) if name in required]
+                node.schema = pn.Schema([node.schema[i] for i in keep])
+                node.projections = [node.projections[i] for i in keep]
+                node.args_lists = [node.args_lists[i] for i in keep]
+            left_schema = node.left_child.schema
+            child_required = set(left_schema[left_schema.position(c)]
+                                 for projection in node.projections for c in projection.columns())
+            node.left_child = self.prune_columns(node.left_child, child_required)
+
+        elif isinstance(node, pn.SelectNode):
+            child_required = None
+            if required is not None:
+                child_required = set(required) | set(node.schema[node.schema.position(c)]
+                                                     for c in node.predicate.columns())
+            node.left_child = self.prune_columns(node.left_child, child_required)
+
+        elif isinstance(node, pn.SortNode):
+            child_required = None
+            if required is not None:
+                child_required = set(required) | set(attribute for attribute, descending in node.sorted_on)
+            node.left_child = self.prune_columns(node.left_child, child_required)
+
+        elif isinstance(node, pn.SpoolNode):
+            # every consumer of a spool reads the same tuples, so the spooled subplan keeps all its attributes
+            node.left_child = self.prune_columns(node.left_child, None)
+
+        elif isinstance(node, pn.NaturalJoinNode):
+            # the common attributes are always kept on both sides, since they are what the join matches on
+            left_schema, right_schema = node.left_child.schema, node.right_child.schema
+            common = set(a for a in left_schema if a in right_schema)
+            left_required = set(a for a in left_schema if required is None or a in required) | common
+            right_required = set(a for a in right_schema if required is None or a in required) | common
+            # an indexed relation is read through its index, so it can't be replaced with a projection of it
+            if node.build_index is None or node.build_index.relation is not node.left_child:
+                node.left_child = self._narrow(node.left_child, left_required)
+            if node.build_index is None or node.build_index.relation is not node.right_child:
+                node.right_child = self._narrow(node.right_child, right_required)
+
+        elif isinstance(node, (pn.CartesianProductNode, pn.ThetaJoinNode)):
+            left_schema, right_schema = node.left_child.schema, node.right_child.schema
+            split = len(left_schema)
+            if required is not None and isinstance(node, pn.ThetaJoinNode):
+                required = set(required) | set(node.schema[node.schema.position(c)] for c in node.predicate.columns())
+            needed = [i for i, name in enumerate(node.schema) if required is None or name in required]
+            node.left_child = self._narrow(node.left_child, set(left_schema[i] for i in needed if i < split))
+            node.right_child = self._narrow(node.right_child, set(right_schema[i - split] for i in needed if i >= split))
+
+        elif isinstance(node, (pn.SetOperationNode, pn.DivisionNode)):
+            # set operations and divisions compare whole tuples, so nothing below them can be dropped
+            node.left_child = self.prune_columns(node.left_child, None)
+            node.right_child = self.prune_columns(node.right_child, None)
+
+        elif isinstance(node, pn.AggregationNode):
+            left_schema = node.left_child.schema
+            node.left_child = self._narrow(node.left_child,
+                                           set(left_schema[i] for i in node.group_indices + node.value_indices))
+
+        node.bind()
+        return node
+
+    def use_sort_orders(self, node):
+        """
+        Uses the orders the nodes of a bound plan output their tuples in. Sorts of inputs which are already in the
+        requested order are dropped, natural joins of inputs sorted in ascending order on the join attributes become
+        merge joins, and aggregations of inputs sorted on the grouping attributes aggregate one group at a time.
+        :param node: the root of the bound plan
+        :return: the root of the rewritten plan
+        """
+        for attribute in self._children(node):
+            setattr(node, attribute, self.use_sort_orders(getattr(node, attribute)))
+        node.bind()
+
+        if isinstance(node, pn.SortNode):
+            if self._is_sorted_on(node.left_child, node.sorted_on):
+                return node.left_child
+
+        elif isinstance(node, pn.NaturalJoinNode) and node.build_index is None and node.left_key_indices:
+            left_schema, right_schema = node.left_child.schema, node.right_child.schema
+            left_keys = [(left_schema[i], False) for i in node.left_key_indices]
+            right_keys = [(right_schema[i], False) for i in node.right_key_indices]
+            if self._is_sorted_on(node.left_child, left_keys) and self._is_sorted_on(node.right_child, right_keys):
+                node.merge = True
+                node.bind()
+
+        elif isinstance(node, pn.AggregationNode) and node.grouping_attributes and not node.input_sorted:
+            left_schema = node.left_child.schema
+            prefix = node.left_child.sorted_on[:len(set(node.group_indices))]
+            if set(attribute for attribute, descending in prefix) == set(left_schema[i] for i in node.group_indices):
+                node.input_sorted = True
+                node.bind()
+        return node
+
+    @staticmethod
+    def _is_sorted_on(node, order):
+        """
+        :param order: List of (attribute, descending) pairs
+        :return: True if the output of a bound node is sorted on the order, or on an order it is a prefix of
+        """
+        return list(node.sorted_on[:len(order)]) == list(order)
+
+    def _narrow(self, child, required):
+        """
+        Prunes a child, then projects it down to just the required attributes if it still has others
+        """
+        child = self.prune_columns(child, required)
+        if len(required) >= len(child.schema):
+            return child
+
+        return self._projection([name for name in child.schema if name in required], child)
+
+    @staticmethod
+    def _projection(names, child, name=None):
+        """
+        Builds a bound projection of a child onto a list of its attributes, named after the child unless a name is given
+        """
+        node = pn.ProjectNode(names, child, [ex.Column(attribute) for attribute in names],
+                              [[attribute] for attribute in names], name)
+        node.bind()
+        return node
@@ -0,0 +1,336 @@
+import copy
+import marshal
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import operator
+import Queue
+import time
+
+import PlanNode as pn
+
+
+# the minimum number of input tuples for a join or aggregation to be split across processes; smaller inputs are
+# cheaper to process than to send to the workers
+DEFAULT_MIN_PARALLEL_ROWS = 10000
+
+
+def _join_rows(spec, left_tuples, right_tuples):
+    """
+    Joins one partition of the inputs of a natural join
+    :param spec: (left schema, right schema, is_left_outer, is_right_outer) tuple describing the join
+    :return: array of the output rows
+    """
+    left_schema, right_schema, is_left_outer, is_right_outer = spec
+    node = pn.NaturalJoinNode(pn.Relation(left_schema, left_tuples, "left"),
+                              pn.Relation(right_schema, right_tuples, "right"), is_left_outer, is_right_outer)
+    node.bind()
+    return list(node.rows())
+
+
+def _aggregate_rows(spec, tuples):
+    """
+    Aggregates one partition of the input of a grouped aggregation
+    :param spec: (input schema, grouping attributes, (function, attribute, result name) triples, input_sorted) tuple
+        describing the aggregation
+    :return: array of the output rows
+    """
+    schema, grouping_attributes, aggregations, input_sorted = spec
+    node = pn.AggregationNode(pn.Relation(schema, tuples, "input"), grouping_attributes,
+                              [pn.Aggregation(*aggregation) for aggregation in aggregations], input_sorted)
+    node.bind()
+    return list(node.rows())
+
+
+def _run_join_partition(task):
+    spec, left_data, right_data = task
+    return marshal.dumps(_join_rows(spec, marshal.loads(left_data), marshal.loads(right_data)))
+
+
+def _run_aggregation_partition(task):
+    spec, data = task
+    return marshal.dumps(_aggregate_rows(spec, marshal.loads(data)))
+
+
+class ParallelEngine:
+    """
+    This object executes bound plans with their natural joins and grouped aggregations split across a pool of worker
+    processes, so they use several CPU cores despite the GIL.
+    The inputs of a join are hash partitioned on the join attributes, and the input of an aggregation on the grouping
+    attributes, so every partition can be joined or aggregated independently by the row engine in a worker, and the
+    outputs of the partitions are simply concatenated. Tuples travel to and from the workers serialized with marshal,
+    which is much cheaper than pickling them.
+    Every other node, and joins and aggregations with small inputs, is executed by the row engine in this process.
+    Index joins, joins without common attributes, aggregations without grouping attributes and nodes producing sorted
+    output aren't partitioned.
+    """
+
+    def __init__(self, processes=None, min_parallel_rows=DEFAULT_MIN_PARALLEL_ROWS):
+        """
+        Class constructor.
+        :param processes: int, the number of worker processes, and of partitions; None uses one per CPU core
+        :param min_parallel_rows: int, the minimum number of input tuples for a join or aggregation to be partitioned
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.min_parallel_rows = min_parallel_rows
+        self.pool = None
+
+    def close(self):
+        """
+        Shuts the worker processes down; they are started again if the engine is used afterwards
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def execute(self, node):
+        """
+        Runs a plan to completion with this engine
+        :param node: Plan Node or Relation: the root of the plan
+        :return: Relation: the output of the plan
+        """
+        node.ensure_bound()
+        node = self._rewrite(node, {})
+        return pn.Relation(node.schema, list(node.rows()), node.name)
+
+    def _rewrite(self, node, rewritten):
+        """
+        Runs the partitioned joins and aggregations of a plan, replacing each with a relation holding its output.
+        The plan itself is left untouched: the nodes above them are copied, and the copies are bound to the outputs.
+        :param rewritten: dictionary of node ids to the node they were rewritten into, so that nodes shared by
+            several parents, such as spools, stay shared
+        :return: the rewritten node
+        """
+        if id(node) in rewritten:
+            return rewritten[id(node)]
+
+        # partitioning loses the order of the output, so nodes whose order the plan relies on aren't partitioned
+        if isinstance(node, pn.NaturalJoinNode) and node.build_index is None and node.left_key_indices and \
+                not node.sorted_on:
+            result = self._join(node, self._rewrite(node.left_child, rewritten),
+                                self._rewrite(node.right_child, rewritten))
+        elif isinstance(node, pn.AggregationNode) and node.group_indices and not node.sorted_on:
+            result = self._aggregate(node, self._rewrite(node.left_child, rewritten))
+        elif isinstance(node, pn.PlanNode) and not isinstance(node, pn.IndexScanNode):
+            # an index scan reads its relation through the index, so it is never rewritten
+            result = copy.copy(node)
+            for attribute in ("left_child", "right_child"):
+                if hasattr(node, attribute):
+                    setattr(result, attribute, self._rewrite(getattr(node, attribute), rewritten))
+            result.bind()
+        else:
+            result = node
+
+        rewritten[id(node)] = result
+        return result
+
+    def _join(self, node, left_child, right_child):
+        left_tuples, right_tuples = list(left_child.rows()), list(right_child.rows())
+        spec = (list(left_child.schema), list(right_child.schema), node.is_left_outer, node.is_right_outer)
+
+        if len(left_tuples) + len(right_tuples) < self.min_parallel_rows:
+            tuples = _join_rows(spec, left_tuples, right_tuples)
+        else:
+            left_partitions = self._partition(left_tuples, node.left_key_indices)
+            right_partitions = self._partition(right_tuples, node.right_key_indices)
+            tasks = [(spec, marshal.dumps(left), marshal.dumps(right))
+                     for left, right in zip(left_partitions, right_partitions) if left or right]
+            tuples = self._run(_run_join_partition, tasks)
+        return pn.Relation(node.schema, tuples, node.name)
+
+    def _aggregate(self, node, left_child):
+        tuples = list(left_child.rows())
+        spec = (list(left_child.schema), node.grouping_attributes,
+                [(aggregation.function_name, aggregation.attribute, aggregation.result_name)
+                 for aggregation in node.aggregations], node.input_sorted)
+
+        if len(tuples) < self.min_parallel_rows:
+            tuples = _aggregate_rows(spec, tuples)
+        else:
+            tasks = [(spec, marshal.dumps(partition))
+                     for partition in self._partition(tuples, node.group_indices) if partition]
+            tuples = self._run(_run_aggregation_partition, tasks)
+        return pn.Relation(node.schema, tuples, node.name)
+
+    def _partition(self, tuples, key_indices):
+        """
+        Hash partitions tuples on the values of some of their attributes, keeping the order of the tuples within each
+        partition
+        :return: array of arrays of tuples, one per worker process
+        """
+        key = operator.itemgetter(*key_indices)
+        partitions = [[] for _ in range(self.processes)]
+        appends = [partition.append for partition in partitions]
+        count = self.processes
+        for tup in tuples:
+            appends[hash(key(tup)) % count](tup)
+        return partitions
+
+    def _run(self, function, tasks):
+        """
+        Runs a task per partition in the worker processes
+        :return: array of the output rows of every partition
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        tuples = []
+        for data in self.pool.imap_unordered(function, tasks):
+            tuples.extend(marshal.loads(data))
+        return tuples
+
+
+class ConcurrentEngine:
+    """
+    This object executes bound plans with the independent subtrees of their binary nodes evaluated concurrently by a
+    pool of worker threads.
+    The two inputs of a binary node are independent unless they share a spool. Each independent input which isn't a
+    relation is evaluated into a relation by a worker as soon as every independent input nested inside it has been,
+    and the rest of the plan then runs over these relations. Since threads share the GIL, this only speeds up subtrees
+    which wait on something other than the interpreter; the ParallelEngine spreads CPU bound joins and aggregations
+    across processes instead.
+    Assignments run as soon as they are parsed, one after the other in the order they are written, so every query reads
+    the relations assigned by the statements before it; only the subtrees of a single query are ever run concurrently.
+    After each execution, timings holds a (description, seconds) pair with the wall time of each subtree evaluated by
+    a worker, in the order they finished, followed by that of the rest of the plan.
+    """
+
+    def __init__(self, parallelism=None):
+        """
+        Class constructor.
+        :param parallelism: int, the number of worker threads, the most subtrees evaluated at once; None uses one per
+            CPU core
+        """
+        self.parallelism = parallelism or multiprocessing.cpu_count()
+        self.pool = None
+        self.timings = []
+
+    def close(self):
+        """
+        Shuts the worker threads down; they are started again if the engine is used afterwards
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def execute(self, node):
+        """
+        Runs a plan to completion with this engine
+        :param node: Plan Node or Relation: the root of the plan
+        :return: Relation: the output of the plan
+        """
+        node.ensure_bound()
+        self.timings = []
+        subtrees = []
+        self._find_subtrees(node, subtrees, {})
+        results = self._run_subtrees(subtrees)
+
+        start = time.time()
+        result = self._evaluate(node, results)
+        self.timings.append((self.describe(node), time.time() - start))
+        return result
+
+    @staticmethod
+    def describe(node):
+        return "%s %s" % (node.__class__.__name__, node.name)
+
+    def _find_subtrees(self, node, subtrees, spools):
+        """
+        Finds the independent inputs of the binary nodes of a plan, listing nested inputs before those containing them
+        :param subtrees: array the independent inputs are added to
+        :param spools: dictionary of node ids to the set of ids of the spools in the subtree of the node
+        :return: the set of ids of the spools in the subtree of the node
+        """
+        if id(node) in spools:
+            return spools[id(node)]
+
+        children = [getattr(node, attribute) for attribute in ("left_child", "right_child") if hasattr(node, attribute)]
+        child_spools = [self._find_subtrees(child, subtrees, spools) for child in children]
+        if len(children) == 2 and not child_spools[0] & child_spools[1]:
+            subtrees.extend(child for child in children
+                            if isinstance(child, pn.PlanNode) and all(child is not other for other in subtrees))
+
+        node_spools = set().union(*child_spools)
+        if isinstance(node, pn.SpoolNode):
+            node_spools.add(id(node))
+        spools[id(node)] = node_spools
+        return node_spools
+
+    def _dependencies(self, node, subtree_ids):
+        """
+        :return: the set of ids of the independent inputs nested in the subtree of a node, not counting the inputs
+            nested within those
+        """
+        dependencies = set()
+        for attribute in ("left_child", "right_child"):
+            child = getattr(node, attribute, None)
+            if child is None:
+                continue
+            if id(child) in subtree_ids:
+                dependencies.add(id(child))
+            else:
+                dependencies |= self._dependencies(child, subtree_ids)
+        return dependencies
+
+    def _run_subtrees(self, subtrees):
+        """
+        Evaluates independent inputs on the worker threads, each once the inputs nested inside it have been
+        :return: dictionary of the ids of the inputs to the relations holding their outputs
+        """
+        results = {}
+        if not subtrees:
+            return results
+        if self.pool is None:
+            self.pool = ThreadPool(self.parallelism)
+
+        subtree_ids = dict((id(subtree), subtree) for subtree in subtrees)
+        waiting = dict((id(subtree), self._dependencies(subtree, subtree_ids)) for subtree in subtrees)
+        finished = Queue.Queue()
+        running = 0
+        while waiting or running:
+            for subtree_id, dependencies in waiting.items():
+                if dependencies.issubset(results):
+                    del waiting[subtree_id]
+                    self.pool.apply_async(self._run_subtree, (subtree_ids[subtree_id], dict(results)),
+                                          callback=finished.put)
+                    running += 1
+
+            subtree, result, seconds, error = finished.get()
+            running -= 1
+            if error is not None:
+                raise error
+            results[id(subtree)] = result
+            self.timings.append((self.describe(subtree), seconds))
+        return results
+
+    def _run_subtree(self, subtree, results):
+        # errors, including the SystemExit raised for binding errors, are handed back to the scheduling thread
+        start = time.time()
+        try:
+            return subtree, self._evaluate(subtree, results), time.time() - start, None
+        except BaseException as error:
+            return subtree, None, time.time() - start, error
+
+    def _evaluate(self, node, results):
+        """
+        Runs a copy of a subtree in which the independent inputs evaluated so far are replaced by their outputs
+        :return: Relation: the output of the subtree
+        """
+        node = self._substitute(node, results, {})
+        return pn.Relation(node.schema, list(node.rows()), node.name)
+
+    def _substitute(self, node, results, copies):
+        if id(node) in results:
+            return results[id(node)]
+        if id(node) in copies:
+            return copies[id(node)]
+        if not isinstance(node, pn.PlanNode) or isinstance(node, pn.IndexScanNode):
+            return node
+
+        result = copy.copy(node)
+        for attribute in ("left_child", "right_child"):
+            if hasattr(node, attribute):
+                setattr(result, attribute, self._substitute(getattr(node, attribute), results, copies))
+        result.bind()
+        copies[id(node)] = result
+        return result
@@ -1,348 +1,448 @@
+from collections import OrderedDict
+import Expression as ex
+import Loader as ld
+import Optimizer as op
 import PlanNode as pn
-import re
 import sys
 
 
-class Indices:
-    """This object stores a set of indices.
-        Usually used for tracking the location of a substring within a larger string."""
+# the number of prepared statements a parser keeps cached by their query text
+PLAN_CACHE_SIZE = 128
 
-    def __init__(self, start_index, end_index):
+
+class PreparedStatement:
+    """
+    This object holds a query which has been parsed, bound and optimized once, to be executed many times with
+    different parameter values. A statement runs one execution at a time, since its parameter values are shared by
+    every compiled expression in its plan.
+    """
+
+    def __init__(self, plan, parameters, sources):
         """
         Class constructor.
-        :param start_index: the starting index
-        :param end_index: the ending index
+        :param plan: The bound, optimized execution plan for the query
+        :param parameters: ParameterValues (defined in Expression.py): where the plan reads its parameter values from
+        :param sources: A list of (name, relation) pairs: each catalog entry the plan reads
+        """
+        self.plan = plan
+        self.parameters = parameters
+        self.sources = sources
+
+    def execute(self, **values):
+        """
+        Runs the plan with a value for each of its parameters
+        :param values: the value of each parameter, by name, e.g. min_salary=10000
+        :return: Relation: the output of the query
         """
+        missing = self.parameters.names.difference(values)
+        if missing:
+            sys.exit("no value given for parameters %s" % ", ".join(":" + name for name in sorted(missing)))
 
-        self.start_index = start_index
-        self.end_index = end_index
+        self.parameters.clear()
+        self.parameters.update(values)
+        return self.plan.execute()
 
 
 class Parser:
     """This object is used for parsing relational algebra input strings.
         It stores a dictionary of relations and uses these relations to parse an input into an execution plan."""
 
-    def __init__(self, relations):
+    def __init__(self, relations, engine=None, optimize=True, result_cache=None):
         """
         Class constructor.
         :param relations: A dictionary of relation names to relation objects (defined in PlanNode.py)
+        :param engine: The engine used to execute parsed plans, e.g. a VectorEngine (defined in Vectorized.py), a
+            ParallelEngine (defined in Parallel.py) or a SpillEngine (defined in Spill.py). None executes plans with
+            the row engine.
+        :param optimize: Boolean: True if parsed plans are rewritten by the optimizer (defined in Optimizer.py)
+        :param result_cache: The ResultCache (defined in ResultCache.py) used to cache the outputs of parsed plans,
+            which should be built over the same relations dictionary. None disables result caching.
         """
 
         self.relations = relations
+        self.engine = engine
+        # the indexes built on the relations, by relation name
+        self.indexes = {}
 
-    @staticmethod
-    def tokenize_string(input_string):
-        """
-        This method takes an input string and generates an array of all the variable names in the array.
-         A variable name must start with a letter and can contain only letters, numbers, periods, and underscores.
-        The keywords 'and' and 'or' are filtered from the results as these are reserved for evaluation.
-        A variable cannot be named 'and' or 'or'
+        self.optimizer = op.Optimizer(relations, self.indexes) if optimize else None
+        self.result_cache = result_cache
 
-        :param input_string: This string to be tokenized
-        :return: An array of the variable tokens
-        """
+        # prepared statements by query text, least recently used first
+        self.plan_cache = OrderedDict()
 
-        keywords = ["and", "or"]
+        # the query being parsed: its text, its tokens and the index of the next token to parse
+        self.input_string = None
+        self.tokens = None
+        self.index = 0
 
-        # get rid of everything within quotes inside the string
-        input_string = re.sub("\'[^\']*\'", "", input_string)
-        results = re.findall("[A-Za-z][A-Za-z1-9_\.]*", input_string)
-        return [token for token in results if token not in keywords]
+        # where the parameters of the query being parsed read their values from
+        self.parameters = None
 
-    @staticmethod
-    def extract_token(open_char, close_char, input_string):
+    def create_index(self, relation_name, attribute, kind="hash"):
         """
-        This method extracts a substring enclosed by the specified brackets from the input string.
-
-        :param open_char: The open bracket character to extract with
-        :param close_char: The closed bracket character to extract with
-        :param input_string: The input string to extract from
-        :return: The extracted string
+        Builds an index on an attribute of a relation in the catalog, for the optimizer to use in later queries.
+        The index is rebuilt whenever the relation is reassigned.
+        :param relation_name: The name of the relation
+        :param attribute: The attribute to index
+        :param kind: 'hash' for an index answering equality conditions, or 'sorted' for one also answering ranges
+        :return: The index
         """
+        if relation_name not in self.relations:
+            sys.exit("invalid relation: %s" % relation_name)
+        if kind not in pn.index_kinds:
+            sys.exit("invalid index kind: %s" % kind)
 
-        # handle the weird case of a null input string
-        if len(input_string) == 0:
-            sys.exit("expecting %s character but could not find in string" % open_char)
-
-
-        ret_token = Indices(0, 0)
-        index = 0
-
-        # find first occurrence of open char in input string
-        while input_string[index] != open_char:
-            index += 1
+        self.drop_index(relation_name, attribute, kind)
+        index = pn.index_kinds[kind](self.relations[relation_name], attribute)
+        self.indexes.setdefault(relation_name, []).append(index)
+        return index
 
-            # make sure we don't go out of bounds
-            if index >= len(input_string):
-                sys.exit("expecting %s character but could not find in string" % open_char)
-
-        ret_token.start_index = index + 1
-        count = 1
-
-        # use count to perform bracket matching; continue until open bracket closed successfully
-        while count > 0:
-            index += 1
-
-            # make sure we don't go out of bounds
-            if index >= len(input_string):
-                sys.exit("expecting %s character but could not find in string" % close_char)
-
-            # increment/decrement based on the brackets hit
-            if input_string[index] == open_char:
-                count += 1
-            elif input_string[index] == close_char:
-                count -= 1
-
-        ret_token.end_index = index
-        return ret_token
-
-
-    @staticmethod
-    def strip_parentheses(input_string):
+    def drop_index(self, relation_name, attribute, kind="hash"):
         """
-        This method strips all enclosing parentheses from an input string: (((hello))) -> hello
-        :param input_string: The string to be stripped
-        :return: The stripped string
+        Removes an index from the catalog
         """
+        # prepared statements are planned again, with or without the index
+        self.plan_cache.clear()
+        schema = self.relations[relation_name].schema
+        attribute = schema[schema.position(attribute)]
+        self.indexes[relation_name] = [index for index in self.indexes.get(relation_name, [])
+                                       if index.kind != kind or index.attribute != attribute]
+
+    def rebuild_indexes(self, relation_name):
+        """
+        Rebuilds the indexes of a relation after it has been replaced. Indexes on attributes the new relation doesn't
+        have are dropped.
+        """
+        # prepared statements hold the old indexes, so they're planned again
+        self.plan_cache.clear()
+        relation = self.relations[relation_name]
+        self.indexes[relation_name] = [pn.index_kinds[index.kind](relation, index.attribute)
+                                       for index in self.indexes.get(relation_name, [])
+                                       if index.attribute in relation.schema]
+
+    def load_file(self, relation_name, path, **options):
+        """
+        Loads a CSV or TSV file into the catalog as a relation, replacing any relation of the same name
+        :param relation_name: The name of the relation
+        :param path: The path of the file, whose first line holds the attribute names
+        :param options: the options of load_delimited (defined in Loader.py), e.g. processes=4
+        :return: A LoadReport (defined in Loader.py) giving the throughput of the load
+        """
+        relation, report = ld.load_delimited(path, relation_name, **options)
+        if self.result_cache is not None:
+            self.result_cache.invalidate(relation_name)
+        self.relations[relation_name] = relation
+        self.rebuild_indexes(relation_name)
+        return report
+
+    def _peek(self, offset=0):
+        return self.tokens[self.index + offset]
+
+    def _next(self):
+        token = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def _error(self, message, token=None):
+        """
+        Reports a syntax error at a token, the next token by default
+        """
+        token = token if token is not None else self._peek()
+        raise ex.ParseError(message, token.position, self.input_string)
+
+    def _accept(self, value):
+        token = self._peek()
+        if token.kind in ("operator", "name") and token.value == value:
+            self.index += 1
+            return True
+        return False
+
+    def _expect(self, value, message=None):
+        if not self._accept(value):
+            self._error(message or "expecting %s" % value)
+
+    def _expect_name(self, description):
+        token = self._next()
+        if token.kind != "name":
+            self._error("expecting %s" % description, token)
+        return token.value
+
+    def parse_plan(self, input_string):
+        """
+        This method parses a query string into an execution plan, without binding the result.
+        The query is split into tokens once, and the tokens are parsed by recursive descent in a single pass.
+        :param input_string: The query string to be parsed.
+        :return: An unbound execution plan for the query.
+        """
+        self.input_string = input_string
+        self.tokens = ex.tokenize(input_string)
+        self.index = 0
 
-        working_string = input_string
-        while True:
-            # null string case (this should never come up...)
-            if len(working_string) == 0:
-                return working_string
-
-            # first ensure the first and last chars are parentheses
-            if working_string[0] != '(' or working_string[-1] != ')':
-                return working_string
-
-            # then ensure the first paren matches the last paren
-            indices = Parser.extract_token('(', ')', working_string)
-            if indices.end_index != len(working_string) - 1:
-                return working_string
-
-            # if we get this far, strip the parens from the string
-            working_string = working_string[1:-1]
-
-
+        plan = self.parse_query()
+        if self._peek().kind != "end":
+            self._error("unexpected %s" % self._peek().value)
+        return plan
 
-    @staticmethod
-    def parse_attribute_name(input_string):
+    def parse_query(self):
         """
-        This method determines what the attribute name for the input string should be.
-        If the string contains the 'AS' keyword, the attribute name is everything following the keyword.
-        Otherwise the attribute name is simply the entire string.
-
-        :param input_string: The string to be parsed
-        :return: The attribute name for the input string
+        Parses a query: an operand, optionally followed by an infix operator and another query.
+        Infix operators are right associative and share a single precedence, except for assignment (<--), which has the
+        lowest precedence so everything to its right is assigned.
+        :return: The execution plan for the query.
         """
-        input_string = input_string.strip()
-        if " AS " in input_string:
-            return input_string[input_string.find(" AS ") + len(" AS "):]
-        else:
-            return input_string
-
-    @staticmethod
-    def generate_aggregation_object(input_string):
+        if self._peek().kind == "name" and self._peek(1).value == "<--":
+            return self.parse_assignment()
+
+        left = self.parse_operand()
+        token = self._peek()
+        if token.kind == "name" and token.value in self.infix_parsers:
+            self._next()
+            return self.infix_parsers[token.value](self, left)
+        if token.kind == "operator" and token.value == "<--":
+            self._error("can only assign to a relation name", token)
+        return left
+
+    def parse_operand(self):
         """
-        This method takes a string of the form 'sum(a) AS b' and parses it into an aggregation object.
-        :param input_string: The string to be parsed
-        :return: The generated aggregation object
+        Parses an operand of an infix operator: a relation name, a prefix operator query or a parenthesized query.
+        :return: The execution plan for the operand.
         """
-        input_string = input_string.strip()
-        valid_agg_functions = ['sum', 'max', 'min', 'avg', 'count']
-
-        # make sure we have a valid aggregate function
-        agg_function = input_string[:input_string.find('(')].lower()
-        if agg_function not in valid_agg_functions:
-            sys.exit("invalid aggregate function specified")
+        token = self._next()
+        if token.kind == "operator" and token.value == "(":
+            plan = self.parse_query()
+            self._expect(")")
+            return plan
+
+        if token.kind == "name":
+            if token.value in self.prefix_parsers:
+                return self.prefix_parsers[token.value](self)
+            if token.value in self.relations:
+                return self.relations[token.value]
+            self._error("invalid relation %s" % token.value, token)
+
+        self._error("expecting a relation or query", token)
+
+    def parse_input(self):
+        """
+        Parses the parenthesized input query of a prefix operator
+        """
+        self._expect("(", "expecting ( before the input relation")
+        plan = self.parse_query()
+        self._expect(")")
+        return plan
 
-        # grab the aggregation attribute from inside the parentheses
-        agg_attribute_indices = Parser.extract_token('(', ')', input_string)
-        agg_attribute = input_string[agg_attribute_indices.start_index:agg_attribute_indices.end_index]
+    def parse_bracketed_expression(self, projection_list=False):
+        """
+        Parses the square bracketed expression of a select, or projection list of a project, straight from the tokens
+        of the query.
+        :param projection_list: Boolean: True to parse a projection list
+        :return: An Expression, or a list of (Expression, output attribute name) pairs for a projection list
+        """
+        self._expect("[")
+        parser = ex.ExpressionParser(self.input_string, self.parameters, self.tokens, self.index)
+        result = parser.parse_projection_list() if projection_list else parser.parse()
+        self.index = parser.index
+        self._expect("]")
+        return result
+
+    def parse_aggregation_function(self):
+        """
+        Parses an aggregate function of the form 'sum(a) AS b' into an aggregation object.
+        :return: The Aggregation object
+        """
+        token = self._peek()
+        agg_function = self._expect_name("aggregate function").lower()
+        if agg_function not in pn.Aggregation.function_mappings:
+            self._error("invalid aggregate function %s" % token.value, token)
 
-        # make sure a result name was specified
-        if " AS " not in input_string:
-            sys.exit("aggregation result must be renamed")
-        result_name = input_string[input_string.find(" AS ") + len(" AS "):].strip()
+        self._expect("(")
+        agg_attribute = self._expect_name("attribute to aggregate")
+        self._expect(")")
 
+        self._expect("AS", "aggregation result must be renamed")
+        result_name = self._expect_name("aggregation result name")
         return pn.Aggregation(agg_function, agg_attribute, result_name)
 
-    def parse_select(self, input_string):
+    def parse_select(self):
         """
-        This method parses a select query into a plan node.
-
-        :param input_string: The query string. Assumed to be a select query.
-
+        This method parses the rest of a select query, SELECT [predicate] (relation), into a plan node.
         :return: A SelectNode containing the parsed query
         """
+        predicate = self.parse_bracketed_expression()
+        relation_object = self.parse_input()
+        return pn.SelectNode(predicate, predicate.columns(), relation_object)
 
-        # parse the predicate first, chucking it and all previous text from the working string
-        pred_token = self.extract_token('[', ']', input_string)
-        pred_str = input_string[pred_token.start_index:pred_token.end_index]
-        working_string = input_string[pred_token.end_index:]
-
-        # next parse the relation from the working string
-        relation_token = self.extract_token('(', ')', working_string)
-        relation_str = working_string[relation_token.start_index:relation_token.end_index]
-        relation_object = self.parse(relation_str)
-
-        # use the predicate and relation to construct a select node
-        return pn.SelectNode(pred_str, self.tokenize_string(pred_str), relation_object)
-
-    def parse_project(self, input_string):
+    def parse_project(self):
         """
-        This method parses a project query into a plan node.
-        :param input_string: The query string. Assumed to be a project query.
+        This method parses the rest of a project query, PROJECT [projections] (relation), into a plan node.
         :return: A ProjectNode containing the parsed query.
         """
+        # each output attribute is named by its AS clause or its text
+        projections = self.parse_bracketed_expression(projection_list=True)
+        schema = [name for expression, name in projections]
+        expressions = [expression for expression, name in projections]
+        relation_object = self.parse_input()
 
-        # grab the projection arguments from inside the square brackets
-        projection_token = self.extract_token('[', ']', input_string)
-        projection_str = input_string[projection_token.start_index:projection_token.end_index]
-
-        # grab the input relation from inside the parentheses
-        relation_token = self.extract_token('(', ')', input_string[projection_token.end_index:])
-        relation_str = (input_string[projection_token.end_index:])[relation_token.start_index:relation_token.end_index]
-        relation_object = self.parse(relation_str)
-
-        # tokenize the projection arguments into an array and use this to generate the schema
-        projection_attributes = projection_str.split(',')
-        schema = [self.parse_attribute_name(attr) for attr in projection_attributes]
-
-        # once the schema has been generated, strip the 'AS' clause from each argument
-        for i in range(len(projection_attributes)):
-            if ' AS ' in projection_attributes[i]:
-                projection_attributes[i] = projection_attributes[i][:projection_attributes[i].find(' AS ')]
+        return pn.ProjectNode(schema, relation_object, expressions, [expression.columns() for expression in expressions])
 
-        # generate a list of arguments for each projection in the array
-        projection_args = [self.tokenize_string(attribute) for attribute in projection_attributes]
-
-        return pn.ProjectNode(schema, relation_object, projection_attributes, projection_args)
-
-    def parse_aggregation(self, input_string):
+    def aggregation_helper(self, grouping_attributes):
         """
-        This method parses an aggregate query.
-        :param input_string: The input query. Assumed to be an aggregate query.
+        This helper function parses the aggregate functions and input relation shared by aggregate and grouping queries.
+        :param grouping_attributes: A list of the attributes to group on
         :return: An AggregationNode object built from the query
         """
+        self._expect("[")
+        aggregations = [self.parse_aggregation_function()]
+        while self._accept(","):
+            aggregations.append(self.parse_aggregation_function())
+        self._expect("]")
 
-        # grab the aggregate function
-        aggregate_indices = self.extract_token('[', ']', input_string)
-        aggregate_expression = input_string[aggregate_indices.start_index:aggregate_indices.end_index]
-        working_string = input_string[aggregate_indices.end_index + 1:]
-
-        # grab the relation
-        relation_indices = self.extract_token('(', ')', working_string)
-        relation_expression = working_string[relation_indices.start_index:relation_indices.end_index]
-        relation_object = self.parse(relation_expression)
+        relation_object = self.parse_input()
+        return pn.AggregationNode(relation_object, grouping_attributes, aggregations)
 
-        # build and return the object
-        aggregation = Parser.generate_aggregation_object(aggregate_expression)
-        return pn.AggregationNode(relation_object, None, aggregation)
+    def parse_aggregation(self):
+        """
+        This method parses the rest of an aggregate query: AGGREGATE [sum(c) AS d] (relation)
+        :return: An AggregationNode object built from the query
+        """
+        return self.aggregation_helper([])
 
-    def parse_grouping(self, input_string):
+    def parse_grouping(self):
         """
-        This method parses a grouping/aggregation query.
-        :param input_string: The grouping query.
+        This method parses the rest of a grouping query: GROUPBY [a, b] AGGREGATE [sum(c) AS d, max(c) AS e] (relation)
         :return: An AggregatioNode object built from the query
         """
-        # TODO: combine common code from parse_aggregation into a helper function
-
-        # grab the grouping attributes
-        grouping_indices = self.extract_token('[', ']', input_string)
-        grouping_attribute = input_string[grouping_indices.start_index:grouping_indices.end_index]
-        working_string = input_string[grouping_indices.end_index + 1:]
+        self._expect("[")
+        grouping_attributes = [self._expect_name("grouping attribute")]
+        while self._accept(","):
+            grouping_attributes.append(self._expect_name("grouping attribute"))
+        self._expect("]")
 
-        # grab the aggregate function
-        aggregate_indices = self.extract_token('[', ']', working_string)
-        aggregate_expression = working_string[aggregate_indices.start_index:aggregate_indices.end_index]
-        working_string = working_string[aggregate_indices.end_index + 1:]
+        self._expect("AGGREGATE")
+        return self.aggregation_helper(grouping_attributes)
 
-        # grab the relation
-        relation_indices = self.extract_token('(', ')', working_string)
-        relation_expression = working_string[relation_indices.start_index:relation_indices.end_index]
-        relation_object = self.parse(relation_expression)
+    def parse_sort(self):
+        """
+        This method parses the rest of a sort query, SORT [a, b DESC] (relation), into a plan node.
+        Each attribute is sorted in ascending order unless it is followed by DESC. ORDERBY is a synonym for SORT.
+        :return: A SortNode containing the parsed query
+        """
+        self._expect("[")
+        sort_attributes = [self.parse_sort_attribute()]
+        while self._accept(","):
+            sort_attributes.append(self.parse_sort_attribute())
+        self._expect("]")
 
-        # build and return the object
-        aggregation = Parser.generate_aggregation_object(aggregate_expression)
-        return pn.AggregationNode(relation_object, grouping_attribute, aggregation)
+        relation_object = self.parse_input()
+        return pn.SortNode(relation_object, sort_attributes)
 
+    def parse_sort_attribute(self):
+        """
+        Parses a sort attribute, optionally followed by ASC or DESC.
+        :return: An (attribute, descending) pair
+        """
+        attribute = self._expect_name("attribute to sort on")
+        if self._accept("DESC"):
+            return attribute, True
+        self._accept("ASC")
+        return attribute, False
 
-    def parse_rename(self, input_string):
+    def parse_rename(self):
         # TODO
-        return
+        self._error("RENAME is not supported yet", self._peek(-1))
 
-    def parse_union(self, input_string):
+    def set_operation_helper(self, left_relation, node_class, distinct):
+        return node_class(left_relation, self.parse_query(), distinct)
 
-        args = self.parse_infix(input_string)
-        left_relation = self.parse(args[0])
-        right_relation = self.parse(args[2])
+    def parse_union(self, left_relation):
+        return self.set_operation_helper(left_relation, pn.UnionNode, True)
 
-        return pn.UnionNode(left_relation, right_relation)
+    def parse_union_all(self, left_relation):
+        return self.set_operation_helper(left_relation, pn.UnionNode, False)
 
-    def parse_intersect(self, input_string):
+    def parse_intersect(self, left_relation):
+        return self.set_operation_helper(left_relation, pn.IntersectionNode, True)
 
-        args = self.parse_infix(input_string)
-        left_relation = self.parse(args[0])
-        right_relation = self.parse(args[2])
+    def parse_intersect_all(self, left_relation):
+        return self.set_operation_helper(left_relation, pn.IntersectionNode, False)
 
-        return pn.IntersectionNode(left_relation, right_relation)
+    def parse_setdiff(self, left_relation):
+        return self.set_operation_helper(left_relation, pn.SetDifferenceNode, True)
 
-    def parse_setdiff(self, input_string):
+    def parse_setdiff_all(self, left_relation):
+        return self.set_operation_helper(left_relation, pn.SetDifferenceNode, False)
 
-        args = self.parse_infix(input_string)
-        left_relation = self.parse(args[0])
-        right_relation = self.parse(args[2])
-
-        return pn.SetDifferenceNode(left_relation, right_relation)
-
-    def parse_crossjoin(self, input_string):
-        args = self.parse_infix(input_string)
-        left_relation = self.parse(args[0])
-        right_relation = self.parse(args[2])
-
-        return pn.CartesianProductNode(left_relation, right_relation)
-
-    def parse_thetajoin(self, input_string):
-        # TODO
-        return
+    def parse_crossjoin(self, left_relation):
+        return pn.CartesianProductNode(left_relation, self.parse_query())
 
-    def natural_join_helper(self, input_string, is_left_outer, is_right_outer):
-        args = self.parse_infix(input_string)
-        left_relation = self.parse(args[0])
-        right_relation = self.parse(args[2])
+    def parse_thetajoin(self, left_relation):
+        """
+        Parses the rest of a theta join, left THETAJOIN [predicate] right
+        """
+        predicate = self.parse_bracketed_expression()
+        return pn.ThetaJoinNode(left_relation, self.parse_query(), predicate)
 
-        return pn.NaturalJoinNode(left_relation, right_relation, is_left_outer, is_right_outer)
+    def parse_divide(self, left_relation):
+        return pn.DivisionNode(left_relation, self.parse_query())
 
-    def parse_leftouter(self, input_string):
-        return self.natural_join_helper(input_string, True, False)
+    def natural_join_helper(self, left_relation, is_left_outer, is_right_outer):
+        return pn.NaturalJoinNode(left_relation, self.parse_query(), is_left_outer, is_right_outer)
 
-    def parse_rightouter(self, input_string):
-        return self.natural_join_helper(input_string, False, True)
+    def parse_leftouter(self, left_relation):
+        return self.natural_join_helper(left_relation, True, False)
 
-    def parse_fullouter(self, input_string):
-        return self.natural_join_helper(input_string, True, True)
+    def parse_rightouter(self, left_relation):
+        return self.natural_join_helper(left_relation, False, True)
 
-    def parse_naturaljoin(self, input_string):
-        return self.natural_join_helper(input_string, False, False)
+    def parse_fullouter(self, left_relation):
+        return self.natural_join_helper(left_relation, True, True)
 
-    def parse_assignment(self, input_string):
-        args = self.parse_infix(input_string)
-        self.relations[args[0]] = self.parse(args[2]).execute()
-        return self.relations[args[0]]
+    def parse_naturaljoin(self, left_relation):
+        return self.natural_join_helper(left_relation, False, False)
 
-    # this maps prefix operator strings to the appropriate parser function
+    def parse_assignment(self):
+        """
+        This method parses an assignment, name <-- query, and runs it straight away, replacing the named relation.
+        :return: The new relation
+        """
+        name = self._next().value
+        operator = self._next()
+
+        # the query runs now, so it can't wait for parameter values. The outer parameters are restored even if the
+        # query fails to parse.
+        outer_parameters = self.parameters
+        self.parameters = ex.ParameterValues()
+        try:
+            plan = self.parse_query()
+            if self.parameters.names:
+                self._error("an assignment can't have parameters", operator)
+        finally:
+            self.parameters = outer_parameters
+
+        result = self.finish_plan(plan).execute()
+
+        # results computed from the old relation are dropped straight away rather than when they're next looked up
+        if self.result_cache is not None:
+            self.result_cache.invalidate(name)
+        self.relations[name] = result
+        self.rebuild_indexes(name)
+        return result
+
+    # this maps prefix operator keywords to the function parsing the rest of the query
     prefix_parsers = {
         "SELECT": parse_select,
         "PROJECT": parse_project,
         "GROUPBY": parse_grouping,
         "RENAME": parse_rename,
-        "AGGREGATE": parse_aggregation
+        "AGGREGATE": parse_aggregation,
+        "SORT": parse_sort,
+        "ORDERBY": parse_sort
     }
 
-    # this maps infix operator strings to the appropriate parser function
+    # this maps infix operator keywords to the function parsing the right operand, given the parsed left operand
     infix_parsers = {
         "UNION": parse_union,
+        "UNIONALL": parse_union_all,
         "CROSSJOIN": parse_crossjoin,
         "THETAJOIN": parse_thetajoin,
         "NATURALJOIN": parse_naturaljoin,
@@ -350,87 +450,72 @@ class Parser:
         "RIGHTOUTERJOIN": parse_rightouter,
         "FULLOUTERJOIN": parse_fullouter,
         "SETDIFF": parse_setdiff,
+        "SETDIFFALL": parse_setdiff_all,
         "INTERSECT": parse_intersect,
-        "<--": parse_assignment
+        "INTERSECTALL": parse_intersect_all,
+        "DIVIDE": parse_divide
     }
 
-    def parse_infix(self, input_string):
-        """
-        This helper function parses an input string known to be in infix form into an [arg1, operator, arg2] array
-        :param input_string: The string to be parsed
-        :return: The array of argument tokens as strings: [arg1, operator, arg2]
-        """
-        output_strings = []
-        working_string = input_string
-
-        # nested first arg
-        if input_string[0] == '(':
-            indices = self.extract_token('(', ')', input_string)
-            first_arg = input_string[indices.start_index: indices.end_index]
-            output_strings.append(first_arg)
-            working_string = input_string[indices.end_index + 1:]
-
-        # simple first arg
-        else:
-            tokens = input_string.split(' ')
-            first_arg = tokens[0]
-            if first_arg not in self.relations:
-                sys.exit("invalid relation: %s" % first_arg)
-            output_strings.append(first_arg)
-            working_string = working_string[working_string.find(' ') + 1:]
-
-        # operator parsing
-        working_string = working_string.strip()
-        tokens = working_string.split(' ')
-        operator = tokens[0]
-        if operator not in self.infix_parsers:
-            sys.exit("invalid infix operator: %s" % operator)
-        output_strings.append(operator)
-
-        # second arg parsing
-        second_arg = working_string[working_string.find(' ') + 1:].strip()
-        output_strings.append(second_arg)
-
-        return output_strings
-
     def parse(self, input_string):
         """
-        This is the entry function into the parser object. It takes an input string and passes it off
-        to the appropriate parser.
-        :param input_string: The query string to be parsed.
+        This is the entry function into the parser object. It parses the input string into an execution plan,
+        then binds the plan so that every attribute reference is resolved before execution, and optimizes it.
+        :param input_string: The query string to be parsed. Queries with :name parameters must be prepared instead.
         :return: An execution plan for the query.
+        :raise ParseError: (defined in Expression.py) if the query is not valid, giving the position of the error
         """
+        plan, parameters = self.build_plan(input_string)
+        if parameters.names:
+            raise ex.ParseError("query has parameters %s, so it must be prepared"
+                                % ", ".join(":" + name for name in sorted(parameters.names)), 0, input_string)
+        return plan
 
-        # strip spaces and redundant parentheses
-        input_string = input_string.strip()
-        input_string = Parser.strip_parentheses(input_string)
-
-        tokens = input_string.split(' ')
-
-        # simple relation case
-        if len(tokens) == 1:
-            if tokens[0] in self.relations:
-                return self.relations[tokens[0]]
-            else:
-                sys.exit("invalid relation: %s" % tokens[0])
-
-        # check for a nested relation expression (e.g. left side of a join)
-        # in this case we know we must have an infix operator
-        elif input_string[0] == '(':
-            infix_args = self.parse_infix(input_string)
-            return self.infix_parsers[infix_args[1]](self, input_string)
-
-        # check for a prefix operator
-        elif tokens[0] in self.prefix_parsers:
-            return self.prefix_parsers[tokens[0]](self, input_string)
-
-        # check for an infix operator
-        elif tokens[1] in self.infix_parsers:
-            return self.infix_parsers[tokens[1]](self, input_string)
-
-        # every valid input will have either a prefix or infix operator, so at this point the input is invalid
-        else:
-            sys.exit("Could not match to a prefix or infix operator - check parentheses?")
-
-
+    def prepare(self, input_string):
+        """
+        Parses, binds and optimizes a query once, so it can be executed many times with different parameter values.
+        Prepared statements are cached by query text, and rebuilt if a relation they read has since been replaced.
+        :param input_string: The query string, which may contain :name parameters wherever an expression may contain
+            a constant, e.g. "SELECT [salary > :min_salary] (works)"
+        :return: A PreparedStatement for the query.
+        """
+        statement = self.plan_cache.get(input_string)
+        if statement is not None and all(self.relations.get(name) is relation for name, relation in statement.sources):
+            # move the statement to the most recently used end
+            del self.plan_cache[input_string]
+            self.plan_cache[input_string] = statement
+            return statement
+
+        plan, parameters = self.build_plan(input_string)
+        relations = set(id(relation) for relation in pn.base_relations(plan))
+        sources = [(name, relation) for name, relation in self.relations.items() if id(relation) in relations]
+        statement = PreparedStatement(plan, parameters, sources)
+
+        self.plan_cache.pop(input_string, None)
+        self.plan_cache[input_string] = statement
+        if len(self.plan_cache) > PLAN_CACHE_SIZE:
+            self.plan_cache.popitem(last=False)
+        return statement
+
+    def build_plan(self, input_string):
+        """
+        Parses a query into a bound, optimized execution plan, which is set up to run with this parser's engine and
+        result cache.
+        :param input_string: The query string to be parsed.
+        :return: The execution plan, and the ParameterValues its parameters read their values from.
+        """
+        self.parameters = parameters = ex.ParameterValues()
+        return self.finish_plan(self.parse_plan(input_string)), parameters
 
+    def finish_plan(self, plan):
+        """
+        Binds and optimizes a parsed plan, and sets it up to run with this parser's engine and result cache.
+        :param plan: The unbound execution plan
+        :return: The finished execution plan
+        """
+        plan.bind()
+        if self.optimizer is not None:
+            plan = self.optimizer.optimize(plan)
+        if isinstance(plan, pn.PlanNode):
+            plan.engine = self.engine
+            plan.cache = self.result_cache
+        return plan
@@ -1,5 +1,8 @@
+import Expression as ex
+import Parallel
 import PlanNode as pn
 import Parser as ps
+import ResultCache as rc
 
 
 def RelationTest():
@@ -61,6 +64,29 @@ def JoinTest():
 
     test_parser.parse(test_query).execute().printOut()
 
+def ThetaJoinTest():
+    test_query = "test1 THETAJOIN [test1.a < test2.c and abs(test1.c - test2.a) <= 1] test2"
+    print test_query
+    test_schema_1 = ["a", "b", "c"]
+    test_tuple_1 = [1, 2, 1]
+    test_tuple_2 = [1, 2, 3]
+    test_tuple_3 = [2, 2, 3]
+    test_relation_1 = pn.Relation(test_schema_1, [test_tuple_1, test_tuple_2, test_tuple_3], "test1")
+    test_relation_2 = pn.Relation(test_schema_1, [test_tuple_1, test_tuple_2, test_tuple_3], "test2")
+    test_parser = ps.Parser({"test1": test_relation_1, "test2": test_relation_2})
+
+    test_parser.parse(test_query).execute().printOut()
+
+def DivisionTest():
+    test_query = "(PROJECT [a, c] (test1)) DIVIDE (PROJECT [c] (SELECT [c > 1] (test2)))"
+    print test_query
+    test_schema_1 = ["a", "b", "c"]
+    test_relation_1 = pn.Relation(test_schema_1, [[1, 2, 1], [1, 2, 3], [2, 2, 3], [2, 5, 4], [1, 5, 4]], "test1")
+    test_relation_2 = pn.Relation(test_schema_1, [[1, 2, 1], [1, 2, 3], [2, 2, 4]], "test2")
+    test_parser = ps.Parser({"test1": test_relation_1, "test2": test_relation_2})
+
+    test_parser.parse(test_query).execute().printOut()
+
 def SimpleAggregationTest():
     test_query = "AGGREGATE [sum(b) AS total_b] (test1)"
     test_schema_1 = ["a", "b", "c"]
@@ -83,9 +109,108 @@ def GroupingTest():
 
     test_parser.parse(test_query).execute().printOut()
 
+def MultipleGroupingTest():
+    test_query = "GROUPBY [b, c] AGGREGATE [sum(a) AS total_a, count(a) AS count_a] (test1)"
+    test_schema_1 = ["a", "b", "c"]
+    test_tuple_1 = [1, 2, 1]
+    test_tuple_2 = [1, 2, 3]
+    test_tuple_3 = [2, 2, 3]
+    test_relation_1 = pn.Relation(test_schema_1, [test_tuple_1, test_tuple_2, test_tuple_3], "test1")
+    test_parser = ps.Parser({"test1": test_relation_1})
+
+    test_parser.parse(test_query).execute().printOut()
+
+def SortTest():
+    test_query = "GROUPBY [c] AGGREGATE [sum(a) AS total_a] (SORT [c DESC, a] (test1))"
+    print test_query
+    test_schema_1 = ["a", "b", "c"]
+    test_tuple_1 = [1, 2, 1]
+    test_tuple_2 = [1, 2, 3]
+    test_tuple_3 = [2, 2, 3]
+    test_relation_1 = pn.Relation(test_schema_1, [test_tuple_1, test_tuple_2, test_tuple_3], "test1")
+    test_parser = ps.Parser({"test1": test_relation_1})
+
+    test_parser.parse("ORDERBY [c DESC, a] (test1)").execute().printOut()
+
+    # the input is sorted on the grouping attribute, so the groups are aggregated one at a time, in order
+    test_plan = test_parser.parse(test_query)
+    print "sorted input: %s" % test_plan.input_sorted
+    test_plan.execute().printOut()
+
+def ConcurrentTest():
+    test_query = "(SELECT [a < c] (test1)) UNION ((PROJECT [a, b, c] (test2)) UNION (SELECT [a > 1] (test1)))"
+    print test_query
+    test_schema_1 = ["a", "b", "c"]
+    test_tuple_1 = [1, 2, 1]
+    test_tuple_2 = [1, 2, 3]
+    test_tuple_3 = [2, 2, 3]
+    test_relation_1 = pn.Relation(test_schema_1, [test_tuple_1, test_tuple_2, test_tuple_3], "test1")
+    test_relation_2 = pn.Relation(test_schema_1, [[5, 5, 5]], "test2")
+    test_engine = Parallel.ConcurrentEngine(parallelism=2)
+    test_parser = ps.Parser({"test1": test_relation_1, "test2": test_relation_2}, engine=test_engine)
+
+    test_parser.parse(test_query).execute().printOut()
+    # the subtrees finish in no particular order
+    print "subtrees: %s" % ", ".join(sorted(description for description, seconds in test_engine.timings))
+    test_engine.close()
+
+def ResultCacheTest():
+    test_query = "SELECT [a < c] (test1)"
+    test_schema_1 = ["a", "b", "c"]
+    test_relation_1 = pn.Relation(test_schema_1, [[1, 2, 1], [1, 2, 3], [2, 2, 3]], "test1")
+    relations = {"test1": test_relation_1}
+    test_parser = ps.Parser(relations, result_cache=rc.ResultCache(relations))
+
+    # the second run is served from the cache, and the assignment invalidates it for the third
+    test_parser.parse(test_query).execute().printOut()
+    test_parser.parse(test_query).execute().printOut()
+    test_parser.parse("test1 <-- SELECT [a == 1] (test1)")
+    test_parser.parse(test_query).execute().printOut()
+
+    cache = test_parser.result_cache
+    print "hits: %d, misses: %d, evictions: %d, invalidations: %d" % (cache.hits, cache.misses, cache.evictions,
+                                                                       cache.invalidations)
+
+def PreparedStatementTest():
+    test_query = "PROJECT [a, b * :scale AS scaled_b] (SELECT [a >= :min_a] (test1))"
+    test_schema_1 = ["a", "b", "c"]
+    test_relation_1 = pn.Relation(test_schema_1, [[1, 2, 1], [1, 2, 3], [2, 2, 3]], "test1")
+    test_parser = ps.Parser({"test1": test_relation_1})
+
+    # the query is parsed once, then run with two sets of parameter values
+    statement = test_parser.prepare(test_query)
+    print test_query
+    statement.execute(min_a=1, scale=10).printOut()
+    statement.execute(min_a=2, scale=100).printOut()
+    print "prepared once: %s" % (test_parser.prepare(test_query) is statement)
+
+    # a new index makes the statement be planned again, so it can use the index
+    test_parser.create_index("test1", "a", "sorted")
+    print "prepared again after indexing: %s" % (test_parser.prepare(test_query) is not statement)
+
+def ParseErrorTest():
+    test_relation_1 = pn.Relation(["a", "b", "c"], [[1, 2, 1]], "test1")
+    test_parser = ps.Parser({"test1": test_relation_1})
+
+    # each error is reported with the position in the query where it was found
+    for test_query in ["SELECT [a < ] (test1)", "(test1 UNION test1", "test1 NATURALJOIN test2",
+                       "test2 <-- SELECT [a > ] (test1)"]:
+        try:
+            test_parser.parse(test_query)
+        except ex.ParseError as e:
+            print e
+
 RelationTest()
 SelectTest()
 ProjectTest()
 JoinTest()
+ThetaJoinTest()
+DivisionTest()
 SimpleAggregationTest()
-GroupingTest()
\ No newline at end of file
+GroupingTest()
+MultipleGroupingTest()
+SortTest()
+ConcurrentTest()
+ResultCacheTest()
+PreparedStatementTest()
+ParseErrorTest()
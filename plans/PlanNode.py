@@ -1,44 +1,51 @@
 from abc import ABCMeta, abstractmethod
+from collections import Counter
+import array
+import bisect
 import copy
-import re
+import itertools
+import operator
 import sys
 
+import Expression as ex
+
 class Aggregation:
     """
     This class defines an aggregation object, used for storing and evaluating an aggregate function within a query.
+    Aggregates are evaluated incrementally: each one starts from an initial state, folds in the non-null input values
+    one at a time, and converts its final state into the result.
     """
 
-    def _aggregate_sum(self, input_relation, attribute):
-        return sum(filter(None, [input_relation.attribute_value(attribute, tup) for tup in input_relation.tuples]))
+    def _step_sum(state, value):
+        return state + value
 
-    def _aggregate_min(self, input_relation, attribute):
-        arr = filter(None, [input_relation.attribute_value(attribute, tup) for tup in input_relation.tuples])
-        if arr:
-            return min(filter(None, arr))
-        else:
-            return None
+    def _step_min(state, value):
+        return value if state is None or value < state else state
 
-    def _aggregate_max(self, input_relation, attribute):
-        arr = filter(None, [input_relation.attribute_value(attribute, tup) for tup in input_relation.tuples])
-        if arr:
-            return max(filter(None, arr))
-        else:
-            return None
+    def _step_max(state, value):
+        return value if state is None or value > state else state
+
+    def _step_count(state, value):
+        return state + 1
 
-    def _aggregate_count(self, input_relation, attribute):
-        return len(filter(None, [input_relation.attribute_value(attribute, tup) for tup in input_relation.tuples]))
+    def _step_avg(state, value):
+        return state[0] + value, state[1] + 1
 
-    def _aggregate_avg(self, input_relation, attribute):
-        arr = filter(None, [input_relation.attribute_value(attribute, tup) for tup in input_relation.tuples])
-        if arr:
-            return sum(arr) / float(len(arr))
+    def _final_avg(state):
+        if state[1]:
+            return state[0] / float(state[1])
+        return None
 
+    def _final_identity(state):
+        return state
+
+    # maps each aggregate function name to its (initial state, step function, final function)
     function_mappings = {
-        'sum': _aggregate_sum,
-        'max': _aggregate_max,
-        'min': _aggregate_min,
-        'count': _aggregate_count,
-        'avg': _aggregate_avg
+        'sum': (0, _step_sum, _final_identity),
+        'max': (None, _step_max, _final_identity),
+        'min': (None, _step_min, _final_identity),
+        'count': (0, _step_count, _final_identity),
+        'avg': ((0, 0), _step_avg, _final_avg)
     }
 
     def __init__(self, agg_function, attribute, result_name):
@@ -48,24 +55,103 @@ class Aggregation:
         :param attribute: The attribute to be aggregated over
         :param result_name: The string name to give to the result of the aggregation function
         """
-        self.agg_function = self.function_mappings[agg_function]
+        self.function_name = agg_function
+        self.initial_state, self.step, self.final = self.function_mappings[agg_function]
         self.attribute = attribute
         self.result_name = result_name
 
+class Schema(list):
+    """
+    This class defines a schema: the list of attribute names of a relation, along with a map from each name to its
+    position so attributes can be resolved without searching the list.
+    Schemas should not be modified in place once built.
+    """
+    def __init__(self, attributes=()):
+        """
+        Schema object constructor
+        :param attributes: array of strings, representing the name of each column
+        """
+        list.__init__(self, attributes)
+        self.positions = dict((attribute, i) for i, attribute in reversed(list(enumerate(self))))
+
+    def __contains__(self, attribute):
+        return attribute in self.positions
+
+    def index(self, attribute):
+        if attribute not in self.positions:
+            raise ValueError("%s is not in schema" % attribute)
+        return self.positions[attribute]
+
+    def position(self, attribute):
+        """
+        Resolves an attribute reference to its position in the schema.
+        An unqualified name also matches a qualified attribute (relation.attribute) if exactly one such attribute exists.
+        :param attribute: string, the attribute name
+        :return: int, the position of the attribute
+        """
+        if attribute in self.positions:
+            return self.positions[attribute]
+
+        if "." not in attribute:
+            matches = [i for i, name in enumerate(self) if name.endswith("." + attribute)]
+            if len(matches) == 1:
+                return matches[0]
+            if len(matches) > 1:
+                sys.exit("Attribute %s is ambiguous in schema" % attribute)
+
+        sys.exit("Attribute value %s could not be found in schema" % attribute)
+
+
 class Relation:
     """
     This class defines a relation object, used for storing and print out relations.
     """
+    # relations are stored in no particular order
+    sorted_on = ()
+
     def __init__(self, schema, tuples, name):
         """
         Relation object constructor
         :param schema: array of strings, representing the name of each column in the relation
-        :param tuples: array of arrays, representing the tuples of the relation
+        :param tuples: array of arrays, representing the tuples of the relation. Rows are stored as python tuples.
         :param name: string, the name of the relation
         """
-        self.schema = schema
-        self.tuples = tuples
+        self.schema = schema if isinstance(schema, Schema) else Schema(schema)
+        self.tuples = map(tuple, tuples)
         self.name = name
+        self.distinct_counts = {}
+
+    def bind(self):
+        return self.schema
+
+    def rows(self):
+        return iter(self.tuples)
+
+    def estimated_cardinality(self):
+        return len(self.tuples)
+
+    def fingerprint(self):
+        # relations are identified by the object itself, so plans over the same catalog entry share a fingerprint
+        return "relation", id(self)
+
+    def column_values(self, position):
+        """
+        :param position: int, the position of an attribute in the schema
+        :return: An iterator over every value of the attribute
+        """
+        return (tup[position] for tup in self.tuples)
+
+    def distinct_count(self, attribute):
+        """
+        Counts the distinct values of an attribute, for the optimizer's cardinality estimates.
+        The count is computed on first use and then cached with the relation.
+        :param attribute: string, the attribute name
+        :return: int, the number of distinct values
+        """
+        position = self.schema.position(attribute)
+        if position not in self.distinct_counts:
+            self.distinct_counts[position] = len(set(self.column_values(position)))
+        return self.distinct_counts[position]
 
     def execute(self):
         return self
@@ -120,44 +206,386 @@ class Relation:
         """
         Given an attribute and a tuple, returns the value of that attribute in the tuple
         """
-        if attribute not in self.schema:
-            sys.exit("Attribute value %s could not be found in schema" % attribute)
+        return tup[self.schema.position(attribute)]
+
+
+def typed_column(values):
+    """
+    Stores a column of values as compactly as possible: columns made up entirely of ints or floats are stored in a
+    typed array of machine values, anything else is stored in a list
+    :param values: iterable of values
+    :return: an array.array or a list
+    """
+    values = list(values)
+    types = set(type(value) for value in values)
+    if types == set([int]):
+        return array.array('l', values)
+    if types == set([float]):
+        return array.array('d', values)
+    return values
+
+
+class RowView:
+    """
+    This class presents the columns of a ColumnarRelation as a read-only sequence of tuples, so that code written
+    against Relation.tuples keeps working.
+    """
+    def __init__(self, relation):
+        self.relation = relation
+
+    def __len__(self):
+        return self.relation.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.relation.row(i) for i in range(*index.indices(self.relation.size))]
+        if index < 0:
+            index += self.relation.size
+        if not 0 <= index < self.relation.size:
+            raise IndexError("row index out of range")
+        return self.relation.row(index)
+
+    def __iter__(self):
+        return self.relation.rows()
+
+
+class ColumnarRelation(Relation):
+    """
+    This class defines a relation stored a column at a time: one typed array or list per attribute.
+    It can stand in for a Relation anywhere, and operators which only need a few attributes (select, project,
+    aggregation) read just those columns through column_rows().
+    """
+    def __init__(self, schema, columns, name, size=None):
+        """
+        ColumnarRelation object constructor
+        :param schema: array of strings, representing the name of each column in the relation
+        :param columns: array of columns, each an array.array or a list of values, all of the same length
+        :param name: string, the name of the relation
+        :param size: int, the number of tuples. By default it's the length of the columns, so it must be given for a
+            relation without any columns.
+        """
+        self.schema = schema if isinstance(schema, Schema) else Schema(schema)
+        self.columns = columns
+        self.name = name
+        self.size = size if size is not None else len(columns[0]) if columns else 0
+        self.tuples = RowView(self)
+        self.distinct_counts = {}
+
+        if len(columns) != len(self.schema) or any(len(column) != self.size for column in columns):
+            sys.exit("columns do not match the schema of relation %s" % name)
+
+    @staticmethod
+    def from_relation(relation):
+        """
+        Converts a row-oriented relation into a columnar one
+        :param relation: Relation: the relation to convert
+        :return: The ColumnarRelation
+        """
+        columns = [typed_column(tup[i] for tup in relation.tuples) for i in range(len(relation.schema))]
+        return ColumnarRelation(relation.schema, columns, relation.name, len(relation.tuples))
+
+    def row(self, index):
+        """
+        :return: the tuple at the given index
+        """
+        return tuple([column[index] for column in self.columns])
+
+    def rows(self):
+        if not self.columns:
+            return itertools.repeat((), self.size)
+        return itertools.izip(*self.columns)
+
+    def column_values(self, position):
+        return self.columns[position]
+
+    def column_rows(self, positions):
+        """
+        Reads only the given columns, one python tuple of their values per row
+        :param positions: array of ints, the positions of the columns to read (at least one)
+        :return: An iterator over the tuples of values
+        """
+        return itertools.izip(*[self.columns[i] for i in positions])
+
+
+class HashIndex:
+    """
+    This class defines a hash index on one attribute of a relation: a map from each value of the attribute to the
+    positions of the tuples holding it. It answers equality lookups.
+    """
+    kind = "hash"
+
+    def __init__(self, relation, attribute):
+        """
+        Builds the index
+        :param relation: Relation: the indexed relation
+        :param attribute: string, the indexed attribute
+        """
+        self.relation = relation
+        self.attribute = relation.schema[relation.schema.position(attribute)]
+        self.positions = {}
+        for i, value in enumerate(relation.column_values(relation.schema.index(self.attribute))):
+            self.positions.setdefault(value, []).append(i)
+        self.distinct_count = len(self.positions)
+
+    def lookup(self, value):
+        """
+        :return: the positions of the tuples whose attribute equals the value
+        """
+        return self.positions.get(value, ())
+
+
+class SortedIndex:
+    """
+    This class defines a sorted index on one attribute of a relation: the positions of its tuples ordered by the value
+    of the attribute, searched by bisection. It answers equality and range lookups.
+    """
+    kind = "sorted"
+
+    def __init__(self, relation, attribute):
+        """
+        Builds the index
+        :param relation: Relation: the indexed relation
+        :param attribute: string, the indexed attribute
+        """
+        self.relation = relation
+        self.attribute = relation.schema[relation.schema.position(attribute)]
+        entries = sorted((value, i) for i, value in
+                         enumerate(relation.column_values(relation.schema.index(self.attribute))))
+        self.values = [value for value, i in entries]
+        self.positions = [i for value, i in entries]
+        self.distinct_count = sum(1 for i in range(len(self.values)) if i == 0 or self.values[i] != self.values[i - 1])
+
+    def lookup(self, value):
+        """
+        :return: the positions of the tuples whose attribute equals the value
+        """
+        return self.positions[bisect.bisect_left(self.values, value):bisect.bisect_right(self.values, value)]
+
+    def range(self, low=None, high=None):
+        """
+        :param low: (value, inclusive) pair: the lower bound on the attribute, and True if values equal to it match;
+            None for no lower bound
+        :param high: (value, inclusive) pair: the upper bound on the attribute; None for no upper bound
+        :return: the positions of the tuples whose attribute lies within the bounds
+        """
+        start, end = 0, len(self.values)
+        if low is not None:
+            value, inclusive = low
+            start = (bisect.bisect_left if inclusive else bisect.bisect_right)(self.values, value)
+        if high is not None:
+            value, inclusive = high
+            end = (bisect.bisect_right if inclusive else bisect.bisect_left)(self.values, value)
+        return self.positions[start:end] if start < end else []
+
+
+# maps each index kind to the class implementing it
+index_kinds = {
+    "hash": HashIndex,
+    "sorted": SortedIndex
+}
+
+
+# the comparison operator which holds with its operands swapped
+_SWAPPED_COMPARISONS = {"==": "==", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+def _tuple_getter(indices):
+    """
+    :param indices: array of ints, positions within a row
+    :return: a function returning the values at those positions of a row, as a tuple
+    """
+    if not indices:
+        return lambda tup: ()
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda tup: (tup[index],)
+    return operator.itemgetter(*indices)
+
+
+def _key_getter(indices):
+    """
+    :param indices: array of ints, positions within a row
+    :return: a function returning a hashable key made of the values at those positions of a row
+    """
+    if len(indices) == 1:
+        return operator.itemgetter(indices[0])
+    return _tuple_getter(indices)
+
+
+def _parameter_key(expressions):
+    """
+    :return: the current values of the parameters of a list of expressions, so that the fingerprint of a prepared plan
+        changes with its parameter values
+    """
+    return tuple((parameter.name, parameter.values.get(parameter.name))
+                 for expression in expressions for parameter in expression.parameters())
+
+
+def base_relations(plan):
+    """
+    :param plan: Plan Node or Relation: the root of a plan
+    :return: array of the distinct Relations read by the plan
+    """
+    relations = {}
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, Relation):
+            relations[id(node)] = node
+        else:
+            pending.extend(getattr(node, attribute) for attribute in ("left_child", "right_child")
+                           if hasattr(node, attribute))
+    return relations.values()
+
+
+def reset_spools(plan):
+    """
+    Releases the tuples held by the spools of a plan, so an execution which stopped early, e.g. on an exception,
+    leaves nothing behind for the next execution to read
+    :param plan: Plan Node or Relation: the root of a plan
+    """
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, SpoolNode):
+            node.tuples = None
+            node.remaining = 0
+        pending.extend(getattr(node, attribute) for attribute in ("left_child", "right_child")
+                       if hasattr(node, attribute))
+
+
+def _column_subset(schema, attributes):
+    """
+    Finds the columns a set of attribute references needs, for operators which read only part of a ColumnarRelation
+    :param schema: Schema: the schema of the relation
+    :param attributes: array of strings, the referenced attributes
+    :return: the sorted positions of the referenced columns, and the Schema of just those columns
+    """
+    positions = sorted(set(schema.position(attribute) for attribute in attributes))
+    return positions, Schema([schema[i] for i in positions])
 
-        return tup[self.schema.index(attribute)]
 
 class PlanNode:
     """
     Abstract class for plan nodes.
-    Right now it doesn't really do anything, but in theory you could put common code here, so it seems useful to have.
+    A plan is bound once before it is executed. Binding resolves every attribute reference in every node to a position
+    in the node's input rows and sets the schema and name of each node's output, so unknown attributes are reported
+    before any tuples are processed and execution never has to look up a name.
+
+    Execution is pull-based: rows() lazily generates the output tuples of a node, pulling tuples from its children
+    only as they are needed. Only blocking operators (hash build sides, set operations, aggregation) hold tuples in
+    memory, so a pipeline's peak memory tracks its largest blocking state rather than every intermediate result.
     """
     __metaclass__ = ABCMeta
 
+    bound = False
+
+    # the order of the output tuples, set by bind(): a list of (attribute, descending) pairs giving the attributes the
+    # output is sorted on, most significant first. Empty if the output is in no particular order.
+    sorted_on = ()
+
+    # the engine used to execute the plan; None means the row engine implemented by the nodes themselves
+    engine = None
+
+    # the ResultCache (defined in ResultCache.py) holding the outputs of executed plans; None disables caching
+    cache = None
+
     @abstractmethod
-    def execute(self):
+    def bind(self):
+        """
+        Binds this node and all of its children.
+        :return: Schema: the output schema of the node
+        """
+        pass
+
+    def ensure_bound(self):
+        """
+        Binds the node if it hasn't been bound yet, e.g. when a plan is built by hand rather than by the parser
+        """
+        if not self.bound:
+            self.bind()
+
+    @abstractmethod
+    def rows(self):
+        """
+        Generates the output tuples of the bound node one at a time.
+        :return: An iterator over the output tuples
+        """
+        pass
+
+    @abstractmethod
+    def estimated_cardinality(self):
+        """
+        :return: int, a rough estimate of the number of output tuples, used to choose hash table build sides
+        """
+        pass
+
+    @abstractmethod
+    def fingerprint(self):
+        """
+        Describes the computation of the node, so structurally identical subplans can be recognised.
+        :return: a hashable value, equal for two nodes exactly when they compute the same output from the same relations
+        """
         pass
 
+    def execute(self):
+        """
+        Runs the plan to completion, draining its output into a Relation, unless its output is already cached
+        :return: Relation: the output of the node
+        """
+        self.ensure_bound()
+        if self.cache is not None:
+            result = self.cache.lookup(self)
+            if result is not None:
+                return result
+
+        # the spools are emptied before and after the plan runs, however the run ends
+        reset_spools(self)
+        try:
+            if self.engine is not None:
+                result = self.engine.execute(self)
+            else:
+                result = Relation(self.schema, list(self.rows()), self.name)
+        finally:
+            reset_spools(self)
+
+        if self.cache is not None:
+            self.cache.store(self, result)
+        return result
+
 class CartesianProductNode(PlanNode):
     def __init__(self, left_child, right_child):
         self.left_child = left_child
         self.right_child = right_child
 
-    def execute(self):
-        left_relation = self.left_child.execute()
-        right_relation = self.right_child.execute()
+    def bind(self):
+        left_schema = self.left_child.bind()
+        right_schema = self.right_child.bind()
 
         # schema is just the combination of the two schemas, prefixed with their respective relation names
-        schema = ["%s.%s" % (left_relation.name, column) for column in left_relation.schema]
-        schema.extend(["%s.%s" % (right_relation.name, column) for column in right_relation.schema])
+        schema = ["%s.%s" % (self.left_child.name, column) for column in left_schema]
+        schema.extend(["%s.%s" % (self.right_child.name, column) for column in right_schema])
+        self.schema = Schema(schema)
 
         # relation name is the concatenation of the two input relation names
-        out_relation = Relation(schema, [], "%s_%s" % (left_relation.name, right_relation.name))
+        self.name = "%s_%s" % (self.left_child.name, self.right_child.name)
+        self.bound = True
+        return self.schema
+
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality() * self.right_child.estimated_cardinality()
 
-        # generate every combination of tuples and add to output
-        for left_tuple in left_relation.tuples:
-            for right_tuple in right_relation.tuples:
-                out_relation.tuples.append(left_tuple + right_tuple)
+    def fingerprint(self):
+        return "product", self.left_child.fingerprint(), self.right_child.fingerprint()
 
-        return out_relation
+    def rows(self):
+        # the right input is materialized once, the left input is streamed
+        right_tuples = list(self.right_child.rows())
+
+        # generate every combination of tuples
+        for left_tuple in self.left_child.rows():
+            for right_tuple in right_tuples:
+                yield left_tuple + right_tuple
 
 
 class NaturalJoinNode(PlanNode):
@@ -167,229 +595,919 @@ class NaturalJoinNode(PlanNode):
         self.is_left_outer = is_left_outer
         self.is_right_outer = is_right_outer
 
-    def execute(self):
-        # TODO: this method is pretty messy and hard to read, should be fixed up
-        left_relation = self.left_child.execute()
-        right_relation = self.right_child.execute()
-
-        # we figure out the names of the attributes shared by both children
-        common_schema = []  # the attributes shared by both children
-        duplicate_indices = []  # the indices of the duplicate attributes in the right schema
-        for attribute in left_relation.schema:
-            if attribute in right_relation.schema:
-                common_schema.append(attribute)
-                duplicate_indices.append(right_relation.schema.index(attribute))
+        # True or False to always build the hash table on the left or right input, as chosen by the optimizer;
+        # None chooses the smaller input when the join runs
+        self.build_left = None
+
+        # a HashIndex on the join attribute of a child relation, set by the optimizer; the other input is then streamed
+        # past the index instead of a hash table being built
+        self.build_index = None
+
+        # True if both inputs arrive sorted in ascending order on the join attributes, in the same attribute order, as
+        # set by the optimizer; the inputs are then merged instead of hashed
+        self.merge = False
+
+    def bind(self):
+        left_schema = self.left_child.bind()
+        right_schema = self.right_child.bind()
+
+        # we figure out the names of the attributes shared by both children, and where they sit in each schema
+        common_schema = [attribute for attribute in left_schema if attribute in right_schema]
+        self.left_key_indices = [left_schema.index(attribute) for attribute in common_schema]
+        self.right_key_indices = [right_schema.index(attribute) for attribute in common_schema]
 
         # our new schema is the left schema and all the non-shared attributes of the right schema
-        new_right_schema = [x for x in right_relation.schema if x not in common_schema]
-        out_relation = Relation(left_relation.schema + new_right_schema, [], "%s_%s" % (left_relation.name, right_relation.name))
+        self.right_extra_indices = [i for i in range(len(right_schema)) if i not in self.right_key_indices]
+        self.schema = Schema(left_schema + [right_schema[i] for i in self.right_extra_indices])
+        self.name = "%s_%s" % (self.left_child.name, self.right_child.name)
 
-        # keep track of which tuples are used, to make sure all tuples are used in an outer join
-        used_right_tuples = []
-        used_left_tuples = []
+        # where each left attribute comes from when padding a dangling right tuple in a right outer join
+        self.left_fill = [right_schema.index(attribute) if attribute in right_schema else None
+                          for attribute in left_schema]
 
-        # iterate through every tuple combination, checking for matches
-        for left_tuple in left_relation.tuples:
-            for right_tuple in right_relation.tuples:
+        self.right_extra = _tuple_getter(self.right_extra_indices)
+        self.null_padding = (None,) * len(self.right_extra_indices)
 
-                # check if every attribute in the common schema is equal across the two tuples
-                if all(left_tuple[left_relation.schema.index(attr)] == right_tuple[right_relation.schema.index(attr)] for attr in common_schema):
+        # a merge join emits its tuples in the order of the join attributes; a hash join loses the order of its inputs
+        self.sorted_on = self.left_child.sorted_on[:len(common_schema)] if self.merge else ()
 
-                    used_right_tuples.append(right_tuple)
-                    used_left_tuples.append(left_tuple)
+        self.bound = True
+        return self.schema
 
-                    # if so add that tuple to the output, excluding the attributes at the duplicate indices
-                    out_tuple = left_tuple + [right_tuple[i] for i in range(len(right_tuple)) if i not in duplicate_indices]
-                    out_relation.tuples.append(out_tuple)
+    def estimated_cardinality(self):
+        return max(self.left_child.estimated_cardinality(), self.right_child.estimated_cardinality())
 
-        # add any tuples from the right relation that weren't already added
-        if self.is_right_outer:
-            unused_right_tuples = [tup for tup in right_relation.tuples if tup not in used_right_tuples]
-            for tup in unused_right_tuples:
-                out_tup = []
-                for attribute in out_relation.schema:
-                    out_tup.append(right_relation.attribute_value(attribute, tup) if attribute in right_relation.schema else None)
-                out_relation.tuples.append(out_tup)
+    def fingerprint(self):
+        return "join", self.is_left_outer, self.is_right_outer, self.left_child.fingerprint(), \
+            self.right_child.fingerprint()
 
-        # add any tuples from the left relation that weren't already added
-        if self.is_left_outer:
-            unused_left_tuples = [tup for tup in left_relation.tuples if tup not in used_left_tuples]
-            for tup in unused_left_tuples:
-                out_relation.tuples.append(tup + [None] * len(new_right_schema))
+    def _pad_left(self, tup):
+        """
+        Pads a dangling left tuple with nulls for the right-only attributes
+        """
+        return tup + self.null_padding
 
-        return out_relation
+    def _pad_right(self, tup):
+        """
+        Pads a dangling right tuple with nulls for the left-only attributes
+        """
+        return tuple([tup[i] if i is not None else None for i in self.left_fill]) + self.right_extra(tup)
+
+    def rows(self):
+        if self.build_index is not None:
+            return self._index_join_rows()
+        if self.merge:
+            return self._merge_join_rows()
+        return self._hash_join_rows()
+
+    def _merge_join_rows(self):
+        # both inputs are ordered on the join attributes, so they are merged one run of equal keys at a time; only the
+        # current run of right tuples is held in memory
+        left_groups = itertools.groupby(self.left_child.rows(), _tuple_getter(self.left_key_indices))
+        right_groups = itertools.groupby(self.right_child.rows(), _tuple_getter(self.right_key_indices))
+        left_group, right_group = next(left_groups, None), next(right_groups, None)
+
+        while left_group is not None and right_group is not None:
+            (left_key, left_tuples), (right_key, right_tuples) = left_group, right_group
+            if left_key == right_key:
+                right_extras = map(self.right_extra, right_tuples)
+                for tup in left_tuples:
+                    for extra in right_extras:
+                        yield tup + extra
+                left_group, right_group = next(left_groups, None), next(right_groups, None)
+            elif left_key < right_key:
+                if self.is_left_outer:
+                    for tup in left_tuples:
+                        yield self._pad_left(tup)
+                left_group = next(left_groups, None)
+            else:
+                if self.is_right_outer:
+                    for tup in right_tuples:
+                        yield self._pad_right(tup)
+                right_group = next(right_groups, None)
+
+        # whatever is left of either input is dangling
+        while left_group is not None:
+            if self.is_left_outer:
+                for tup in left_group[1]:
+                    yield self._pad_left(tup)
+            left_group = next(left_groups, None)
+        while right_group is not None:
+            if self.is_right_outer:
+                for tup in right_group[1]:
+                    yield self._pad_right(tup)
+            right_group = next(right_groups, None)
+
+    def _index_join_rows(self):
+        # an index nested loop join: each probe tuple looks up its matches in the index on the relation
+        build_left = self.left_child is self.build_index.relation
+        if build_left:
+            build_child, build_outer, pad_build = self.left_child, self.is_left_outer, self._pad_left
+            probe_child, probe_key, probe_outer, pad_probe = \
+                self.right_child, _key_getter(self.right_key_indices), self.is_right_outer, self._pad_right
+        else:
+            build_child, build_outer, pad_build = self.right_child, self.is_right_outer, self._pad_right
+            probe_child, probe_key, probe_outer, pad_probe = \
+                self.left_child, _key_getter(self.left_key_indices), self.is_left_outer, self._pad_left
+
+        build_tuples = build_child.tuples
+        lookup = self.build_index.positions.get
+        matched = set()
+
+        for probe_tuple in probe_child.rows():
+            matches = lookup(probe_key(probe_tuple))
+            if not matches:
+                if probe_outer:
+                    yield pad_probe(probe_tuple)
+                continue
+
+            if build_outer:
+                matched.update(matches)
+            if build_left:
+                probe_extra = self.right_extra(probe_tuple)
+                for build_index in matches:
+                    yield build_tuples[build_index] + probe_extra
+            else:
+                for build_index in matches:
+                    yield probe_tuple + self.right_extra(build_tuples[build_index])
+
+        if build_outer:
+            for i, tup in enumerate(build_tuples):
+                if i not in matched:
+                    yield pad_build(tup)
+
+    def _hash_join_rows(self):
+        # build the hash table on the smaller input and stream the larger one past it
+        build_left = self.build_left
+        if build_left is None:
+            build_left = self.left_child.estimated_cardinality() <= self.right_child.estimated_cardinality()
+        if build_left:
+            build_child, build_key_indices, build_outer, pad_build = \
+                self.left_child, self.left_key_indices, self.is_left_outer, self._pad_left
+            probe_child, probe_key_indices, probe_outer, pad_probe = \
+                self.right_child, self.right_key_indices, self.is_right_outer, self._pad_right
+        else:
+            build_child, build_key_indices, build_outer, pad_build = \
+                self.right_child, self.right_key_indices, self.is_right_outer, self._pad_right
+            probe_child, probe_key_indices, probe_outer, pad_probe = \
+                self.left_child, self.left_key_indices, self.is_left_outer, self._pad_left
+
+        build_key, probe_key = _key_getter(build_key_indices), _key_getter(probe_key_indices)
+        build_tuples = list(build_child.rows())
+        hash_table = {}
+        for i, tup in enumerate(build_tuples):
+            hash_table.setdefault(build_key(tup), []).append(i)
+
+        # when the right input is the build side, each build tuple's share of the output is cut out once
+        build_extras = None if build_left else map(self.right_extra, build_tuples)
+
+        # one match flag per build row, so an outer join can find its dangling build tuples without rescanning
+        build_matched = [False] * len(build_tuples)
+
+        for probe_tuple in probe_child.rows():
+            matches = hash_table.get(probe_key(probe_tuple))
+
+            # dangling probe tuples are known straight away
+            if not matches:
+                if probe_outer:
+                    yield pad_probe(probe_tuple)
+                continue
+
+            # output the joined tuples, excluding the right tuple's copy of the common attributes
+            if build_left:
+                probe_extra = self.right_extra(probe_tuple)
+                for build_index in matches:
+                    build_matched[build_index] = True
+                    yield build_tuples[build_index] + probe_extra
+            else:
+                for build_index in matches:
+                    build_matched[build_index] = True
+                    yield probe_tuple + build_extras[build_index]
+
+        # add any build tuples that weren't matched by the probe side
+        if build_outer:
+            for tup, matched in zip(build_tuples, build_matched):
+                if not matched:
+                    yield pad_build(tup)
+
+
+class ThetaJoinNode(PlanNode):
+    """
+    This node joins two inputs on an arbitrary predicate. Its output is that of a cartesian product of the inputs
+    filtered by the predicate, but the product is never built.
+    Equality conjuncts between an expression over the left input and one over the right input are evaluated as a hash
+    join. Without any, inequalities between expressions over each input, including bands such as
+    abs(a.t - b.t) < 5, are evaluated by sorting the right input and finding the matches of each left tuple by
+    bisection. Any other conjuncts are checked on the matching pairs of tuples only.
+    """
+    def __init__(self, left_child, right_child, predicate):
+        """
+        :param left_child: Plan Node: the left input
+        :param right_child: Plan Node: the right input
+        :param predicate: Expression: the join predicate, over the output schema. A raw predicate string is parsed here.
+        """
+        if isinstance(predicate, basestring):
+            predicate = ex.parse_expression(predicate)
+
+        self.left_child = left_child
+        self.right_child = right_child
+        self.predicate = predicate
+
+    def bind(self):
+        left_schema = self.left_child.bind()
+        right_schema = self.right_child.bind()
+
+        # the schema is that of the cartesian product of the inputs
+        schema = ["%s.%s" % (self.left_child.name, column) for column in left_schema]
+        schema.extend(["%s.%s" % (self.right_child.name, column) for column in right_schema])
+        self.schema = Schema(schema)
+        self.name = "%s_%s" % (self.left_child.name, self.right_child.name)
+
+        # expressions over a single input are compiled against its part of the schema
+        self.split = len(left_schema)
+        left_part, right_part = Schema(self.schema[:self.split]), Schema(self.schema[self.split:])
+
+        # conjuncts comparing an expression over each input become lists of (left expression, operator, right
+        # expression) conditions; the conditions of other conjuncts are None
+        conjuncts = [(conjunct, self._conditions(conjunct)) for conjunct in ex.split_conjuncts(self.predicate)]
+        equalities = [condition for conjunct, conditions in conjuncts if conditions
+                      for condition in conditions if condition[1] == "=="]
+
+        self.left_keys = self.right_keys = self.right_value = None
+        self.bound_kinds = []
+        if equalities:
+            enforced = [conjunct for conjunct, conditions in conjuncts
+                        if conditions and all(comparison == "==" for left, comparison, right in conditions)]
+            self.left_keys = ex.compile_row_builder([left for left, comparison, right in equalities], left_part)
+            self.right_keys = ex.compile_row_builder([right for left, comparison, right in equalities], right_part)
+        else:
+            # the right input is sorted on the right expression bounded by the most conditions, counting the conjuncts
+            # which only bound that expression
+            bounded = dict((conjunct, str(conditions[0][2])) for conjunct, conditions in conjuncts if conditions and
+                           len(set(str(right) for left, comparison, right in conditions)) == 1)
+            ranges = Counter()
+            for conjunct, conditions in conjuncts:
+                if conjunct in bounded:
+                    ranges[bounded[conjunct]] += len(conditions)
+            enforced = []
+            if ranges:
+                sort_key = ranges.most_common(1)[0][0]
+                enforced = [conjunct for conjunct, conditions in conjuncts if bounded.get(conjunct) == sort_key]
+                bounds = [condition for conjunct, conditions in conjuncts if conjunct in enforced
+                          for condition in conditions]
+                self.right_value = ex.compile_expression(bounds[0][2], right_part)
+                self.bound_values = ex.compile_row_builder([left for left, comparison, right in bounds], left_part)
+                # for each bound, whether it is a lower bound on the right expression and whether it is inclusive
+                self.bound_kinds = [(comparison in ("<", "<="), comparison in ("<=", ">="))
+                                    for left, comparison, right in bounds]
+
+        residual = [conjunct for conjunct, conditions in conjuncts if conjunct not in enforced]
+        self.residual_function = ex.compile_expression(ex.conjunction(residual), self.schema) if residual else None
+
+        self.bound = True
+        return self.schema
+
+    def _side(self, expression):
+        """
+        :return: "left" or "right" if an expression only references attributes of that input, otherwise None
+        """
+        positions = [self.schema.position(column) for column in expression.columns()]
+        if positions and max(positions) < self.split:
+            return "left"
+        if positions and min(positions) >= self.split:
+            return "right"
+        return None
+
+    def _conditions(self, conjunct):
+        """
+        Rewrites a conjunct as comparisons between an expression over the left input and one over the right input
+        :return: List of (left expression, operator, right expression) triples, all of which hold exactly when the
+            conjunct does, or None if the conjunct can't be rewritten
+        """
+        if not isinstance(conjunct, ex.Comparison):
+            return None
+
+        # a band, abs(x - y) < d, holds when y lies strictly between x - d and x + d
+        if len(conjunct.operators) == 1 and conjunct.operators[0] in ("<", "<=", ">", ">="):
+            comparison, (difference, width) = conjunct.operators[0], conjunct.operands
+            if comparison in (">", ">="):
+                comparison, width, difference = _SWAPPED_COMPARISONS[comparison], difference, width
+            if comparison in ("<", "<=") and not width.columns() and isinstance(difference, ex.FunctionCall) and \
+                    difference.function_name == "abs" and len(difference.arguments) == 1 and \
+                    isinstance(difference.arguments[0], ex.BinaryOperation) and \
+                    difference.arguments[0].operator == "-" and len(difference.arguments[0].operands) == 2:
+                x, y = difference.arguments[0].operands
+                if self._side(x) == "right" and self._side(y) == "left":
+                    x, y = y, x
+                if self._side(x) == "left" and self._side(y) == "right":
+                    return [(ex.BinaryOperation("-", [x, width]), comparison, y),
+                            (ex.BinaryOperation("+", [x, width]), _SWAPPED_COMPARISONS[comparison], y)]
+
+        # a chained comparison holds when each of its comparisons does
+        conditions = []
+        for comparison, first, second in zip(conjunct.operators, conjunct.operands, conjunct.operands[1:]):
+            if comparison not in _SWAPPED_COMPARISONS or comparison == "!=":
+                return None
+            sides = self._side(first), self._side(second)
+            if sides == ("left", "right"):
+                conditions.append((first, comparison, second))
+            elif sides == ("right", "left"):
+                conditions.append((second, _SWAPPED_COMPARISONS[comparison], first))
+            else:
+                return None
+        return conditions
+
+    def estimated_cardinality(self):
+        if self.left_keys is not None:
+            return max(self.left_child.estimated_cardinality(), self.right_child.estimated_cardinality())
+        return self.left_child.estimated_cardinality() * self.right_child.estimated_cardinality()
+
+    def fingerprint(self):
+        return "theta join", str(self.predicate), _parameter_key([self.predicate]), self.left_child.fingerprint(), \
+            self.right_child.fingerprint()
+
+    def rows(self):
+        if self.left_keys is not None:
+            return self._hash_join_rows()
+        if self.bound_kinds:
+            return self._range_join_rows()
+        return self._nested_loop_rows()
+
+    def _matches(self, left_tuple, right_tuples):
+        check = self.residual_function
+        for right_tuple in right_tuples:
+            tup = left_tuple + right_tuple
+            if check is None or check(tup):
+                yield tup
+
+    def _hash_join_rows(self):
+        # the right input is hashed on its equality expressions, and the left input is streamed past it
+        table = {}
+        for tup in self.right_child.rows():
+            table.setdefault(self.right_keys(tup), []).append(tup)
+
+        for left_tuple in self.left_child.rows():
+            for tup in self._matches(left_tuple, table.get(self.left_keys(left_tuple), ())):
+                yield tup
+
+    def _range_join_rows(self):
+        # the right input is sorted on its bounded expression; the bounds each left tuple puts on the expression then
+        # select a contiguous run of it
+        entries = sorted(((self.right_value(tup), tup) for tup in self.right_child.rows()), key=operator.itemgetter(0))
+        values = [value for value, tup in entries]
+        right_tuples = [tup for value, tup in entries]
+
+        for left_tuple in self.left_child.rows():
+            start, end = 0, len(values)
+            for value, (is_lower, inclusive) in zip(self.bound_values(left_tuple), self.bound_kinds):
+                if is_lower:
+                    start = max(start, (bisect.bisect_left if inclusive else bisect.bisect_right)(values, value))
+                else:
+                    end = min(end, (bisect.bisect_right if inclusive else bisect.bisect_left)(values, value))
+            for tup in self._matches(left_tuple, itertools.islice(right_tuples, start, max(start, end))):
+                yield tup
+
+    def _nested_loop_rows(self):
+        right_tuples = list(self.right_child.rows())
+        for left_tuple in self.left_child.rows():
+            for tup in self._matches(left_tuple, right_tuples):
+                yield tup
 
 
 class ProjectNode(PlanNode):
-    def __init__(self, schema, left_child, projections, args_lists):
+    def __init__(self, schema, left_child, projections, args_lists, name=None):
         """
 
         :param schema: List of strings: The output schema
         :param left_child: Plan node: the left child
-        :param projections: List of strings: the projection strings
-        :param args_lists: List of lists of strings: the arguments to each projection
+        :param projections: List of Expressions: the parsed projections. Raw projection strings are parsed here.
+        :param args_lists: List of lists of strings: the attributes referenced by each projection
+        :param name: string, the name of the output. By default it's the name of the child.
         """
 
         if len(schema) != len(projections) or len(schema) != len(args_lists):
             sys.exit("Invalid projection")
 
-        self.schema = schema
+        self.schema = Schema(schema)
         self.left_child = left_child
-        self.projections = projections
+        self.projections = [ex.parse_expression(projection) if isinstance(projection, basestring) else projection
+                            for projection in projections]
         self.args_lists = args_lists
+        self.output_name = name
+
+    def bind(self):
+        # the whole projection list is compiled into one row building function for the schema of the child
+        left_schema = self.left_child.bind()
+        self.row_builder = ex.compile_row_builder(self.projections, left_schema)
+
+        # over a columnar relation, a second builder reads just the referenced columns
+        self.column_positions = None
+        referenced = [attribute for projection in self.projections for attribute in projection.columns()]
+        if isinstance(self.left_child, ColumnarRelation) and referenced:
+            self.column_positions, column_schema = _column_subset(left_schema, referenced)
+            self.column_row_builder = ex.compile_row_builder(self.projections, column_schema)
+
+        # the output keeps the order of the input for as long as the sort attributes are projected unchanged
+        outputs = dict((left_schema[left_schema.position(projection.name)], name)
+                       for name, projection in zip(self.schema, self.projections) if isinstance(projection, ex.Column))
+        sorted_on = []
+        for attribute, descending in self.left_child.sorted_on:
+            if attribute not in outputs:
+                break
+            sorted_on.append((outputs[attribute], descending))
+        self.sorted_on = sorted_on
+
+        self.name = self.output_name or self.left_child.name
+        self.bound = True
+        return self.schema
+
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality()
+
+    def fingerprint(self):
+        return "project", tuple(self.schema), tuple(str(projection) for projection in self.projections), \
+            _parameter_key(self.projections), self.left_child.fingerprint()
+
+    def rows(self):
+        if self.column_positions is not None:
+            return itertools.imap(self.column_row_builder, self.left_child.column_rows(self.column_positions))
+        return itertools.imap(self.row_builder, self.left_child.rows())
 
-    def execute(self):
-        left_relation = self.left_child.execute()
-        out_relation = Relation(self.schema, [], left_relation.name)
 
-        # perform the projection for every tuple
-        for in_tuple in left_relation.tuples:
-            out_tuple = []
+class SelectNode(PlanNode):
+    def __init__(self, predicate, args, left_child):
+        """
+        :param predicate: Expression: the parsed select predicate. A raw predicate string is parsed here.
+        :param args: List of strings: the attributes referenced by the predicate
+        :param left_child: Plan Node: the child node
+        """
+        if isinstance(predicate, basestring):
+            predicate = ex.parse_expression(predicate)
 
-            # iterate through every projection in the input
-            for attribute, projection, args in zip(self.schema, self.projections, self.args_lists):
+        self.predicate = predicate
+        self.args = args
+        self.left_child = left_child
 
-                # iterate through every argument in the projection, replacing it with the tuple's attribute value
-                for arg in args:
+    def bind(self):
+        # the predicate is compiled once for the schema of the child, then reused for every tuple
+        self.schema = self.left_child.bind()
+        self.predicate_function = ex.compile_expression(self.predicate, self.schema)
 
-                    # regex checks for numbers, which must not be enclosed in quotes for exec
-                    if re.match("[-+]?[0-9]*\.?[0-9]+", str(left_relation.attribute_value(arg, in_tuple))):
-                        exec("%s = %s" % (arg, left_relation.attribute_value(arg, in_tuple)))
+        # over a columnar relation, the predicate is evaluated on just the columns it references
+        self.column_positions = None
+        if isinstance(self.left_child, ColumnarRelation) and self.predicate.columns():
+            self.column_positions, column_schema = _column_subset(self.schema, self.predicate.columns())
+            self.column_predicate_function = ex.compile_expression(self.predicate, column_schema)
 
-                    # but strings do need to be enclosed in quotes
-                    else:
-                        exec("%s = '%s'" % (arg, left_relation.attribute_value(arg, in_tuple)))
+        self.sorted_on = self.left_child.sorted_on
+        self.name = self.left_child.name
+        self.bound = True
+        return self.schema
 
-                # evaluate the projection and add it to the output tuple
-                out_tuple.append(eval(projection))
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality()
 
-            out_relation.tuples.append(out_tuple)
+    def fingerprint(self):
+        return "select", str(self.predicate), _parameter_key([self.predicate]), self.left_child.fingerprint()
 
-        return out_relation
+    def rows(self):
+        if self.column_positions is not None:
+            # only the tuples which match are read in full
+            matches = itertools.imap(self.column_predicate_function, self.left_child.column_rows(self.column_positions))
+            return itertools.imap(self.left_child.row, itertools.compress(itertools.count(), matches))
+        return itertools.ifilter(self.predicate_function, self.left_child.rows())
 
 
-class SelectNode(PlanNode):
-    def __init__(self, predicate, args, left_child):
+class IndexScanNode(PlanNode):
+    """
+    This node reads the tuples of a relation which satisfy an equality or range condition on an indexed attribute,
+    finding them through the index instead of scanning the whole relation.
+    """
+    def __init__(self, index, equal=None, low=None, high=None):
+        """
+        :param index: HashIndex or SortedIndex: the index to search. Range conditions need a SortedIndex.
+        :param equal: Expression: a constant or parameter the attribute must equal; None for a range condition
+        :param low: (Expression, Boolean) pair: a constant or parameter lower bound on the attribute, and True if the
+            bound is inclusive; None for no lower bound
+        :param high: (Expression, Boolean) pair: the upper bound on the attribute; None for no upper bound
+        """
+        self.index = index
+        self.left_child = index.relation
+        self.equal = equal
+        self.low = low
+        self.high = high
+
+    def _expressions(self):
+        return [bound for bound in (self.equal, self.low and self.low[0], self.high and self.high[0]) if bound]
+
+    def bind(self):
+        # the bounds don't read any attributes, so they are compiled into functions of an empty row
+        empty = Schema()
+        self.equal_function = ex.compile_expression(self.equal, empty) if self.equal is not None else None
+        self.low_function = ex.compile_expression(self.low[0], empty) if self.low is not None else None
+        self.high_function = ex.compile_expression(self.high[0], empty) if self.high is not None else None
+
+        self.schema = self.left_child.bind()
+        self.name = self.left_child.name
+
+        # a range scan reads the tuples in the order of the sorted index; a lookup keeps the order of the relation
+        if self.equal is None:
+            self.sorted_on = [(self.index.attribute, False)]
+        else:
+            self.sorted_on = self.left_child.sorted_on
+
+        self.bound = True
+        return self.schema
+
+    def estimated_cardinality(self):
+        size = self.left_child.estimated_cardinality()
+        if self.equal is not None:
+            return size / max(self.index.distinct_count, 1)
+        return size / 3
+
+    def fingerprint(self):
+        bounds = (str(self.equal), self.low and (str(self.low[0]), self.low[1]),
+                  self.high and (str(self.high[0]), self.high[1]))
+        return "index scan", self.index.kind, self.index.attribute, bounds, _parameter_key(self._expressions()), \
+            self.left_child.fingerprint()
+
+    def rows(self):
+        if self.equal_function is not None:
+            positions = self.index.lookup(self.equal_function(()))
+        else:
+            low = (self.low_function(()), self.low[1]) if self.low is not None else None
+            high = (self.high_function(()), self.high[1]) if self.high is not None else None
+            positions = self.index.range(low, high)
+        return itertools.imap(self.left_child.tuples.__getitem__, positions)
+
+
+class SortNode(PlanNode):
+    """
+    This node outputs the tuples of its child ordered on a list of attributes.
+    """
+    def __init__(self, left_child, sort_attributes):
         """
-        :param predicate: String: the raw select predicate
-        :param args: List of strings: the arguments to the predicate
         :param left_child: Plan Node: the child node
+        :param sort_attributes: List of (attribute, descending) pairs: the attributes to order on, most significant
+            first, and True for each attribute sorted in descending order
         """
-        self.predicate = predicate
-        self.args = args
         self.left_child = left_child
+        self.sort_attributes = list(sort_attributes)
 
-    def execute(self):
-        left_relation = self.left_child.execute()
-        out_relation = Relation(left_relation.schema, [], left_relation.name)
-
-        for tup in left_relation.tuples:
+    def bind(self):
+        self.schema = self.left_child.bind()
+        self.sort_indices = [self.schema.position(attribute) for attribute, descending in self.sort_attributes]
+        self.sorted_on = [(self.schema[i], descending)
+                          for i, (attribute, descending) in zip(self.sort_indices, self.sort_attributes)]
+        self.name = self.left_child.name
+        self.bound = True
+        return self.schema
 
-            # replace all the arguments with the corresponding attribute value for the current tuple
-            for arg in self.args:
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality()
 
-                # regex checks for numbers, which must not be enclosed in quotes for exec
-                if re.match("[-+]?[0-9]*\.?[0-9]+", str(left_relation.attribute_value(arg, tup))):
-                    exec("%s = %s" % (arg, left_relation.attribute_value(arg, tup)))
+    def fingerprint(self):
+        return "sort", tuple(self.sorted_on), self.left_child.fingerprint()
 
-                # strings must not be enclosed in quotes
-                else:
-                    exec("%s = '%s'" % (arg, left_relation.attribute_value(arg, tup)))
+    def rows(self):
+        tuples = list(self.left_child.rows())
 
-            # with the correct arguments assigned, evaluate the predicate
-            if eval(self.predicate):
-                out_relation.tuples.append(tup)
+        # python's sort is stable, so sorting on each attribute from the least significant up orders on all of them
+        for i, (attribute, descending) in reversed(zip(self.sort_indices, self.sort_attributes)):
+            tuples.sort(key=operator.itemgetter(i), reverse=descending)
+        return iter(tuples)
 
-        return out_relation
 
+class SetOperationNode(PlanNode):
+    """
+    Abstract class for the union, intersection and set difference nodes.
+    Membership is checked against a hash table built over the smaller input, with each tuple hashed as a python tuple.
+    When distinct is True the output has set semantics (no duplicate tuples), otherwise it has bag semantics and
+    no deduplication is done at all.
+    """
+    __metaclass__ = ABCMeta
 
-class UnionNode(PlanNode):
-    def __init__(self, left_child, right_child):
+    def __init__(self, left_child, right_child, distinct=True):
+        """
+        :param left_child: Plan Node: the left child
+        :param right_child: Plan Node: the right child
+        :param distinct: Boolean: True for set semantics, False for bag semantics
+        """
         self.left_child = left_child
         self.right_child = right_child
+        self.distinct = distinct
 
-    def execute(self):
-        left_relation = self.left_child.execute()
-        right_relation = self.right_child.execute()
-        assert (left_relation.schema == right_relation.schema)
+    def bind(self):
+        left_schema = self.left_child.bind()
+        right_schema = self.right_child.bind()
 
-        out_relation = Relation(left_relation.schema, [], "%s_%s" % (left_relation.name, right_relation.name))
-        out_relation.tuples += left_relation.tuples
+        assert (left_schema == right_schema)
 
-        # add the tuples from the right relation that haven't already been added
-        out_relation.tuples += [tuple for tuple in right_relation.tuples if tuple not in left_relation.tuples]
-        return out_relation
+        self.schema = left_schema
+        self.name = "%s_%s" % (self.left_child.name, self.right_child.name)
+        self.bound = True
+        return self.schema
 
+    def fingerprint(self):
+        return self.__class__.__name__, self.distinct, self.left_child.fingerprint(), self.right_child.fingerprint()
 
-class IntersectionNode(PlanNode):
-    def __init__(self, left_child, right_child):
-        self.left_child = left_child
-        self.right_child = right_child
+    def left_is_smaller(self):
+        return self.left_child.estimated_cardinality() <= self.right_child.estimated_cardinality()
 
-    def execute(self):
-        left_relation = self.left_child.execute()
-        right_relation = self.right_child.execute()
 
-        assert (left_relation.schema == right_relation.schema)
+class UnionNode(SetOperationNode):
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality() + self.right_child.estimated_cardinality()
+
+    def rows(self):
+        # bag union is a plain concatenation
+        if not self.distinct:
+            return itertools.chain(self.left_child.rows(), self.right_child.rows())
+        return self._distinct_rows()
+
+    def _distinct_rows(self):
+        # only output the tuples that haven't already been output
+        seen = set()
+        for tup in itertools.chain(self.left_child.rows(), self.right_child.rows()):
+            if tup not in seen:
+                seen.add(tup)
+                yield tup
+
+
+class IntersectionNode(SetOperationNode):
+    def estimated_cardinality(self):
+        return min(self.left_child.estimated_cardinality(), self.right_child.estimated_cardinality())
+
+    def rows(self):
+        # count the tuples of the smaller input, then stream the larger one against the counts
+        if self.left_is_smaller():
+            build_child, probe_child = self.left_child, self.right_child
+        else:
+            build_child, probe_child = self.right_child, self.left_child
+        counts = Counter(build_child.rows())
+
+        # each match uses up one copy of the tuple; under set semantics a match uses up every copy
+        for tup in probe_child.rows():
+            if counts.get(tup, 0) > 0:
+                if self.distinct:
+                    del counts[tup]
+                else:
+                    counts[tup] -= 1
+                yield tup
 
-        out_relation = Relation(left_relation.schema, [], "%s_%s" % (left_relation.name, right_relation.name))
 
-        # add the tuples from the left relation that are also in the right relation
-        out_relation.tuples += [tuple for tuple in left_relation.tuples if tuple in right_relation.tuples]
-        return out_relation
+class SetDifferenceNode(SetOperationNode):
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality()
 
-class SetDifferenceNode(PlanNode):
+    def rows(self):
+        # under bag semantics each right tuple removes one copy of the matching left tuple
+        if not self.left_is_smaller():
+            left_tuples = self.left_child.rows()
+            removals = Counter(self.right_child.rows())
+        else:
+            # the left input is smaller, so only count the right tuples which can actually remove something
+            left_tuples = list(self.left_child.rows())
+            left_counts = Counter(left_tuples)
+            removals = Counter()
+            for tup in self.right_child.rows():
+                if removals[tup] < left_counts.get(tup, 0):
+                    removals[tup] += 1
+
+        seen = set()
+        for tup in left_tuples:
+            if self.distinct:
+                if tup not in removals and tup not in seen:
+                    seen.add(tup)
+                    yield tup
+            elif removals.get(tup, 0) > 0:
+                removals[tup] -= 1
+            else:
+                yield tup
+
+
+class DivisionNode(PlanNode):
+    """
+    This node divides its left input by its right input. The schema of the right input (the divisor) must be part of
+    the schema of the left input (the dividend), and the output is every distinct combination of the remaining left
+    attributes (a quotient) which appears in the left input alongside every tuple of the divisor.
+    Rather than rewriting the division into products and set differences, the distinct divisor tuples are hashed, and
+    the divisor tuples seen with each quotient are collected in one pass over the left input.
+    """
     def __init__(self, left_child, right_child):
+        """
+        :param left_child: Plan Node: the dividend
+        :param right_child: Plan Node: the divisor
+        """
         self.left_child = left_child
         self.right_child = right_child
 
-    def execute(self):
-        left_relation = self.left_child.execute()
-        right_relation = self.right_child.execute()
+    def bind(self):
+        left_schema = self.left_child.bind()
+        right_schema = self.right_child.bind()
+
+        for attribute in right_schema:
+            if attribute not in left_schema:
+                sys.exit("Divisor attribute %s could not be found in the dividend schema" % attribute)
+
+        # the divisor part of a left tuple is read in the attribute order of the divisor
+        self.divisor_key = _tuple_getter([left_schema.index(attribute) for attribute in right_schema])
+        quotient_indices = [i for i, attribute in enumerate(left_schema) if attribute not in right_schema]
+        self.quotient_key = _tuple_getter(quotient_indices)
 
-        assert (left_relation.schema == right_relation.schema)
+        self.schema = Schema([left_schema[i] for i in quotient_indices])
+        self.name = "%s_%s" % (self.left_child.name, self.right_child.name)
+        self.bound = True
+        return self.schema
 
-        out_relation = Relation(left_relation.schema, [], "%s_%s" % (left_relation.name, right_relation.name))
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality()
+
+    def fingerprint(self):
+        return "division", self.left_child.fingerprint(), self.right_child.fingerprint()
+
+    def rows(self):
+        divisor = set(tuple(tup) for tup in self.right_child.rows())
+
+        # the divisor tuples each quotient has been seen with, keyed on the quotient, in order of first appearance
+        quotients = {}
+        order = []
+        for tup in self.left_child.rows():
+            quotient = self.quotient_key(tup)
+            seen = quotients.get(quotient)
+            if seen is None:
+                seen = quotients[quotient] = set()
+                order.append(quotient)
+            key = self.divisor_key(tup)
+            if key in divisor:
+                seen.add(key)
+
+        required = len(divisor)
+        return (quotient for quotient in order if len(quotients[quotient]) == required)
 
-        # add the tuples from the left relation that are not in the right relation
-        out_relation.tuples += [tuple for tuple in left_relation.tuples if tuple not in right_relation.tuples]
-        return out_relation
 
 class AggregationNode(PlanNode):
-    def __init__(self, left_child, grouping_attribute, aggregation):
+    def __init__(self, left_child, grouping_attributes, aggregations, input_sorted=False):
         """
         :param left_child: Plan Node: The child node
-        :param grouping_attribute: String: the attribute to be grouped on.
-        :param aggregation: Aggregation: See above object definition
+        :param grouping_attributes: List of strings: the attributes to be grouped on. A single string is also accepted.
+        :param aggregations: List of Aggregations: See above object definition. A single Aggregation is also accepted.
+        :param input_sorted: Boolean: True if the input is already ordered on the grouping attributes, in which case
+            each group is aggregated and emitted as soon as it ends instead of being kept in a hash table
         """
-        self.left_child = left_child
-        self.aggregation = aggregation
-        self.grouping_attribute = grouping_attribute
-
-    def execute(self):
-        left_relation = self.left_child.execute()
-        out_relation = Relation([], [], left_relation.name)
-
+        if isinstance(grouping_attributes, basestring):
+            grouping_attributes = [grouping_attributes]
+        if isinstance(aggregations, Aggregation):
+            aggregations = [aggregations]
 
-        # simple aggregation case: just apply the aggregation function to the entire tuple set
-        if not self.grouping_attribute:
-            out_relation.schema = [self.aggregation.result_name]
-            out_relation.tuples.append([self.aggregation.agg_function(self, left_relation, self.aggregation.attribute)])
-
-        # make sure we have a valid grouping attribute
-        elif self.grouping_attribute not in left_relation.schema:
-            sys.exit("invalid grouping attribute given")
+        self.left_child = left_child
+        self.grouping_attributes = list(grouping_attributes or [])
+        self.aggregations = aggregations
+        self.input_sorted = input_sorted
+
+    def bind(self):
+        left_schema = self.left_child.bind()
+        self.group_indices = [left_schema.position(attribute) for attribute in self.grouping_attributes]
+        self.value_indices = [left_schema.position(aggregation.attribute) for aggregation in self.aggregations]
+
+        # over a columnar relation, only the grouping and aggregated columns are read
+        self.column_positions = None
+        if isinstance(self.left_child, ColumnarRelation) and self.group_indices + self.value_indices:
+            self.column_positions = sorted(set(self.group_indices + self.value_indices))
+            column_index = dict((position, i) for i, position in enumerate(self.column_positions))
+            self.column_group_indices = [column_index[i] for i in self.group_indices]
+            self.column_value_indices = [column_index[i] for i in self.value_indices]
+
+        self.schema = Schema(self.grouping_attributes + [aggregation.result_name for aggregation in self.aggregations])
+        self.name = self.left_child.name
+
+        # sorted input is aggregated one group at a time, so the groups come out in the order of the input
+        self.sorted_on = ()
+        if self.input_sorted and self.grouping_attributes:
+            group_names = set(left_schema[i] for i in self.group_indices)
+            prefix = self.left_child.sorted_on[:len(group_names)]
+            if set(attribute for attribute, descending in prefix) == group_names:
+                self.sorted_on = [(self.grouping_attributes[self.group_indices.index(left_schema.index(attribute))],
+                                   descending) for attribute, descending in prefix]
+
+        self.bound = True
+        return self.schema
+
+    def estimated_cardinality(self):
+        if not self.grouping_attributes:
+            return 1
+        return self.left_child.estimated_cardinality()
+
+    def fingerprint(self):
+        aggregations = tuple((aggregation.function_name, aggregation.attribute, aggregation.result_name)
+                             for aggregation in self.aggregations)
+        return "aggregation", tuple(self.grouping_attributes), aggregations, self.input_sorted, \
+            self.left_child.fingerprint()
+
+    def rows(self):
+        if self.column_positions is not None:
+            tuples = self.left_child.column_rows(self.column_positions)
+            group_indices, value_indices = self.column_group_indices, self.column_value_indices
+        else:
+            tuples = self.left_child.rows()
+            group_indices, value_indices = self.group_indices, self.value_indices
 
-        # here we have to iterate over each distinct attribute value and apply the aggregate function to each one
+        if self.input_sorted:
+            groups = self._sorted_groups(tuples, group_indices, value_indices)
         else:
-            out_relation.schema = [self.grouping_attribute, self.aggregation.result_name]
-            distinct_values = set([left_relation.attribute_value(self.grouping_attribute, tup) for tup in left_relation.tuples])
+            groups = self._hashed_groups(tuples, group_indices, value_indices)
+
+        empty = True
+        for key, states in groups:
+            empty = False
+            yield key + tuple([aggregation.final(state) for aggregation, state in zip(self.aggregations, states)])
 
-            for val in distinct_values:
-                temp_relation = Relation(self.left_child.schema, [], self.left_child.name)
-                temp_relation.tuples = [tup for tup in left_relation.tuples
-                                        if left_relation.attribute_value(self.grouping_attribute, tup) == val]
+        # simple aggregation case: an empty input still produces a single output tuple
+        if not self.grouping_attributes and empty:
+            yield tuple([aggregation.final(aggregation.initial_state) for aggregation in self.aggregations])
 
-                out_relation.tuples.append([val, self.aggregation.agg_function(self, temp_relation, self.aggregation.attribute)])
+    def _accumulate(self, states, tup, value_indices):
+        """
+        Folds the aggregated attribute values of a tuple into the running states of its group, skipping nulls
+        """
+        for i in range(len(states)):
+            value = tup[value_indices[i]]
+            if value is not None:
+                states[i] = self.aggregations[i].step(states[i], value)
 
-        return out_relation
+    def _hashed_groups(self, tuples, group_indices, value_indices):
+        """
+        Aggregates the input in a single pass, keeping the running states of every group in a hash table
+        :return: A list of (group key, aggregate states) pairs
+        """
+        group_key = _tuple_getter(group_indices)
+        groups = {}
+        for tup in tuples:
+            key = group_key(tup)
+            states = groups.get(key)
+            if states is None:
+                states = groups[key] = [aggregation.initial_state for aggregation in self.aggregations]
+            self._accumulate(states, tup, value_indices)
+        return groups.items()
+
+    def _sorted_groups(self, tuples, group_indices, value_indices):
+        """
+        Aggregates input ordered on the grouping attributes, holding the running states of one group at a time
+        :return: A generator of (group key, aggregate states) pairs
+        """
+        group_key = _tuple_getter(group_indices)
+        current_key = None
+        states = None
+        for tup in tuples:
+            key = group_key(tup)
+            if states is None or key != current_key:
+                if states is not None:
+                    yield current_key, states
+                current_key = key
+                states = [aggregation.initial_state for aggregation in self.aggregations]
+            self._accumulate(states, tup, value_indices)
+
+        if states is not None:
+            yield current_key, states
+
+
+class SpoolNode(PlanNode):
+    """
+    This node shares the output of one subplan between several consumers in the same plan.
+    The first consumer to read the spool runs the subplan once and keeps its tuples; every other consumer reads the
+    kept tuples, and they are released as soon as the last consumer has started reading them.
+    """
+    def __init__(self, left_child, consumers):
+        """
+        :param left_child: Plan Node: the shared subplan
+        :param consumers: int, the number of nodes in the plan reading the spool
+        """
+        self.left_child = left_child
+        self.consumers = consumers
+        self.tuples = None
+        self.remaining = 0
+
+    def bind(self):
+        self.schema = self.left_child.bind()
+        self.sorted_on = self.left_child.sorted_on
+        self.name = self.left_child.name
+        self.bound = True
+        return self.schema
+
+    def estimated_cardinality(self):
+        return self.left_child.estimated_cardinality()
+
+    def fingerprint(self):
+        return self.left_child.fingerprint()
+
+    def rows(self):
+        # each execution of the plan runs the subplan again, when its first consumer reads the spool
+        if self.tuples is None:
+            self.tuples = list(self.left_child.rows())
+            self.remaining = self.consumers
+
+        tuples = self.tuples
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.tuples = None
+        return iter(tuples)
@@ -1,15 +1,73 @@
+import array
+import os
+import tempfile
+
+import Expression as ex
+import Loader
+import Optimizer as op
+import Parallel
 import PlanNode as pn
+import Spill
+import Storage
+
+try:
+    import Vectorized
+except ImportError:
+    Vectorized = None
+
+# the engine the tests are currently being run with; None is the row engine
+engine = None
 
 # Runs a list of tests, printing the number of successes and the number of total tests
+# If numpy is available every test is run again with the vectorized engine, then every test is run again with the
+# parallel engine, partitioning even the smallest inputs, with the concurrent engine, and with the spill engine,
+# spilling every input
 def run_tests():
+    global engine
     total_tests = 0
     successes = 0
-    tests = [SetDifferenceTest, LeftOuterJoinTest, RightOuterJoinTest, UnionTest, \
-             IntersectionTest, CartesianProductTest, ProjectTest, SelectTest, SumTest, GroupedSumTest]
+    tests = [SetDifferenceTest, LeftOuterJoinTest, RightOuterJoinTest, FullOuterJoinTest, UnionTest, BagUnionTest, \
+             IntersectionTest, BagSetDifferenceTest, CartesianProductTest, ProjectTest, ComputedProjectTest, SelectTest, CompiledSelectTest, \
+             GuardedSelectTest, BooleanProjectTest, QualifiedSelectTest, \
+             UnknownAttributeTest, PushdownTest, AggregationPushdownTest, JoinOrderTest, JoinOrderNameTest, \
+             SharedSubplanTest, IndexScanTest, \
+             FailedSpoolTest, IndexJoinTest, MergeJoinTest, SortTest, SortedAggregationOrderTest, \
+             ThetaJoinTest, BandJoinTest, DivisionTest, SumTest, GroupedSumTest, StreamingTest, ColumnarSelectTest, \
+             ColumnarGroupingTest, StorageTest, EmptySchemaStorageTest, LoaderTest, TextLoaderTest, MalformedFileTest, \
+             MultipleGroupingTest, ManyGroupingAttributesTest, SortedGroupingTest]
     for t in tests:
         total_tests += 1
         successes += t()
 
+    if Vectorized is not None:
+        engine = Vectorized.VectorEngine(batch_size=2)
+        print "\nRunning every test again with the vectorized engine\n"
+        for t in tests:
+            total_tests += 1
+            successes += t()
+        engine = None
+
+    engine = Parallel.ParallelEngine(processes=2, min_parallel_rows=0)
+    print "\nRunning every test again with the parallel engine\n"
+    for t in tests:
+        total_tests += 1
+        successes += t()
+    engine.close()
+
+    engine = Parallel.ConcurrentEngine(parallelism=2)
+    print "\nRunning every test again with the concurrent engine\n"
+    for t in tests:
+        total_tests += 1
+        successes += t()
+    engine.close()
+
+    engine = Spill.SpillEngine(memory_budget=1, partitions=2)
+    print "\nRunning every test again with the spill engine\n"
+    for t in tests:
+        total_tests += 1
+        successes += t()
+    engine = None
+
     print "\nran %d tests" % total_tests
     print "passed %d tests" % successes
 
@@ -20,6 +78,7 @@ def test(test_name, node, expected_output):
     print "Expected output is: "
     expected_output.printOut()
     print "Actual output is: "
+    node.engine = engine
     output = node.execute()
     output.printOut()
     output.tuples.sort()
@@ -97,6 +156,22 @@ def UnionTest():
     test_node = pn.UnionNode(test_relation_1, test_relation_2)
     return test("Union Test 1", test_node, expected_output_relation)
 
+def BagUnionTest():
+    test_schema = ["a", "b"]
+    test_relation_1 = pn.Relation(test_schema, [[1, 2], [1, 2]], "test1")
+    test_relation_2 = pn.Relation(test_schema, [[1, 2], [3, 4]], "test2")
+    expected_output_relation = pn.Relation(test_schema, [[1, 2], [1, 2], [1, 2], [3, 4]], "expected_output")
+    test_node = pn.UnionNode(test_relation_1, test_relation_2, False)
+    return test("Bag Union Test 1", test_node, expected_output_relation)
+
+def BagSetDifferenceTest():
+    test_schema = ["a", "b"]
+    test_relation_1 = pn.Relation(test_schema, [[1, 2], [1, 2], [1, 2], [3, 4]], "test1")
+    test_relation_2 = pn.Relation(test_schema, [[1, 2], [5, 6]], "test2")
+    expected_output_relation = pn.Relation(test_schema, [[1, 2], [1, 2], [3, 4]], "expected_output")
+    test_node = pn.SetDifferenceNode(test_relation_1, test_relation_2, False)
+    return test("Bag Set Difference Test 1", test_node, expected_output_relation)
+
 def CartesianProductTest():
     test_schema_1 = ["a", "b"]
     test_schema_2 = ["c", "d"]
@@ -141,6 +216,17 @@ def RightOuterJoinTest():
     test_node = pn.NaturalJoinNode(test_relation_2, test_relation_1, False, True)
     return test("Right Outer Join Test 1", test_node, expected_output_relation)
 
+def FullOuterJoinTest():
+    test_schema_1 = ["a", "b", "c"]
+    test_schema_2 = ["c", "b", "d"]
+    test_relation_1 = pn.Relation(test_schema_1, [[1, 2, 3], [4, 2, 3], [7, 8, 9]], "test1")
+    test_relation_2 = pn.Relation(test_schema_2, [[3, 2, "x"], [3, 2, "y"], [0, 0, "z"]], "test2")
+    expected_output_relation = pn.Relation(["a", "b", "c", "d"], [[1, 2, 3, "x"], [1, 2, 3, "y"], [4, 2, 3, "x"],
+                                                                  [4, 2, 3, "y"], [7, 8, 9, None], [None, 0, 0, "z"]],
+                                           "expected_output")
+    test_node = pn.NaturalJoinNode(test_relation_1, test_relation_2, True, True)
+    return test("Full Outer Join Test 1", test_node, expected_output_relation)
+
 def ProjectTest():
     test_schema_1 = ["a", "b", "c"]
     project_schema = ["a", "c"]
@@ -153,6 +239,18 @@ def ProjectTest():
     return test("Generalized Project Test 1", test_node, expected_output_relation)
 
 
+def ComputedProjectTest():
+    test_schema_1 = ["name", "salary", "bonus"]
+    test_tuple_1 = ["Conan O'Brien", 100, 5]
+
+    test_relation_1 = pn.Relation(test_schema_1, [test_tuple_1], "test1")
+    expected_output_relation = pn.Relation(["salary", "name", "total"], [[110.00000000000001, "Conan O'Brien", 105]],
+                                           "expected_output")
+    test_node = pn.ProjectNode(["salary", "name", "total"], test_relation_1, ["salary * 1.1", "name", "salary + bonus"],
+                               [["salary"], ["name"], ["salary", "bonus"]])
+    return test("Generalized Project Test 2", test_node, expected_output_relation)
+
+
 def SelectTest():
     test_schema_1 = ["a", "b", "c"]
     test_tuple_1 = [1, 2, 1]
@@ -165,6 +263,418 @@ def SelectTest():
     return test("Select Test 1", test_node, expected_output_relation)
 
 
+def CompiledSelectTest():
+    test_schema_1 = ["name", "salary"]
+    test_tuple_1 = ["Conan O'Brien", 100]
+    test_tuple_2 = ["Conan O'Brien", 10]
+    test_tuple_3 = ["Jay Leno", 100]
+    predicate = "name == \"Conan O'Brien\" and not salary * 2 < 50"
+
+    test_relation_1 = pn.Relation(test_schema_1, [test_tuple_1, test_tuple_2, test_tuple_3], "test1")
+    expected_output_relation = pn.Relation(["name", "salary"], [test_tuple_1], "expected_output")
+    test_node = pn.SelectNode(predicate, ["name", "salary"], test_relation_1)
+    return test("Compiled Select Test 1", test_node, expected_output_relation)
+
+
+def GuardedSelectTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[4, 2], [3, 0], [5, None], [1, 1]], "test1")
+    expected_output_relation = pn.Relation(["a", "b"], [[4, 2]], "expected_output")
+
+    # the later conjuncts are only evaluated for rows the earlier ones select, so they never divide by zero or None
+    test_node = pn.SelectNode("b != None and b != 0 and a / b > 1", ["a", "b"], test_relation_1)
+    return test("Guarded Select Test 1", test_node, expected_output_relation)
+
+
+def BooleanProjectTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[3, 5], [0, 5], [3, None]], "test1")
+
+    # 'and' and 'or' evaluate to one of their operands, not to a boolean
+    expected_output_relation = pn.Relation(["c", "d"], [[3, 3], [5, 0], [3, None]], "expected_output")
+    test_node = pn.ProjectNode(["c", "d"], test_relation_1, ["a or b", "b and a"], [["a", "b"], ["b", "a"]])
+    return test("Boolean Project Test 1", test_node, expected_output_relation)
+
+
+def QualifiedSelectTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 2], [3, 4]], "t1")
+    test_relation_2 = pn.Relation(["a", "c"], [[1, 5], [3, 6]], "t2")
+    expected_output_relation = pn.Relation(["t1.a", "t1.b", "t2.a", "t2.c"], [[1, 2, 1, 5], [3, 4, 3, 6]],
+                                           "expected_output")
+    test_node = pn.SelectNode("t1.a == t2.a and c > b", ["t1.a", "t2.a", "c", "b"],
+                              pn.CartesianProductNode(test_relation_1, test_relation_2))
+    return test("Qualified Select Test 1", test_node, expected_output_relation)
+
+
+def UnknownAttributeTest():
+    print "Running test: Unknown Attribute Test 1"
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 2]], "test1")
+    test_node = pn.ProjectNode(["a"], pn.SelectNode("a == 1", ["a"], test_relation_1), ["z"], [["z"]])
+    try:
+        test_node.bind()
+    except SystemExit as e:
+        print "Binding failed as expected: %s\n" % e
+        return True
+    print "Binding should have failed.\n"
+    return False
+
+
+def PushdownTest():
+    test_relation_1 = pn.Relation(["a", "b", "x"], [[1, 2, "p"], [3, 4, "q"], [5, 2, "r"]], "test1")
+    test_relation_2 = pn.Relation(["b", "c", "y"], [[2, 10, "s"], [4, 20, "t"], [2, 30, "u"]], "test2")
+    expected_output_relation = pn.Relation(["a", "c"], [[1, 30], [5, 30]], "expected_output")
+    test_node = pn.ProjectNode(["a", "c"], pn.SelectNode("a > 0 and c > 25 and b == 2", ["a", "c", "b"],
+                                                         pn.NaturalJoinNode(test_relation_1, test_relation_2,
+                                                                            False, False)),
+                               ["a", "c"], [["a"], ["c"]])
+    test_node = op.Optimizer({}).optimize(test_node)
+
+    # every conjunct is evaluated below the join, and neither side carries its unused attribute through it
+    join_node = test_node.left_child
+    if not isinstance(join_node, pn.NaturalJoinNode) or join_node.left_child.schema != ["a", "b"] or \
+            join_node.right_child.schema != ["b", "c"]:
+        print "Running test: Pushdown Test 1"
+        print "The selection and projections were not pushed below the join.\n"
+        return False
+    return test("Pushdown Test 1", test_node, expected_output_relation)
+
+
+def AggregationPushdownTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 2], [5, 7]], "test1")
+    expected_output_relation = pn.Relation(["n"], [], "expected_output")
+
+    # a constant condition over an aggregation without grouping attributes must not be evaluated below it, where it
+    # would empty the input but leave the aggregation's single output tuple
+    def query():
+        return pn.SelectNode("1 == 0", [], pn.AggregationNode(test_relation_1, [], pn.Aggregation("count", "a", "n")))
+    unoptimized_node = query()
+    unoptimized_node.engine = engine
+    unoptimized_output = unoptimized_node.execute()
+    matches = test("Aggregation Pushdown Test 1", op.Optimizer({}).optimize(query()), expected_output_relation)
+    return matches and unoptimized_output.tuples == []
+
+
+def JoinOrderTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[i, i % 2] for i in range(30)], "test1")
+    test_relation_2 = pn.Relation(["b", "c"], [[i % 2, i] for i in range(30)], "test2")
+    test_relation_3 = pn.Relation(["a", "d"], [[0, "x"], [1, "y"]], "test3")
+    expected_output_relation = pn.Relation(["a", "b", "c", "d"], [[0, 0, i, "x"] for i in range(0, 30, 2)] +
+                                           [[1, 1, i, "y"] for i in range(1, 30, 2)], "expected_output")
+    test_node = pn.NaturalJoinNode(pn.NaturalJoinNode(test_relation_1, test_relation_2, False, False),
+                                   test_relation_3, False, False)
+    test_node = op.Optimizer({}).optimize(test_node)
+
+    # the small relation is joined first, and a projection restores the written attribute order
+    first_join = test_node.left_child.left_child
+    if first_join.left_child is not test_relation_1 or first_join.right_child is not test_relation_3:
+        print "Running test: Join Order Test 1"
+        print "The joins were not reordered.\n"
+        return False
+    return test("Join Order Test 1", test_node, expected_output_relation)
+
+
+def JoinOrderNameTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[i, i % 2] for i in range(30)], "test1")
+    test_relation_2 = pn.Relation(["b", "c"], [[i % 2, i] for i in range(30)], "test2")
+    test_relation_3 = pn.Relation(["a", "d"], [[0, "x"]], "test3")
+    test_relation_4 = pn.Relation(["e"], [[True]], "test4")
+    expected_output_relation = pn.Relation(["test1_test2_test3." + name for name in ["a", "b", "c", "d"]] +
+                                           ["test4.e"], [[0, 0, i, "x", True] for i in range(0, 30, 2)],
+                                           "expected_output")
+
+    # the product qualifies the attributes of the reordered joins with the name of the joins as written
+    def query():
+        return pn.CartesianProductNode(pn.NaturalJoinNode(pn.NaturalJoinNode(test_relation_1, test_relation_2,
+                                                                             False, False),
+                                                          test_relation_3, False, False), test_relation_4)
+    unoptimized_node = query()
+    unoptimized_node.bind()
+    test_node = op.Optimizer({}).optimize(query())
+    return test("Join Order Name Test 1", test_node, expected_output_relation) and \
+        test_node.schema == unoptimized_node.schema
+
+
+def SharedSubplanTest():
+    class CountingRelation(pn.Relation):
+        pulled = 0
+
+        def rows(self):
+            for tup in self.tuples:
+                self.pulled += 1
+                yield tup
+
+    test_relation_1 = CountingRelation(["a", "b"], [[1, 2], [2, 2], [3, 4], [4, 5]], "test1")
+    test_relation_2 = pn.Relation(["b", "c"], [[2, "x"], [4, "y"]], "test2")
+    expected_output_relation = pn.Relation(["a", "c"], [[1, "x"], [2, "x"], [3, "y"]], "expected_output")
+
+    # both branches of the union read the same join, which should only be evaluated once
+    branches = [pn.SelectNode(predicate, ["a"], pn.NaturalJoinNode(test_relation_1, test_relation_2, False, False))
+                for predicate in ("a < 2", "a >= 2")]
+    test_node = op.Optimizer({}).optimize(pn.UnionNode(*[pn.ProjectNode(["a", "c"], branch, ["a", "c"],
+                                                                         [["a"], ["c"]]) for branch in branches]))
+    matches = test("Shared Subplan Test 1", test_node, expected_output_relation)
+    print "The shared join pulled %d input tuples\n" % test_relation_1.pulled
+    return matches and test_relation_1.pulled == 4
+
+
+def IndexScanTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[i % 10, i] for i in range(50)], "test1")
+    index = pn.SortedIndex(test_relation_1, "a")
+    expected_output_relation = pn.Relation(["a", "b"], [[a, b] for a, b in test_relation_1.tuples if 3 < a <= 5],
+                                           "expected_output")
+    test_node = pn.IndexScanNode(index, low=(ex.Literal(3), False), high=(ex.Literal(5), True))
+    return test("Index Scan Test 1", test_node, expected_output_relation)
+
+
+def FailedSpoolTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 0], [2, 0]], "test1")
+    expected_output_relation = pn.Relation(["test1.a", "test1.x"], [[3, 1], [3, 2], [4, 1], [4, 2]], "expected_output")
+
+    # both inputs of the product read the same selection, and the first execution fails after it has been spooled
+    branches = [pn.SelectNode("a > 0", ["a"], test_relation_1) for _ in range(2)]
+    test_node = op.Optimizer({}).optimize(pn.CartesianProductNode(
+        pn.ProjectNode(["a"], branches[0], ["a"], [["a"]]),
+        pn.ProjectNode(["x"], branches[1], ["a / b"], [["a", "b"]])))
+    test_node.engine = engine
+    try:
+        test_node.execute()
+        print "The first execution didn't fail"
+        return False
+    except ZeroDivisionError:
+        print "The first execution failed as expected"
+
+    test_relation_1.tuples = [(3, 3), (4, 2)]
+    return test("Failed Spool Test 1", test_node, expected_output_relation)
+
+
+def IndexJoinTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 2], [3, 4], [5, 4]], "test1")
+    test_relation_2 = pn.Relation(["b", "c"], [[4, "x"], [4, "y"], [6, "z"]], "test2")
+    expected_output_relation = pn.Relation(["a", "b", "c"], [[3, 4, "x"], [3, 4, "y"], [5, 4, "x"], [5, 4, "y"],
+                                                             [1, 2, None]], "expected_output")
+    test_node = pn.NaturalJoinNode(test_relation_1, test_relation_2, True, False)
+    test_node.build_index = pn.HashIndex(test_relation_2, "b")
+    return test("Index Join Test 1", test_node, expected_output_relation)
+
+
+def MergeJoinTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 2], [3, 4], [5, 4], [7, 8]], "test1")
+    test_relation_2 = pn.Relation(["b", "c"], [[6, "z"], [4, "x"], [8, "w"], [4, "y"]], "test2")
+    expected_output_relation = pn.Relation(["a", "b", "c"], [[3, 4, "x"], [3, 4, "y"], [5, 4, "x"], [5, 4, "y"],
+                                                             [7, 8, "w"], [1, 2, None], [None, 6, "z"]],
+                                           "expected_output")
+    test_node = pn.NaturalJoinNode(pn.SortNode(test_relation_1, [("b", False)]),
+                                   pn.SortNode(test_relation_2, [("b", False)]), True, True)
+    test_node = op.Optimizer({}).optimize(test_node)
+    if not test_node.merge:
+        print "Merge Join Test 1 did not choose a merge join\n"
+        return False
+    return test("Merge Join Test 1", test_node, expected_output_relation)
+
+
+def SortTest():
+    print "Running test: Sort Test 1"
+    test_relation_1 = pn.Relation(["a", "b"], [[1, "x"], [3, "y"], [2, "x"], [4, "y"]], "test1")
+    test_node = pn.SortNode(pn.SortNode(test_relation_1, [("b", True), ("a", False)]), [("b", True)])
+    test_node = op.Optimizer({}).optimize(test_node)
+    test_node.engine = engine
+    output = test_node.execute()
+    output.printOut()
+
+    # the outer sort is redundant, since its input is already ordered on b
+    expected_tuples = [(3, "y"), (4, "y"), (1, "x"), (2, "x")]
+    if [tuple(tup) for tup in output.tuples] == expected_tuples and not isinstance(test_node.left_child, pn.SortNode):
+        print "The outputs match!\n"
+        return True
+    print "The outputs do not match.\n"
+    return False
+
+
+def SortedAggregationOrderTest():
+    print "Running test: Sorted Aggregation Order Test 1"
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 2], [3, 4], [2, 1], [3, 5], [1, 7]], "test1")
+    test_aggregation = pn.Aggregation("sum", "b", "sum_b")
+    test_node = pn.SortNode(pn.AggregationNode(pn.SortNode(test_relation_1, [("a", True)]), ["a"], test_aggregation),
+                            [("a", True)])
+    test_node = op.Optimizer({}).optimize(test_node)
+    test_node.engine = engine
+    output = test_node.execute()
+    output.printOut()
+
+    # the outer sort is dropped, so every engine must output the groups in the order of its sorted input
+    expected_tuples = [(3, 9), (2, 1), (1, 9)]
+    if [tuple(tup) for tup in output.tuples] == expected_tuples and not isinstance(test_node, pn.SortNode):
+        print "The outputs match!\n"
+        return True
+    print "The outputs do not match.\n"
+    return False
+
+
+def ThetaJoinTest():
+    test_relation_1 = pn.Relation(["a", "b"], [[1, 2], [3, 4], [5, 4]], "test1")
+    test_relation_2 = pn.Relation(["b", "c"], [[4, 4], [4, 6], [2, 0]], "test2")
+    expected_output_relation = pn.Relation(["test1.a", "test1.b", "test2.b", "test2.c"],
+                                           [[3, 4, 4, 4], [3, 4, 4, 6], [5, 4, 4, 6]], "expected_output")
+    test_node = pn.ThetaJoinNode(test_relation_1, test_relation_2, "test1.b == test2.b and test1.a <= test2.c")
+    return test("Theta Join Test 1", test_node, expected_output_relation)
+
+
+def BandJoinTest():
+    test_relation_1 = pn.Relation(["t"], [[1], [5], [10]], "test1")
+    test_relation_2 = pn.Relation(["t", "v"], [[0, "a"], [2, "b"], [4, "c"], [6, "d"], [9, "e"]], "test2")
+    expected_output_relation = pn.Relation(["test1.t", "test2.t", "test2.v"],
+                                           [[1, 0, "a"], [1, 2, "b"], [5, 4, "c"], [5, 6, "d"], [10, 9, "e"]],
+                                           "expected_output")
+    # the selection over the product is turned into a band join
+    test_node = pn.SelectNode("abs(test1.t - test2.t) <= 1", ["test1.t", "test2.t"],
+                              pn.CartesianProductNode(test_relation_1, test_relation_2))
+    test_node = op.Optimizer({}).optimize(test_node)
+    if not isinstance(test_node, pn.ThetaJoinNode) or not test_node.bound_kinds:
+        print "Band Join Test 1 did not choose a band join\n"
+        return False
+    return test("Band Join Test 1", test_node, expected_output_relation)
+
+
+def DivisionTest():
+    test_relation_1 = pn.Relation(["name", "company"], [["Brad Pitt", "Google"], ["Brad Pitt", "NBC"],
+                                                        ["Jay Leno", "NBC"], ["Jon Snow", "NBC"],
+                                                        ["Jon Snow", "Google"], ["Jon Snow", "Google"],
+                                                        ["Jay Leno", "IBM"]], "works")
+    test_relation_2 = pn.Relation(["company"], [["NBC"], ["Google"]], "companies")
+    expected_output_relation = pn.Relation(["name"], [["Brad Pitt"], ["Jon Snow"]], "expected_output")
+    test_node = pn.DivisionNode(test_relation_1, test_relation_2)
+    return test("Division Test 1", test_node, expected_output_relation)
+
+
+def StreamingTest():
+    print "Running test: Streaming Test 1"
+
+    # a relation which counts how many of its tuples have been pulled by its parent
+    class CountingRelation(pn.Relation):
+        pulled = 0
+
+        def rows(self):
+            for tup in self.tuples:
+                self.pulled += 1
+                yield tup
+
+    test_relation_1 = CountingRelation(["a", "b"], [[i, i % 3] for i in range(1000)], "test1")
+    test_relation_2 = pn.Relation(["b", "c"], [[0, "zero"], [1, "one"]], "test2")
+    test_node = pn.ProjectNode(["a", "c"], pn.SelectNode("a > 10", ["a"],
+                                                          pn.NaturalJoinNode(test_relation_1, test_relation_2,
+                                                                             False, False)),
+                               ["a", "c"], [["a"], ["c"]])
+    test_node.bind()
+    first_tuple = next(test_node.rows())
+    print "First tuple %s was produced after pulling %d input tuples\n" % (first_tuple, test_relation_1.pulled)
+    return first_tuple == (12, "zero") and test_relation_1.pulled == 13
+
+
+def ColumnarSelectTest():
+    test_schema_1 = ["name", "company", "salary"]
+    test_relation_1 = pn.ColumnarRelation.from_relation(pn.Relation(test_schema_1, [["Brad Pitt", "Google", 20000],
+                                                                                    ["Jay Leno", "NBC", 5000],
+                                                                                    ["Jon Snow", "Google", 100]],
+                                                                    "test1"))
+    expected_output_relation = pn.Relation(["salary", "name"], [[20000, "Brad Pitt"], [100, "Jon Snow"]],
+                                           "expected_output")
+    test_node = pn.ProjectNode(["salary", "name"], pn.SelectNode("company == 'Google'", ["company"], test_relation_1),
+                               ["salary", "name"], [["salary"], ["name"]])
+    return test("Columnar Select Test 1", test_node, expected_output_relation)
+
+
+def ColumnarGroupingTest():
+    test_relation_1 = pn.ColumnarRelation(["a", "b", "c"], [["lloyd", "ruddock", "lloyd"], array.array('l', [1, 2, 3]),
+                                                           array.array('d', [0.5, 1.5, 2.5])], "test1")
+    test_aggregations = [pn.Aggregation("sum", "b", "sum_b"), pn.Aggregation("max", "c", "max_c")]
+    expected_output_relation = pn.Relation(["a", "sum_b", "max_c"], [["lloyd", 4, 2.5], ["ruddock", 2, 1.5]],
+                                           "expected_output")
+    test_node = pn.AggregationNode(test_relation_1, ["a"], test_aggregations)
+    return test("Columnar Grouping Test 1", test_node, expected_output_relation)
+
+
+def StorageTest():
+    test_relation_1 = pn.Relation(["name", "company", "salary", "rating"], [["Brad Pitt", "Google", 20000, 0.5],
+                                                                          ["Jay Leno", "NBC", 5000, None],
+                                                                          ["Jon Snow", "Google", 100, 2.5]], "test1")
+    handle, path = tempfile.mkstemp(Storage.RELATION_EXTENSION)
+    os.close(handle)
+    try:
+        Storage.save_relation(test_relation_1, path)
+        test_relation_2 = Storage.load_relation(path)
+        expected_output_relation = pn.Relation(["salary", "name", "rating"], [[20000, "Brad Pitt", 0.5],
+                                                                              [100, "Jon Snow", 2.5]],
+                                               "expected_output")
+        test_node = pn.ProjectNode(["salary", "name", "rating"],
+                                   pn.SelectNode("company == 'Google'", ["company"], test_relation_2),
+                                   ["salary", "name", "rating"], [["salary"], ["name"], ["rating"]])
+        return test("Storage Test 1", test_node, expected_output_relation)
+    finally:
+        os.remove(path)
+
+
+def EmptySchemaStorageTest():
+    test_relation_1 = pn.ProjectNode([], pn.Relation(["a"], [[1], [2], [3]], "test1"), [], []).execute()
+    handle, path = tempfile.mkstemp(Storage.RELATION_EXTENSION)
+    os.close(handle)
+    try:
+        # a relation without attributes still has a number of tuples, which is kept in the header
+        Storage.save_relation(test_relation_1, path)
+        expected_output_relation = pn.Relation([], [[], [], []], "expected_output")
+        test_node = pn.ProjectNode([], Storage.load_relation(path), [], [])
+        return test("Empty Schema Storage Test 1", test_node, expected_output_relation)
+    finally:
+        os.remove(path)
+
+
+def LoaderTest():
+    handle, path = tempfile.mkstemp(".tsv")
+    os.write(handle, "name\tcompany\tsalary\trating\nBrad Pitt\tGoogle\t20000\t0.5\nJay Leno\tNBC\t5000\t\n"
+                     "Jon Snow\tGoogle\t100\t2\n")
+    os.close(handle)
+    try:
+        test_relation_1, report = Loader.load_delimited(path, "test1")
+        print report
+        expected_output_relation = pn.Relation(["name", "rating"], [["Brad Pitt", 0.5], ["Jon Snow", 2.0]],
+                                               "expected_output")
+        test_node = pn.ProjectNode(["name", "rating"],
+                                   pn.SelectNode("salary < 50000 and rating >= 0", ["salary", "rating"], test_relation_1),
+                                   ["name", "rating"], [["name"], ["rating"]])
+        return test("Loader Test 1", test_node, expected_output_relation) and report.rows == 3
+    finally:
+        os.remove(path)
+
+
+def TextLoaderTest():
+    handle, path = tempfile.mkstemp(".csv")
+    os.write(handle, "code,value\nnan,1.5\ninf,-inf\n2.5,2\n")
+    os.close(handle)
+    try:
+        # words float() happens to accept are text, so neither column is converted
+        test_relation_1, report = Loader.load_delimited(path, "test1")
+        expected_output_relation = pn.Relation(["code", "value"], [["nan", "1.5"], ["inf", "-inf"], ["2.5", "2"]],
+                                               "expected_output")
+        test_node = pn.ProjectNode(["code", "value"], test_relation_1, ["code", "value"], [["code"], ["value"]])
+        return test("Text Loader Test 1", test_node, expected_output_relation)
+    finally:
+        os.remove(path)
+
+
+def MalformedFileTest():
+    print "Running test: Malformed File Test 1"
+    handle, path = tempfile.mkstemp(".csv")
+    os.write(handle, "a,b\n" + "1,2\n" * 100 + "3\n" + "4,5\n" * 100)
+    os.close(handle)
+    try:
+        # the malformed row is found by a worker process, and must be reported rather than kill the worker
+        Loader.load_delimited(path, "test1", processes=2, chunk_size=64)
+    except SystemExit as e:
+        print "Loading failed as expected: %s\n" % e
+        return True
+    finally:
+        os.remove(path)
+    print "Loading should have failed.\n"
+    return False
+
+
 def SumTest():
     test_schema_1 = ["a", "b"]
     test_tuple_1 = [1, 2]
@@ -187,5 +697,38 @@ def GroupedSumTest():
     return test("Grouped Sum Test 1", test_node, expected_output_relation)
 
 
-run_tests()
+def MultipleGroupingTest():
+    test_schema_1 = ["a", "b", "c"]
+    test_relation_1 = pn.Relation(test_schema_1, [["ruddock", 1, 6], ["lloyd", 1, 2], ["lloyd", 1, None],
+                                                  ["lloyd", 2, 3], ["ruddock", 1, 0]], "test1")
+    test_aggregations = [pn.Aggregation("sum", "c", "sum_c"), pn.Aggregation("count", "c", "count_c"),
+                         pn.Aggregation("min", "c", "min_c"), pn.Aggregation("avg", "c", "avg_c")]
+    expected_output_relation = pn.Relation(["a", "b", "sum_c", "count_c", "min_c", "avg_c"],
+                                           [["ruddock", 1, 6, 2, 0, 3.0], ["lloyd", 1, 2, 1, 2, 2.0],
+                                            ["lloyd", 2, 3, 1, 3, 3.0]], "expected_output")
+    test_node = pn.AggregationNode(test_relation_1, ["a", "b"], test_aggregations)
+    return test("Multiple Grouping Test 1", test_node, expected_output_relation)
+
+
+def ManyGroupingAttributesTest():
+    # nine grouping attributes, the last eight with 256 distinct values each: numbering the groups by combining the
+    # value numbers of every attribute would need 2 ** 72 numbers, and the first two tuples would share a number
+    test_schema_1 = ["a%d" % i for i in range(9)]
+    test_tuples = [[0] * 9, [1] + [0] * 8] + [[i] * 9 for i in range(1, 256)]
+    test_relation_1 = pn.Relation(test_schema_1, test_tuples, "test1")
+    expected_output_relation = pn.Relation(test_schema_1 + ["n"], [tup + [1] for tup in test_tuples],
+                                           "expected_output")
+    test_node = pn.AggregationNode(test_relation_1, test_schema_1, pn.Aggregation("count", "a0", "n"))
+    return test("Many Grouping Attributes Test 1", test_node, expected_output_relation)
+
+
+def SortedGroupingTest():
+    test_schema_1 = ["a", "b"]
+    test_relation_1 = pn.Relation(test_schema_1, [["lloyd", 2], ["lloyd", 3], ["ruddock", 6]], "test1")
+    test_aggregation = pn.Aggregation("max", "b", "max_b")
+    expected_output_relation = pn.Relation(["a", "max_b"], [["ruddock", 6], ["lloyd", 3]], "expected_output")
+    test_node = pn.AggregationNode(test_relation_1, ["a"], test_aggregation, True)
+    return test("Sorted Grouping Test 1", test_node, expected_output_relation)
 
+
+run_tests()
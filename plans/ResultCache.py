@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import sys
+
+import PlanNode as pn
+
+
+# the default memory budget of a result cache, in bytes
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# the number of tuples sampled to estimate the memory used by a result
+SIZE_SAMPLE = 100
+
+
+class CacheEntry:
+    """
+    This class defines a cached query result, along with the catalog entries it was computed from.
+    """
+    def __init__(self, result, inputs, sources, size):
+        """
+        :param result: Relation: the output of the plan
+        :param inputs: array of Relations: every relation the plan read. Plan fingerprints identify relations by
+            their ids, so the entry keeps them alive to stop their ids being reused by other relations.
+        :param sources: array of (name, Relation) pairs: each catalog name bound to a relation the plan read, and the
+            relation object it was bound to when the plan ran
+        :param size: int, the estimated memory used by the result, in bytes
+        """
+        self.result = result
+        self.inputs = inputs
+        self.sources = sources
+        self.size = size
+
+
+def estimated_size(relation):
+    """
+    Estimates the memory used by the tuples of a relation, from a sample of its tuples
+    :param relation: Relation: the relation
+    :return: int, the estimated size in bytes
+    """
+    tuples = relation.tuples
+    sample = tuples[:SIZE_SAMPLE]
+    size = sys.getsizeof(tuples)
+    if sample:
+        sample_size = sum(sys.getsizeof(tup) + sum(sys.getsizeof(value) for value in tup) for tup in sample)
+        size += sample_size * len(tuples) / len(sample)
+    return size
+
+
+class ResultCache:
+    """
+    This object caches the outputs of executed plans, keyed on the fingerprint of the optimized plan.
+    Entries are evicted least recently used first once the cached results exceed the memory budget.
+    An entry is invalidated as soon as any catalog relation it read is replaced, whether by an assignment or by
+    changing the catalog dictionary directly.
+    """
+
+    def __init__(self, relations, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Class constructor.
+        :param relations: A dictionary of relation names to relation objects, the catalog the cached plans read
+        :param memory_budget: int, the maximum estimated size of all the cached results, in bytes
+        """
+        self.relations = relations
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self, plan):
+        """
+        :param plan: Plan Node: the root of a bound plan
+        :return: Relation: a copy of the cached output of the plan, or None if it isn't cached
+        """
+        key = plan.fingerprint()
+        entry = self.entries.get(key)
+        if entry is not None and not self._is_valid(entry):
+            self._remove(key)
+            self.invalidations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # move the entry to the most recently used end
+        del self.entries[key]
+        self.entries[key] = entry
+        self.hits += 1
+        return pn.Relation(entry.result.schema, entry.result.tuples, entry.result.name)
+
+    def store(self, plan, result):
+        """
+        Caches the output of a plan, evicting the least recently used results until it fits in the memory budget.
+        Results larger than the whole budget aren't cached.
+        :param plan: Plan Node: the root of the bound plan
+        :param result: Relation: the output of the plan
+        """
+        key = plan.fingerprint()
+        if key in self.entries:
+            self._remove(key)
+
+        size = estimated_size(result)
+        if size > self.memory_budget:
+            return
+
+        while self.entries and self.size + size > self.memory_budget:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        result = pn.Relation(result.schema, result.tuples, result.name)
+        inputs = pn.base_relations(plan)
+        self.entries[key] = CacheEntry(result, inputs, self._sources(inputs), size)
+        self.size += size
+
+    def invalidate(self, name):
+        """
+        Drops every cached result which read a catalog relation, e.g. because the relation is being replaced
+        :param name: string, the name of the relation in the catalog
+        """
+        for key, entry in self.entries.items():
+            if any(source_name == name for source_name, _ in entry.sources):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+    def _is_valid(self, entry):
+        return all(self.relations.get(name) is relation for name, relation in entry.sources)
+
+    def _sources(self, inputs):
+        """
+        :return: array of (name, Relation) pairs, for each catalog name bound to one of the input relations
+        """
+        ids = set(id(relation) for relation in inputs)
+        return [(name, relation) for name, relation in self.relations.items() if id(relation) in ids]
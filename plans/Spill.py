@@ -0,0 +1,453 @@
+import copy
+import functools
+import heapq
+import itertools
+import marshal
+import operator
+import sys
+import tempfile
+
+import PlanNode as pn
+
+
+# the default memory budget of a query, in bytes
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# the number of files an input is hash partitioned into when it doesn't fit in memory
+DEFAULT_PARTITIONS = 16
+
+# how many times a partition which still doesn't fit in memory is partitioned again; a deeper partition is processed
+# in memory regardless, since all its tuples most likely share the same key
+MAX_SPILL_DEPTH = 4
+
+# the number of tuples sampled to estimate the memory used by each tuple of an input
+SIZE_SAMPLE = 100
+
+# the number of tuples serialized together when writing to a spill file
+SPILL_BATCH_SIZE = 1024
+
+
+def tuple_size(tup):
+    """
+    :return: int, the estimated memory used by a tuple and its values, in bytes
+    """
+    return sys.getsizeof(tup) + sum(sys.getsizeof(value) for value in tup)
+
+
+class SpillFile:
+    """
+    This class defines a temporary file holding a sequence of tuples, written in marshal-serialized batches.
+    The file can be read any number of times once written, and is deleted when closed or garbage collected.
+    """
+    def __init__(self, directory=None):
+        """
+        :param directory: string, the directory the file is created in; None uses the system temporary directory
+        """
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.batch = []
+        self.count = 0
+
+    def append(self, tup):
+        self.batch.append(tup)
+        self.count += 1
+        if len(self.batch) == SPILL_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            marshal.dump(self.batch, self.file)
+            self.batch = []
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.flush()
+        self.file.seek(0)
+        position = 0
+        while True:
+            # other readers of the file may move its position between batches
+            self.file.seek(position)
+            try:
+                batch = marshal.load(self.file)
+            except EOFError:
+                return
+            position = self.file.tell()
+            for tup in batch:
+                yield tup
+
+    def close(self):
+        self.file.close()
+
+
+class Stream(pn.PlanNode):
+    """
+    This node outputs a given sequence of tuples: the spilled or buffered input of a node executed by the SpillEngine.
+    """
+    def __init__(self, schema, name, tuples, cardinality=None, sorted_on=()):
+        """
+        :param schema: Schema: the schema of the tuples
+        :param name: string, the name of the input
+        :param tuples: iterable of tuples, e.g. a list, a generator or a SpillFile
+        :param cardinality: int, the estimated number of tuples; None counts them, which requires a list or SpillFile
+        :param sorted_on: List of (attribute, descending) pairs: the order of the tuples
+        """
+        self.schema = schema
+        self.name = name
+        self.tuples = tuples
+        self.cardinality = len(tuples) if cardinality is None else cardinality
+        self.sorted_on = sorted_on
+
+    def bind(self):
+        self.bound = True
+        return self.schema
+
+    def estimated_cardinality(self):
+        return self.cardinality
+
+    def fingerprint(self):
+        return "stream", id(self)
+
+    def rows(self):
+        return iter(self.tuples)
+
+
+class SpillEngine:
+    """
+    This object executes bound plans within a memory budget, writing the state of blocking nodes to temporary files
+    once it would exceed the budget, so that queries over inputs larger than memory complete.
+    The budget of a query is shared evenly between its blocking nodes:
+    - a natural join buffers its right input, and if it doesn't fit, hash partitions both inputs on the join attributes
+      into files and joins each pair of partitions separately (a grace hash join)
+    - a cartesian product spills its right input to a file, and reads it once per block of left tuples that fits
+    - an aggregation keeps as many groups in memory as fit, and partitions the tuples of every other group into files
+      which are aggregated separately; so does a distinct union, with whole tuples as the groups
+    - an intersection or difference partitions both inputs on whole tuples if its right input doesn't fit
+    - a sort writes sorted runs of tuples to files, then merges them (an external merge sort)
+    - a spool spills the output of its subplan to a file if it doesn't fit
+    Partitions which still don't fit are partitioned again, up to MAX_SPILL_DEPTH times.
+    Every other node, including index, merge and theta joins and divisions, is executed by the row engine, and keeps
+    its state in memory. Spilled values must be serializable by marshal, as relations of numbers and strings are.
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, partitions=DEFAULT_PARTITIONS, directory=None):
+        """
+        Class constructor.
+        :param memory_budget: int, the memory the blocking nodes of a query may use, in bytes
+        :param partitions: int, the number of files an input is partitioned into when it doesn't fit in memory
+        :param directory: string, the directory spill files are created in; None uses the system temporary directory
+        """
+        self.memory_budget = memory_budget
+        self.partitions = partitions
+        self.directory = directory
+
+        # the budget of each blocking node of the plan being executed
+        self.node_budget = memory_budget
+        # the outputs of the spools of the plan being executed, and how many of their consumers are still to read them
+        self.spooled = {}
+
+        # the number of spill files written
+        self.spills = 0
+
+    def execute(self, node):
+        """
+        Runs a plan to completion with this engine
+        :param node: Plan Node or Relation: the root of the plan
+        :return: Relation: the output of the plan
+        """
+        node.ensure_bound()
+        self.node_budget = self.memory_budget / max(1, self._count_blocking(node, set()))
+        self.spooled = {}
+        return pn.Relation(node.schema, list(self.rows(node)), node.name)
+
+    def _count_blocking(self, node, seen):
+        if id(node) in seen:
+            return 0
+        seen.add(id(node))
+        count = int(isinstance(node, (pn.NaturalJoinNode, pn.CartesianProductNode, pn.SetOperationNode,
+                                      pn.AggregationNode, pn.SortNode, pn.SpoolNode)))
+        for attribute in ("left_child", "right_child"):
+            if hasattr(node, attribute):
+                count += self._count_blocking(getattr(node, attribute), seen)
+        return count
+
+    def rows(self, node):
+        """
+        Generates the output tuples of a node
+        """
+        if isinstance(node, pn.NaturalJoinNode) and node.build_index is None and not node.merge and \
+                node.left_key_indices:
+            return self._join_rows(node, self.rows(node.left_child), self.rows(node.right_child), 0)
+        if isinstance(node, pn.CartesianProductNode):
+            return self._product_rows(node)
+        if isinstance(node, pn.UnionNode) and node.distinct:
+            tuples = itertools.chain(self.rows(node.left_child), self.rows(node.right_child))
+            return self._distinct_rows(node, tuples, 0)
+        if isinstance(node, (pn.IntersectionNode, pn.SetDifferenceNode)):
+            return self._set_operation_rows(node, self.rows(node.left_child), self.rows(node.right_child), 0)
+        if isinstance(node, pn.AggregationNode) and node.group_indices and not node.input_sorted:
+            return self._aggregation_rows(node, self.rows(node.left_child), 0)
+        if isinstance(node, pn.SortNode):
+            return self._sort_rows(node)
+        if isinstance(node, pn.SpoolNode):
+            return self._spool_rows(node)
+        if isinstance(node, pn.Relation) or isinstance(node, pn.IndexScanNode):
+            return node.rows()
+
+        # any other node runs over the streamed outputs of its children, as executed by this engine
+        node = copy.copy(node)
+        for attribute in ("left_child", "right_child"):
+            child = getattr(node, attribute, None)
+            if isinstance(child, pn.PlanNode):
+                setattr(node, attribute, self._stream(child, self.rows(child)))
+        node.bind()
+        return node.rows()
+
+    @staticmethod
+    def _stream(node, tuples, cardinality=None):
+        """
+        Wraps tuples produced in place of the output of a node
+        """
+        if cardinality is None and isinstance(tuples, (list, SpillFile)):
+            cardinality = len(tuples)
+        elif cardinality is None:
+            cardinality = node.estimated_cardinality()
+        return Stream(node.schema, node.name, tuples, cardinality, node.sorted_on)
+
+    def _capacity(self, sample):
+        """
+        :param sample: array of tuples from an input
+        :return: int, the number of tuples of the input which fit within the budget of a node
+        """
+        if not sample:
+            return sys.maxint
+        size = sum(tuple_size(tup) for tup in sample) / float(len(sample))
+        return max(1, int(self.node_budget / size))
+
+    def _read(self, tuples):
+        """
+        Reads tuples into memory until the budget of a node is used up
+        :return: An array of the tuples read, and True if there are more tuples than fit, in which case the array holds
+            more tuples than fit and the rest are still to be read
+        """
+        tuples = iter(tuples)
+        buffered = list(itertools.islice(tuples, SIZE_SAMPLE))
+        capacity = self._capacity(buffered)
+        if len(buffered) == SIZE_SAMPLE and len(buffered) <= capacity:
+            buffered.extend(itertools.islice(tuples, capacity + 1 - len(buffered)))
+        return buffered, len(buffered) > capacity
+
+    def _spill_file(self):
+        self.spills += 1
+        return SpillFile(self.directory)
+
+    def _partition(self, tuples, key, depth):
+        """
+        Hash partitions tuples into spill files
+        :param key: function returning the value a tuple is partitioned on
+        :param depth: int, how many times the tuples have already been partitioned; each level hashes differently
+        :return: array of SpillFiles, None for each empty partition
+        """
+        partitions = [None] * self.partitions
+        count = self.partitions
+        for tup in tuples:
+            i = hash((depth, key(tup))) % count
+            if partitions[i] is None:
+                partitions[i] = self._spill_file()
+            partitions[i].append(tup)
+        return partitions
+
+    def _store(self, tuples):
+        """
+        Keeps tuples in memory if they fit, otherwise writes them all to a spill file
+        :return: An array or SpillFile of the tuples
+        """
+        tuples = iter(tuples)
+        buffered, overflowed = self._read(tuples)
+        if not overflowed:
+            return buffered
+        spill_file = self._spill_file()
+        for tup in itertools.chain(buffered, tuples):
+            spill_file.append(tup)
+        return spill_file
+
+    def _join_rows(self, node, left_tuples, right_tuples, depth):
+        left_tuples, right_tuples = iter(left_tuples), iter(right_tuples)
+        buffered, overflowed = self._read(right_tuples)
+        right_tuples = itertools.chain(buffered, right_tuples)
+        if not overflowed or depth == MAX_SPILL_DEPTH:
+            # the right input fits: it is hashed, and the left input streamed past it
+            join = pn.NaturalJoinNode(self._stream(node.left_child, left_tuples),
+                                      self._stream(node.right_child, right_tuples),
+                                      node.is_left_outer, node.is_right_outer)
+            join.build_left = False
+            join.bind()
+            tuples = join.rows()
+        else:
+            tuples = self._grace_join_rows(node, left_tuples, right_tuples, depth)
+        for tup in tuples:
+            yield tup
+
+    def _grace_join_rows(self, node, left_tuples, right_tuples, depth):
+        # matching tuples land in the same pair of partitions, and dangling tuples stay dangling, so each pair can be
+        # joined on its own
+        right_partitions = self._partition(right_tuples, operator.itemgetter(*node.right_key_indices), depth)
+        left_partitions = self._partition(left_tuples, operator.itemgetter(*node.left_key_indices), depth)
+        for left, right in zip(left_partitions, right_partitions):
+            for tup in self._join_rows(node, left or (), right or (), depth + 1):
+                yield tup
+            for partition in (left, right):
+                if partition is not None:
+                    partition.close()
+
+    def _product_rows(self, node):
+        right_tuples = self._store(self.rows(node.right_child))
+        left_tuples = iter(self.rows(node.left_child))
+        if isinstance(right_tuples, list):
+            for left_tuple in left_tuples:
+                for right_tuple in right_tuples:
+                    yield left_tuple + right_tuple
+            return
+
+        # the right input is read once for each block of left tuples which fits in memory
+        while True:
+            block, overflowed = self._read(left_tuples)
+            if not block:
+                break
+            for right_tuple in right_tuples:
+                for left_tuple in block:
+                    yield left_tuple + right_tuple
+            if not overflowed:
+                break
+        right_tuples.close()
+
+    def _hybrid_rows(self, tuples, key, depth, process):
+        """
+        Processes the groups of tuples which fit in memory straight away, and partitions the tuples of every other group
+        into spill files to be processed afterwards, a partition at a time
+        :param key: function returning the group of a tuple
+        :param process: function processing an iterable of the tuples of some groups into output tuples
+        """
+        tuples = iter(tuples)
+        sample = list(itertools.islice(tuples, SIZE_SAMPLE))
+        capacity = self._capacity(sample) if depth < MAX_SPILL_DEPTH else sys.maxint
+        resident = set()
+        partitions = [None] * self.partitions
+        count = self.partitions
+
+        def route():
+            for tup in itertools.chain(sample, tuples):
+                group = key(tup)
+                if group in resident:
+                    yield tup
+                elif len(resident) < capacity:
+                    resident.add(group)
+                    yield tup
+                else:
+                    i = hash((depth, group)) % count
+                    if partitions[i] is None:
+                        partitions[i] = self._spill_file()
+                    partitions[i].append(tup)
+
+        for tup in process(route()):
+            yield tup
+        resident.clear()
+
+        for partition in partitions:
+            if partition is not None:
+                for tup in self._hybrid_rows(partition, key, depth + 1, process):
+                    yield tup
+                partition.close()
+
+    def _aggregation_rows(self, node, tuples, depth):
+        def process(group_tuples):
+            aggregation = pn.AggregationNode(self._stream(node.left_child, group_tuples), node.grouping_attributes,
+                                             node.aggregations)
+            aggregation.bind()
+            return aggregation.rows()
+
+        return self._hybrid_rows(tuples, operator.itemgetter(*node.group_indices), depth, process)
+
+    def _distinct_rows(self, node, tuples, depth):
+        def process(group_tuples):
+            seen = set()
+            for tup in group_tuples:
+                if tup not in seen:
+                    seen.add(tup)
+                    yield tup
+
+        return self._hybrid_rows(tuples, lambda tup: tup, depth, process)
+
+    def _set_operation_rows(self, node, left_tuples, right_tuples, depth):
+        left_tuples, right_tuples = iter(left_tuples), iter(right_tuples)
+        buffered, overflowed = self._read(right_tuples)
+        if not overflowed or depth == MAX_SPILL_DEPTH:
+            left = self._stream(node.left_child, left_tuples)
+            right = self._stream(node.right_child, itertools.chain(buffered, right_tuples),
+                                 len(buffered) if not overflowed else None)
+            set_operation = node.__class__(left, right, node.distinct)
+            set_operation.bind()
+            tuples = set_operation.rows()
+        else:
+            tuples = self._partitioned_set_operation_rows(node, left_tuples, itertools.chain(buffered, right_tuples),
+                                                          depth)
+        for tup in tuples:
+            yield tup
+
+    def _partitioned_set_operation_rows(self, node, left_tuples, right_tuples, depth):
+        # equal tuples land in the same pair of partitions
+        right_partitions = self._partition(right_tuples, lambda tup: tup, depth)
+        left_partitions = self._partition(left_tuples, lambda tup: tup, depth)
+        for left, right in zip(left_partitions, right_partitions):
+            if left is not None:
+                for tup in self._set_operation_rows(node, left, right or (), depth + 1):
+                    yield tup
+            for partition in (left, right):
+                if partition is not None:
+                    partition.close()
+
+    def _sort_rows(self, node):
+        order = [(i, descending) for i, (attribute, descending) in zip(node.sort_indices, node.sort_attributes)]
+
+        def compare(left, right):
+            for i, descending in order:
+                result = cmp(left[i], right[i])
+                if result:
+                    return -result if descending else result
+            return 0
+        key = functools.cmp_to_key(compare)
+
+        tuples = iter(self.rows(node.left_child))
+        runs = []
+        while True:
+            run, overflowed = self._read(tuples)
+            run.sort(key=key)
+            if not runs and not overflowed:
+                for tup in run:
+                    yield tup
+                return
+            spill_file = self._spill_file()
+            for tup in run:
+                spill_file.append(tup)
+            runs.append(spill_file)
+            if not overflowed:
+                break
+
+        # ties are broken by run, and the runs were cut from the input in order, so the sort stays stable
+        merged = heapq.merge(*[((key(tup), i, tup) for tup in spill_file) for i, spill_file in enumerate(runs)])
+        for sort_key, i, tup in merged:
+            yield tup
+        for spill_file in runs:
+            spill_file.close()
+
+    def _spool_rows(self, node):
+        # the subplan runs once, when the first consumer reads the spool, and is released after the last one
+        stored, remaining = self.spooled.get(id(node), (None, node.consumers))
+        if stored is None:
+            stored = self._store(self.rows(node.left_child))
+        if remaining > 1:
+            self.spooled[id(node)] = stored, remaining - 1
+        else:
+            self.spooled.pop(id(node), None)
+        for tup in stored:
+            yield tup
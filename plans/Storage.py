@@ -0,0 +1,256 @@
+import itertools
+import marshal
+import mmap
+import os
+import struct
+import sys
+
+import PlanNode as pn
+
+
+# the first bytes of every relation file, and the version of the format
+MAGIC = "RELB"
+FORMAT_VERSION = 1
+
+# the extension of the relation files of a catalog directory
+RELATION_EXTENSION = ".rel"
+
+# the file header: magic, format version, number of rows, number of columns and length of the relation name
+HEADER = struct.Struct("<4sIQII")
+
+# each column entry of the header, after the column name: the kind of column, the offset of its data, and the size of
+# its dictionary (zero for a fixed width column)
+COLUMN_ENTRY = struct.Struct("<cQQ")
+
+# the kind of a dictionary encoded column; the kind of a fixed width column is the struct code of its values
+DICTIONARY_KIND = "*"
+
+# the struct codes of the integer widths, narrowest first, with the range of values each can hold
+INTEGER_CODES = [(code, -2 ** (8 * size - 1), 2 ** (8 * size - 1) - 1) for code, size in
+                 (("b", 1), ("h", 2), ("i", 4), ("q", 8))]
+CODE_WIDTHS = [(code, 2 ** (8 * size) - 1) for code, size in (("B", 1), ("H", 2), ("I", 4))]
+
+# the number of values unpacked at a time when iterating over a fixed width column
+READ_CHUNK = 4096
+
+# every section of the file starts at a multiple of this many bytes
+ALIGNMENT = 8
+
+
+class MappedColumn:
+    """
+    This class defines a column of fixed width values read straight out of a memory mapped file: nothing is read until a
+    value is asked for, and only the pages holding the values asked for are loaded.
+    """
+    def __init__(self, buffer, offset, size, code):
+        """
+        :param buffer: mmap: the mapped file
+        :param offset: int, the position of the first value in the file
+        :param size: int, the number of values
+        :param code: string, the struct code of the values
+        """
+        self.buffer = buffer
+        self.offset = offset
+        self.size = size
+        self.code = code
+        self.item = struct.Struct("<" + code)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.size)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return list(self._unpack(start, max(start, stop)))
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("column index out of range")
+        return self.item.unpack_from(self.buffer, self.offset + index * self.item.size)[0]
+
+    def __iter__(self):
+        for start in range(0, self.size, READ_CHUNK):
+            for value in self._unpack(start, min(start + READ_CHUNK, self.size)):
+                yield value
+
+    def _unpack(self, start, stop):
+        return struct.unpack_from("<%d%s" % (stop - start, self.code), self.buffer,
+                                  self.offset + start * self.item.size)
+
+
+class DictionaryColumn:
+    """
+    This class defines a dictionary encoded column read out of a memory mapped file: a fixed width code per value,
+    indexing a dictionary of the distinct values, each stored marshal serialized in a heap.
+    Dictionary entries are only deserialized when first read.
+    """
+    def __init__(self, codes, offsets, heap_offset, buffer):
+        """
+        :param codes: MappedColumn: the dictionary code of each value
+        :param offsets: MappedColumn: the position of each dictionary entry within the heap, followed by the size of
+            the heap
+        :param heap_offset: int, the position of the heap in the file
+        :param buffer: mmap: the mapped file
+        """
+        self.codes = codes
+        self.offsets = offsets
+        self.heap_offset = heap_offset
+        self.buffer = buffer
+        self.dictionary = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._value(code) for code in self.codes[index]]
+        return self._value(self.codes[index])
+
+    def __iter__(self):
+        # a full scan reads every value, so the whole dictionary is deserialized up front
+        dictionary = [self._value(code) for code in range(len(self.offsets) - 1)]
+        return itertools.imap(dictionary.__getitem__, self.codes)
+
+    def _value(self, code):
+        if code not in self.dictionary:
+            start = self.heap_offset + self.offsets[code]
+            end = self.heap_offset + self.offsets[code + 1]
+            self.dictionary[code] = marshal.loads(self.buffer[start:end])
+        return self.dictionary[code]
+
+
+def _narrowest(codes, low, high):
+    for code, code_low, code_high in codes:
+        if code_low <= low and high <= code_high:
+            return code
+    return None
+
+
+def _encode_column(values):
+    """
+    Chooses how a column is stored: ints in the narrowest integer width which holds them all, floats as doubles, and
+    anything else dictionary encoded
+    :return: the kind of the column, the size of its dictionary, and the sections of its data as strings
+    """
+    types = set(type(value) for value in values)
+    if types == set([int]) and _narrowest(INTEGER_CODES, min(values), max(values)):
+        code = _narrowest(INTEGER_CODES, min(values), max(values))
+        return code, 0, [struct.pack("<%d%s" % (len(values), code), *values)]
+    if types == set([float]):
+        return "d", 0, [struct.pack("<%dd" % len(values), *values)]
+
+    dictionary = {}
+    entries = []
+    codes = []
+    for value in values:
+        # equal values of different types, such as 1 and 1.0, get separate entries
+        key = type(value), value
+        code = dictionary.get(key)
+        if code is None:
+            code = dictionary[key] = len(entries)
+            entries.append(marshal.dumps(value))
+        codes.append(code)
+
+    code_width = _narrowest([(code, 0, high) for code, high in CODE_WIDTHS], 0, len(entries))
+    offsets = [0]
+    for entry in entries:
+        offsets.append(offsets[-1] + len(entry))
+    return DICTIONARY_KIND, len(entries), [struct.pack("<%d%s" % (len(codes), code_width), *codes),
+                                           struct.pack("<%dQ" % len(offsets), *offsets), "".join(entries)]
+
+
+def _padding(position):
+    return "\0" * (-position % ALIGNMENT)
+
+
+def save_relation(relation, path):
+    """
+    Writes a relation to a binary file: a header holding the schema, followed by each column, either as fixed width
+    values or dictionary encoded. Values which aren't ints or floats must be serializable by marshal.
+    :param relation: Relation: the relation to write
+    :param path: string, the path of the file
+    """
+    size = len(relation.tuples)
+    columns = [_encode_column(list(relation.column_values(i))) for i in range(len(relation.schema))]
+
+    header_size = HEADER.size + len(relation.name) + \
+        sum(4 + len(attribute) + COLUMN_ENTRY.size for attribute in relation.schema)
+    header = [HEADER.pack(MAGIC, FORMAT_VERSION, size, len(relation.schema), len(relation.name)), relation.name]
+    body = [_padding(header_size)]
+    position = header_size + len(body[0])
+
+    for attribute, (kind, dictionary_size, sections) in zip(relation.schema, columns):
+        header.extend([struct.pack("<I", len(attribute)), attribute,
+                       COLUMN_ENTRY.pack(kind, position, dictionary_size)])
+        for section in sections:
+            body.extend([section, _padding(len(section))])
+            position += len(section) + len(body[-1])
+
+    with open(path, "wb") as output:
+        output.write("".join(header + body))
+
+
+def load_relation(path):
+    """
+    Opens a relation file written by save_relation, memory mapping it rather than reading it, so opening it is
+    immediate and only the pages of the columns queries read are ever loaded.
+    :param path: string, the path of the file
+    :return: ColumnarRelation: the relation, with columns reading the mapped file
+    """
+    with open(path, "rb") as input_file:
+        buffer = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(buffer) < HEADER.size:
+        sys.exit("%s is not a relation file" % path)
+    magic, version, size, column_count, name_length = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        sys.exit("%s is not a relation file of version %d" % (path, FORMAT_VERSION))
+
+    position = HEADER.size
+    name = buffer[position:position + name_length]
+    position += name_length
+
+    schema, columns = [], []
+    for _ in range(column_count):
+        attribute_length, = struct.unpack_from("<I", buffer, position)
+        position += 4
+        schema.append(buffer[position:position + attribute_length])
+        position += attribute_length
+        kind, offset, dictionary_size = COLUMN_ENTRY.unpack_from(buffer, position)
+        position += COLUMN_ENTRY.size
+
+        if kind != DICTIONARY_KIND:
+            columns.append(MappedColumn(buffer, offset, size, kind))
+            continue
+        code_width = _narrowest([(code, 0, high) for code, high in CODE_WIDTHS], 0, dictionary_size)
+        codes = MappedColumn(buffer, offset, size, code_width)
+        offsets_offset = offset + codes.item.size * size
+        offsets_offset += -offsets_offset % ALIGNMENT
+        offsets = MappedColumn(buffer, offsets_offset, dictionary_size + 1, "Q")
+        heap_offset = offsets_offset + 8 * (dictionary_size + 1)
+        columns.append(DictionaryColumn(codes, offsets, heap_offset, buffer))
+
+    # the number of tuples is read from the header, since a relation may have no columns to count them in
+    return pn.ColumnarRelation(schema, columns, name, size)
+
+
+def save_catalog(relations, directory):
+    """
+    Writes every relation of a catalog to a relation file in a directory, named after its catalog name
+    :param relations: A dictionary of relation names to relation objects
+    :param directory: string, the path of the directory
+    """
+    for name, relation in relations.items():
+        save_relation(relation, os.path.join(directory, name + RELATION_EXTENSION))
+
+
+def load_catalog(directory):
+    """
+    Opens every relation file in a directory
+    :param directory: string, the path of the directory
+    :return: A dictionary of relation names to the opened relations, named after their files
+    """
+    return dict((file_name[:-len(RELATION_EXTENSION)], load_relation(os.path.join(directory, file_name)))
+                for file_name in sorted(os.listdir(directory)) if file_name.endswith(RELATION_EXTENSION))
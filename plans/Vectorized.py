@@ -0,0 +1,360 @@
+import array
+import weakref
+
+import numpy as np
+
+import Expression as ex
+import PlanNode as pn
+
+
+DEFAULT_BATCH_SIZE = 4096
+
+
+class Batch:
+    """
+    This class defines a batch of rows stored as one numpy array per attribute.
+    """
+    def __init__(self, columns, size):
+        """
+        Batch object constructor
+        :param columns: array of numpy arrays, one per attribute, each of length size
+        :param size: int, the number of rows in the batch
+        """
+        self.columns = columns
+        self.size = size
+
+    @staticmethod
+    def from_rows(rows, width):
+        """
+        Builds a batch from a list of row tuples
+        :param rows: array of rows
+        :param width: int, the number of attributes in each row
+        :return: The built Batch
+        """
+        return Batch([column_array([row[i] for row in rows]) for i in range(width)], len(rows))
+
+    def to_rows(self):
+        """
+        Converts the batch back into python rows, with every value converted back to a native python object
+        :return: array of rows
+        """
+        if not self.columns:
+            return [()] * self.size
+        return zip(*[column.tolist() for column in self.columns])
+
+    def filter(self, mask):
+        """
+        :param mask: numpy boolean array, True for each row to keep
+        :return: A new Batch with only the selected rows
+        """
+        return Batch([column[mask] for column in self.columns], int(np.count_nonzero(mask)))
+
+
+def column_array(values):
+    """
+    Converts a list of python values into a numpy array.
+    Columns made up entirely of ints, floats or booleans get a native numpy type; anything else (strings, nulls or
+    mixed types) is kept as an object array, so every value keeps its exact python semantics.
+    :param values: array of values
+    :return: The numpy array
+    """
+    types = set(type(value) for value in values)
+    if types == set([int]):
+        return np.array(values, dtype=np.int64)
+    if types == set([float]):
+        return np.array(values, dtype=np.float64)
+    if types == set([bool]):
+        return np.array(values, dtype=np.bool_)
+
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def _broadcast(value, size):
+    """
+    Turns the result of a vector expression into an array of the batch size; constant expressions produce scalars
+    """
+    if isinstance(value, np.ndarray) and value.ndim == 1:
+        return value
+    column = np.empty(size, dtype=object)
+    column[:] = [np.asarray(value).item()] * size
+    return column
+
+
+def _not_null(column):
+    """
+    :return: a numpy boolean array, True for each non-null value of the column
+    """
+    if column.dtype != object:
+        return np.ones(len(column), dtype=np.bool_)
+    return np.array([value is not None for value in column], dtype=np.bool_)
+
+
+def vector_source(expression, column_source):
+    """
+    Generates numpy source for an expression, evaluating it over whole columns at once.
+    Negation becomes a numpy logical function, comparisons and arithmetic are applied elementwise, and function calls
+    are applied through numpy universal functions wrapping the python functions. 'and' and 'or' can't be vectorized,
+    since python evaluates them lazily and their value is one of their operands.
+    :param expression: Expression: the parsed expression
+    :param column_source: function mapping an attribute name to the source that reads its column
+    :return: string, the numpy source
+    """
+    if isinstance(expression, ex.Literal):
+        return repr(expression.value)
+
+    if isinstance(expression, ex.Column):
+        return column_source(expression.name)
+
+    if isinstance(expression, ex.Parameter):
+        return expression.to_source(column_source)
+
+    if isinstance(expression, ex.UnaryOperation):
+        operand = vector_source(expression.operand, column_source)
+        if expression.operator == "not":
+            return "np.logical_not(%s)" % operand
+        return "(%s%s)" % (expression.operator, operand)
+
+    if isinstance(expression, ex.BinaryOperation):
+        if expression.operator in ("and", "or"):
+            raise TypeError("cannot vectorize expression %s" % expression)
+        operands = [vector_source(operand, column_source) for operand in expression.operands]
+        return "(%s)" % (" %s " % expression.operator).join(operands)
+
+    if isinstance(expression, ex.Comparison):
+        # chained comparisons are the conjunction of each adjacent comparison
+        operands = [vector_source(operand, column_source) for operand in expression.operands]
+        comparisons = ["(%s %s %s)" % (operands[i], operator, operands[i + 1])
+                       for i, operator in enumerate(expression.operators)]
+        source = comparisons[0]
+        for comparison in comparisons[1:]:
+            source = "np.logical_and(%s, %s)" % (source, comparison)
+        return source
+
+    if isinstance(expression, ex.FunctionCall):
+        arguments = [vector_source(argument, column_source) for argument in expression.arguments]
+        return "np.frompyfunc(%s, %d, 1)(%s)" % (expression.function_name, len(arguments), ", ".join(arguments))
+
+    raise TypeError("cannot vectorize expression %s" % expression)
+
+
+def _lazy(expression):
+    """
+    :return: True if the expression has an 'and' or 'or' operator anywhere in it
+    """
+    if isinstance(expression, ex.BinaryOperation) and expression.operator in ("and", "or"):
+        return True
+    if isinstance(expression, ex.UnaryOperation):
+        return _lazy(expression.operand)
+    if isinstance(expression, (ex.BinaryOperation, ex.Comparison)):
+        return any(_lazy(operand) for operand in expression.operands)
+    if isinstance(expression, ex.FunctionCall):
+        return any(_lazy(argument) for argument in expression.arguments)
+    return False
+
+
+def compile_vector_expression(expression, schema):
+    """
+    Compiles an expression into a function taking a list of column arrays and returning the column of results.
+    Expressions with 'and' or 'or' operators are evaluated a row at a time instead, by the row engine's compiled
+    function, so operands are only evaluated when the row engine would evaluate them.
+    :param expression: Expression: the parsed expression
+    :param schema: Schema: the schema of the input columns
+    :return: The compiled function
+    """
+    if _lazy(expression):
+        # the function reads rows made of just the referenced columns
+        positions = sorted(set(schema.position(name) for name in expression.columns()))
+        function = ex.compile_expression(expression, pn.Schema([schema[i] for i in positions]))
+        if not positions:
+            return lambda columns: function(())
+        return lambda columns: column_array([function(row)
+                                             for row in zip(*[columns[i].tolist() for i in positions])])
+
+    namespace = {"__builtins__": {}, "np": np, "parameters": ex.parameter_values([expression])}
+    namespace.update(ex.FUNCTIONS)
+    source = vector_source(expression, lambda name: "columns[%d]" % schema.position(name))
+    return eval(compile("lambda columns: %s" % source, "<vector expression>", "eval"), namespace)
+
+
+class VectorEngine:
+    """
+    This object executes bound plans over batches of rows stored as numpy column arrays.
+    Selections, projections and aggregations are evaluated a column at a time; every other node is executed by the
+    row engine and its output is converted into batches.
+    Integer columns are evaluated as 64 bit numpy integers, so arithmetic which would overflow into a python long is
+    not supported.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Class constructor.
+        :param batch_size: int, the maximum number of rows in each batch
+        """
+        self.batch_size = batch_size
+        self.compiled = weakref.WeakKeyDictionary()
+
+    def execute(self, node):
+        """
+        Runs a plan to completion with this engine
+        :param node: Plan Node or Relation: the root of the plan
+        :return: Relation: the output of the plan
+        """
+        node.ensure_bound()
+        tuples = []
+        for batch in self.batches(node):
+            tuples.extend(batch.to_rows())
+        return pn.Relation(node.schema, tuples, node.name)
+
+    def batches(self, node):
+        """
+        Generates the output of a node as a sequence of batches
+        """
+        if isinstance(node, pn.SelectNode):
+            return self._select_batches(node)
+        if isinstance(node, pn.ProjectNode):
+            return self._project_batches(node)
+        if isinstance(node, pn.AggregationNode):
+            return self._aggregation_batches(node)
+        if isinstance(node, pn.ColumnarRelation):
+            return self._columnar_batches(node)
+        return self._row_batches(node.rows(), len(node.schema))
+
+    def _columnar_batches(self, relation):
+        """
+        Slices the columns of a columnar relation into batches; typed columns are viewed in place without copying
+        """
+        if relation.size == 0:
+            return
+        columns = [np.frombuffer(column, dtype=column.typecode) if isinstance(column, array.array) else column
+                   for column in relation.columns]
+        for start in range(0, relation.size, self.batch_size):
+            end = min(start + self.batch_size, relation.size)
+            yield Batch([column[start:end] if isinstance(column, np.ndarray) else column_array(column[start:end])
+                         for column in columns], end - start)
+
+    def _row_batches(self, rows, width):
+        """
+        Cuts a stream of rows into batches
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.batch_size:
+                yield Batch.from_rows(chunk, width)
+                chunk = []
+        if chunk:
+            yield Batch.from_rows(chunk, width)
+
+    def _compiled(self, node, build):
+        """
+        Compiles the vector functions of a node once, caching them for as long as the node exists
+        """
+        if node not in self.compiled:
+            self.compiled[node] = build()
+        return self.compiled[node]
+
+    def _select_batches(self, node):
+        predicates = self._compiled(node, lambda: [compile_vector_expression(conjunct, node.left_child.schema)
+                                                   for conjunct in ex.split_conjuncts(node.predicate)])
+        for batch in self.batches(node.left_child):
+            # each conjunct only sees the rows every conjunct before it selected, so a conjunct such as b != 0 guards
+            # the conjuncts after it, as in the row engine
+            for predicate in predicates:
+                mask = _broadcast(predicate(batch.columns), batch.size).astype(np.bool_)
+                if not mask.all():
+                    batch = batch.filter(mask)
+                if batch.size == 0:
+                    break
+            if batch.size:
+                yield batch
+
+    def _project_batches(self, node):
+        projections = self._compiled(node, lambda: [compile_vector_expression(projection, node.left_child.schema)
+                                                    for projection in node.projections])
+        for batch in self.batches(node.left_child):
+            yield Batch([_broadcast(projection(batch.columns), batch.size) for projection in projections], batch.size)
+
+    def _aggregation_batches(self, node):
+        # aggregation is blocking, so gather all the needed input columns first
+        needed = sorted(set(node.group_indices + node.value_indices))
+        gathered = dict((i, []) for i in needed)
+        size = 0
+        for batch in self.batches(node.left_child):
+            for i in needed:
+                gathered[i].append(batch.columns[i])
+            size += batch.size
+        columns = dict((i, np.concatenate(gathered[i]) if gathered[i] else column_array([])) for i in needed)
+
+        if not node.group_indices:
+            # simple aggregation case: every row is in a single group, which exists even if the input is empty
+            group_ids = np.zeros(size, dtype=np.int64)
+            group_count = 1
+            key_columns = []
+        elif size == 0:
+            return
+        else:
+            # number each distinct combination of grouping values, renumbering densely after each attribute so the
+            # numbers stay below the number of rows however many distinct values the attributes have
+            group_ids = np.zeros(size, dtype=np.int64)
+            for i in node.group_indices:
+                uniques, codes = np.unique(columns[i], return_inverse=True)
+                group_keys, group_ids = np.unique(group_ids * len(uniques) + codes, return_inverse=True)
+            group_count = len(group_keys)
+
+            # groups are renumbered in the order they first appear, so input sorted on the grouping attributes gives
+            # output sorted the same way, as the row engine does. The grouping values of each group are read from
+            # the first row in the group.
+            first_rows = np.empty(group_count, dtype=np.int64)
+            first_rows[group_ids[::-1]] = np.arange(size - 1, -1, -1)
+            order = np.argsort(first_rows)
+            ranks = np.empty(group_count, dtype=np.int64)
+            ranks[order] = np.arange(group_count)
+            group_ids = ranks[group_ids]
+            key_columns = [columns[i][first_rows[order]] for i in node.group_indices]
+
+        result_columns = [self._aggregate(aggregation, columns[i], group_ids, group_count)
+                          for aggregation, i in zip(node.aggregations, node.value_indices)]
+        yield Batch(key_columns + result_columns, group_count)
+
+    @staticmethod
+    def _aggregate(aggregation, column, group_ids, group_count):
+        """
+        Evaluates an aggregate function for every group at once
+        :param aggregation: Aggregation: the aggregate function
+        :param column: numpy array: the aggregated attribute values
+        :param group_ids: numpy array: the group number of each row
+        :param group_count: int, the number of groups
+        :return: numpy array: the result for each group
+        """
+        valid = _not_null(column)
+        values, ids = column[valid], group_ids[valid]
+        counts = np.bincount(ids, minlength=group_count)
+        function = aggregation.function_name
+
+        if function == "count":
+            return counts
+
+        # sums are accumulated in row order, exactly as the row engine does
+        totals = np.zeros(group_count, dtype=values.dtype if values.dtype != np.bool_ else np.int64)
+        if function in ("sum", "avg"):
+            np.add.at(totals, ids, values)
+            if function == "sum":
+                return totals
+            result = np.empty(group_count, dtype=object)
+            result[:] = [total / float(count) if count else None for total, count in zip(totals.tolist(), counts)]
+            return result
+
+        # min and max start from the first value of each group
+        result = np.empty(group_count, dtype=object if values.dtype == object else values.dtype)
+        if len(values):
+            first_values = np.empty(group_count, dtype=np.int64)
+            first_values[ids[::-1]] = np.arange(len(ids) - 1, -1, -1)
+            result[counts > 0] = values[first_values[counts > 0]]
+            (np.minimum if function == "min" else np.maximum).at(result, ids, values)
+
+        if (counts == 0).any():
+            result = result.astype(object)
+            result[counts == 0] = None
+        return result